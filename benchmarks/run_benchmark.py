@@ -0,0 +1,269 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import resource
+import sqlite3
+import subprocess
+import sys
+import time
+from dataclasses import asdict
+from datetime import datetime, timezone
+
+import redis
+
+loc = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(loc, "mr_crawly"))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from main import crawl  # noqa
+from manager import Manager  # noqa
+from synthetic_site import SiteConfig, SyntheticSite  # noqa
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# Named site shapes, so runs on different commits measure the same thing
+SCENARIOS = {
+    "small": SiteConfig(pages=200, fanout=8, page_size=10_000),
+    "medium": SiteConfig(pages=2_000, fanout=12, page_size=20_000),
+    "slow": SiteConfig(pages=500, fanout=8, page_size=20_000, latency=0.2),
+    "flaky": SiteConfig(pages=500, fanout=8, page_size=20_000, error_rate=0.1),
+    "no-sitemap": SiteConfig(pages=500, fanout=8, page_size=20_000, sitemap=False),
+}
+
+
+def git_revision() -> tuple[str, bool]:
+    """Returns the short commit hash of the tree and whether it is dirty"""
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=loc, text=True
+        ).strip()
+        dirty = bool(
+            subprocess.check_output(
+                ["git", "status", "--porcelain", "--untracked-files=no"],
+                cwd=loc,
+                text=True,
+            ).strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+    return commit, dirty
+
+
+def histogram_quantiles(
+    redis_conn, metrics, series: str, quantiles=(0.5, 0.99)
+) -> dict:
+    """
+    Estimate quantiles from a histogram stored by metrics.Metrics, by linear
+    interpolation within the bucket that contains each rank (as Prometheus'
+    histogram_quantile does).
+    """
+    buckets, count = {}, 0.0
+    for field, value in redis_conn.hgetall(metrics.histograms_key).items():
+        field = field.decode("utf-8")
+        name, _, part = field.rpartition("|")
+        if name != series:
+            continue
+        if part == "count":
+            count = float(value)
+        elif part != "sum":
+            buckets[part] = float(value)
+    if not count:
+        return {f"p{int(q * 100)}": None for q in quantiles}
+
+    bounds = [*metrics.buckets, "+Inf"]
+    results = {}
+    for quantile in quantiles:
+        rank = quantile * count
+        cumulative, lower = 0.0, 0.0
+        for bound in bounds:
+            in_bucket = buckets.get(str(bound), 0.0)
+            if cumulative + in_bucket >= rank and in_bucket:
+                if bound == "+Inf":
+                    # Unbounded bucket, the best estimate is its lower edge
+                    estimate = lower
+                else:
+                    estimate = lower + (bound - lower) * (rank - cumulative) / in_bucket
+                break
+            cumulative += in_bucket
+            if bound != "+Inf":
+                lower = bound
+        else:
+            estimate = lower
+        results[f"p{int(quantile * 100)}"] = estimate
+    return results
+
+
+def peak_rss_kib() -> dict:
+    """Peak resident set size of this process and its (rq work horse) children"""
+    return {
+        "manager": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "workers": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+def redis_memory(redis_conn) -> dict:
+    """
+    used_memory and used_memory_peak from INFO, None where the server
+    doesn't report them (e.g. lightweight or test servers without INFO)
+    """
+    try:
+        info = redis_conn.info("memory")
+    except redis.RedisError:
+        info = {}
+    return {field: info.get(field) for field in ("used_memory", "used_memory_peak")}
+
+
+def count_pages(db_path: str) -> dict:
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT CAST(status AS TEXT), COUNT(*) FROM url_html GROUP BY 1"
+        ).fetchall()
+        links = conn.execute("SELECT COUNT(*) FROM links").fetchone()[0]
+    finally:
+        conn.close()
+    return {"by_status": dict(rows), "total": sum(n for _, n in rows), "links": links}
+
+
+def run_benchmark(
+    scenario: str,
+    site_config: SiteConfig,
+    max_pages: int,
+    num_workers: int,
+    fused: bool = False,
+    host: str = "localhost",
+    port: int = 7777,
+) -> dict:
+    """Crawl a freshly served synthetic site end to end and measure the run"""
+    site = SyntheticSite(site_config)
+    server = site.serve()
+    site_host, site_port = server.server_address[:2]
+    seed_url = f"http://{site_host}:{site_port}/"
+
+    manager = Manager(
+        seed_url=seed_url,
+        max_pages=max_pages,
+        num_workers=num_workers,
+        host=host,
+        port=port,
+        fused=fused,
+    )
+    redis_before = redis_memory(manager.redis_conn)
+    start = time.perf_counter()
+    try:
+        crawl(manager)
+    finally:
+        elapsed = time.perf_counter() - start
+        server.shutdown()
+
+    db_path = os.path.join(manager.data_dir, "sqlite.db")
+    pages = count_pages(db_path)
+    redis_after = redis_memory(manager.redis_conn)
+    latency = histogram_quantiles(
+        manager.redis_conn,
+        manager.metrics,
+        'stage_seconds|stage="download"',
+    )
+    return {
+        "scenario": scenario,
+        "site": asdict(site_config),
+        "max_pages": max_pages,
+        "num_workers": num_workers,
+        "fused": fused,
+        "run_id": manager.run_id,
+        "elapsed_seconds": elapsed,
+        "pages": pages,
+        "site_requests": site.request_count,
+        "pages_per_second": pages["total"] / elapsed if elapsed else 0.0,
+        "page_latency_seconds": latency,
+        "redis_memory_bytes": {
+            "used_before": redis_before["used_memory"],
+            "used_after": redis_after["used_memory"],
+            "peak": redis_after["used_memory_peak"],
+        },
+        "peak_rss_kib": peak_rss_kib(),
+        "sqlite_bytes": os.path.getsize(db_path),
+    }
+
+
+def save_result(result: dict, out_dir: str = RESULTS_DIR) -> str:
+    commit, dirty = git_revision()
+    result = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        **result,
+    }
+    os.makedirs(out_dir, exist_ok=True)
+    suffix = "-dirty" if dirty else ""
+    mode = "-fused" if result.get("fused") else ""
+    path = os.path.join(out_dir, f"{commit}{suffix}-{result['scenario']}{mode}.json")
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    return path
+
+
+def _mib(value: float | None) -> float | None:
+    return value / 2**20 if value is not None else None
+
+
+SUMMARY_FIELDS = [
+    ("pages/sec", lambda r: r["pages_per_second"]),
+    ("p50 latency (s)", lambda r: r["page_latency_seconds"]["p50"]),
+    ("p99 latency (s)", lambda r: r["page_latency_seconds"]["p99"]),
+    ("redis peak (MiB)", lambda r: _mib(r["redis_memory_bytes"]["peak"])),
+    ("manager rss (MiB)", lambda r: r["peak_rss_kib"]["manager"] / 1024),
+    ("worker rss (MiB)", lambda r: r["peak_rss_kib"]["workers"] / 1024),
+    ("sqlite (MiB)", lambda r: r["sqlite_bytes"] / 2**20),
+]
+
+
+def compare(paths: list[str]):
+    """Print the summary fields of several result files side by side"""
+    results = []
+    for path in paths:
+        with open(path) as f:
+            results.append(json.load(f))
+    header = f"{'':20}" + "".join(
+        f"{r['commit'] + ('*' if r['dirty'] else ''):>14}" for r in results
+    )
+    print(header)
+    for label, getter in SUMMARY_FIELDS:
+        values = [getter(r) for r in results]
+        cells = "".join(
+            f"{'-':>14}" if value is None else f"{value:14.3f}" for value in values
+        )
+        print(f"{label:20}{cells}")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Benchmark a crawl of a synthetic local site"
+    )
+    arg_parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="small")
+    arg_parser.add_argument("--max-pages", type=int, default=None)
+    arg_parser.add_argument("--num-workers", type=int, default=1)
+    arg_parser.add_argument("--redis-port", type=int, default=7777)
+    arg_parser.add_argument("--fused", action="store_true", help="Crawl in fused mode")
+    arg_parser.add_argument(
+        "--compare", nargs="+", metavar="RESULT", help="Compare saved result files"
+    )
+    args = arg_parser.parse_args()
+    if args.compare:
+        compare(args.compare)
+        sys.exit(0)
+
+    site_config = SCENARIOS[args.scenario]
+    result = run_benchmark(
+        args.scenario,
+        site_config,
+        max_pages=args.max_pages or site_config.pages,
+        num_workers=args.num_workers,
+        fused=args.fused,
+        port=args.redis_port,
+    )
+    path = save_result(result)
+    print(json.dumps(result, indent=2))
+    print(f"Saved results to {path}")
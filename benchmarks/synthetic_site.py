@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import argparse
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SITEMAP_NS = "http://www.sitemaps.org/schemas/sitemap/0.9"
+
+
+@dataclass
+class SiteConfig:
+    """Shape of the generated site. The same config always yields the same site"""
+
+    pages: int = 1000
+    fanout: int = 10
+    page_size: int = 20_000
+    latency: float = 0.0
+    error_rate: float = 0.0
+    seed: int = 0
+    sitemap: bool = True
+    urls_per_sitemap: int = 500
+    disallow: list[str] = field(default_factory=list)
+
+
+class SyntheticSite:
+    """
+    Deterministically generated website. Page i always links to page i+1
+    (so every page is reachable from the home page) plus fanout-1 pages
+    chosen with a per-page seeded RNG, and fails with a 500 if its seeded
+    draw falls under error_rate.
+    """
+
+    def __init__(self, config: SiteConfig):
+        self.config = config
+        self.request_count = 0
+        self._lock = threading.Lock()
+
+    def page_path(self, page: int) -> str:
+        return "/" if page == 0 else f"/page/{page}"
+
+    def links(self, page: int) -> list[int]:
+        rng = random.Random(self.config.seed * 1_000_003 + page)
+        count = min(self.config.fanout - 1, self.config.pages - 1)
+        targets = rng.sample(range(self.config.pages), count) if count > 0 else []
+        return [(page + 1) % self.config.pages, *targets]
+
+    def is_error(self, page: int) -> bool:
+        rng = random.Random(self.config.seed * 7_919 + page)
+        return rng.random() < self.config.error_rate
+
+    def render_page(self, page: int) -> bytes:
+        anchors = "".join(
+            f'<li><a href="{self.page_path(target)}">Page {target}</a></li>'
+            for target in self.links(page)
+        )
+        head = (
+            f"<html><head><title>Page {page}</title></head><body>"
+            f"<h1>Page {page}</h1><ul>{anchors}</ul><p>"
+        )
+        tail = "</p></body></html>"
+        rng = random.Random(self.config.seed + page)
+        words = ["lorem", "ipsum", "dolor", "sit", "amet", "crawler", "bench"]
+        filler = []
+        size = len(head) + len(tail)
+        while size < self.config.page_size:
+            word = rng.choice(words)
+            filler.append(word)
+            size += len(word) + 1
+        return (head + " ".join(filler) + tail).encode("utf-8")
+
+    def render_robots(self, base_url: str) -> bytes:
+        lines = ["User-agent: *"]
+        lines += [f"Disallow: {path}" for path in self.config.disallow]
+        if self.config.sitemap:
+            lines.append(f"Sitemap: {base_url}/sitemap.xml")
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    def render_sitemap_index(self, base_url: str) -> bytes:
+        chunks = range(0, self.config.pages, self.config.urls_per_sitemap)
+        sitemaps = "".join(
+            f"<sitemap><loc>{base_url}/sitemaps/{i}.xml</loc></sitemap>"
+            for i in range(len(chunks))
+        )
+        return (
+            f'<?xml version="1.0" encoding="UTF-8"?>'
+            f'<sitemapindex xmlns="{SITEMAP_NS}">{sitemaps}</sitemapindex>'
+        ).encode("utf-8")
+
+    def render_sitemap(self, base_url: str, chunk: int) -> bytes | None:
+        start = chunk * self.config.urls_per_sitemap
+        if start >= self.config.pages:
+            return None
+        stop = min(start + self.config.urls_per_sitemap, self.config.pages)
+        urls = "".join(
+            f"<url><loc>{base_url}{self.page_path(page)}</loc>"
+            f"<changefreq>daily</changefreq></url>"
+            for page in range(start, stop)
+        )
+        return (
+            f'<?xml version="1.0" encoding="UTF-8"?>'
+            f'<urlset xmlns="{SITEMAP_NS}">{urls}</urlset>'
+        ).encode("utf-8")
+
+    def route(self, path: str, base_url: str) -> tuple[int, str, bytes]:
+        """Returns (status, content type, body) for a request path"""
+        path = path.split("?")[0]
+        if path == "/robots.txt":
+            return 200, "text/plain", self.render_robots(base_url)
+        if path == "/sitemap.xml" and self.config.sitemap:
+            return 200, "application/xml", self.render_sitemap_index(base_url)
+        if path.startswith("/sitemaps/") and self.config.sitemap:
+            chunk = path[len("/sitemaps/") : -len(".xml")]
+            body = None
+            if chunk.isdigit():
+                body = self.render_sitemap(base_url, int(chunk))
+            if body is not None:
+                return 200, "application/xml", body
+        if path == "/":
+            page = 0
+        elif path.startswith("/page/") and path[len("/page/") :].isdigit():
+            page = int(path[len("/page/") :])
+        else:
+            page = None
+        if page is None or page >= self.config.pages:
+            return 404, "text/html", b"<html><body>Not found</body></html>"
+        if self.is_error(page):
+            return 500, "text/html", b"<html><body>Server error</body></html>"
+        return 200, "text/html; charset=utf-8", self.render_page(page)
+
+    def serve(self, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+        """Start serving the site from a daemon thread, returns the server"""
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with site._lock:
+                    site.request_count += 1
+                if site.config.latency:
+                    time.sleep(site.config.latency)
+                host, port = self.server.server_address[:2]
+                status, content_type, body = site.route(
+                    self.path, f"http://{host}:{port}"
+                )
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_HEAD(self):
+                host, port = self.server.server_address[:2]
+                status, content_type, body = site.route(
+                    self.path, f"http://{host}:{port}"
+                )
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Serve a synthetic site")
+    arg_parser.add_argument("--port", type=int, default=8000)
+    arg_parser.add_argument("--pages", type=int, default=1000)
+    arg_parser.add_argument("--fanout", type=int, default=10)
+    arg_parser.add_argument("--page-size", type=int, default=20_000)
+    arg_parser.add_argument("--latency", type=float, default=0.0)
+    arg_parser.add_argument("--error-rate", type=float, default=0.0)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--no-sitemap", action="store_true")
+    args = arg_parser.parse_args()
+    site = SyntheticSite(
+        SiteConfig(
+            pages=args.pages,
+            fanout=args.fanout,
+            page_size=args.page_size,
+            latency=args.latency,
+            error_rate=args.error_rate,
+            seed=args.seed,
+            sitemap=not args.no_sitemap,
+        )
+    )
+    server = site.serve(port=args.port)
+    print(f"Serving synthetic site on http://127.0.0.1:{args.port}/")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
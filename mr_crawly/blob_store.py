@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import hashlib
+import mmap
+import os
+import tempfile
+
+from config.configuration import get_logger
+
+logger = get_logger(__name__)
+
+
+class BlobStore:
+    """
+    Content-addressed store for page bodies.
+    Bodies are written once to <root>/<hash[:2]>/<hash[2:4]>/<hash>, so
+    identical pages (across urls and across runs) share a single file.
+    Reads are served through mmap, so callers can parse a body without
+    copying it into the python heap.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def hash_content(content: bytes) -> str:
+        return hashlib.sha256(content).hexdigest()
+
+    def path_for(self, content_hash: str) -> str:
+        return os.path.join(
+            self.root, content_hash[:2], content_hash[2:4], content_hash
+        )
+
+    def exists(self, content_hash: str) -> bool:
+        return os.path.exists(self.path_for(content_hash))
+
+    def put(self, content: bytes | str) -> str:
+        """Store content if it is not already present, returning its hash"""
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        content_hash = self.hash_content(content)
+        path = self.path_for(content_hash)
+        if os.path.exists(path):
+            logger.debug(f"Blob {content_hash} already stored")
+            return content_hash
+        shard_dir = os.path.dirname(path)
+        os.makedirs(shard_dir, exist_ok=True)
+        # Write to a temp file then rename, so concurrent writers of the
+        # same body never expose a partially written blob
+        fd, tmp_path = tempfile.mkstemp(dir=shard_dir, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return content_hash
+
+    def open(self, content_hash: str) -> mmap.mmap | bytes:
+        """
+        Returns a read-only mmap of the blob. Callers should close it
+        (or use it as a context manager) once finished.
+        """
+        path = self.path_for(content_hash)
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # Empty files can't be mapped
+                return b""
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get(self, content_hash: str) -> bytes | None:
+        """Returns a copy of the blob contents"""
+        if content_hash is None or not self.exists(content_hash):
+            return None
+        blob = self.open(content_hash)
+        if isinstance(blob, bytes):
+            return blob
+        with blob:
+            return blob[:]
@@ -1,15 +1,18 @@
 from __future__ import annotations
 
 import time
+from collections import defaultdict
 from dataclasses import dataclass
 from enum import Enum
-from typing import Any
+from urllib.parse import urlparse
 
 import redis
 import rq
 from config.configuration import get_logger  # noqa
 from rq import Queue
+from rq.job import Job
 from rq.registry import StartedJobRegistry
+from serializer import MsgpackSerializer
 
 logger = get_logger(__name__)
 
@@ -47,6 +50,12 @@ class SitemapDetails(Enum):
     STATUS = "status"
 
 
+# Names of the pipeline stages that update_status progresses a url through
+PIPELINE_STAGES = ("map_site", "download", "parse", "db", "error")
+# Separates the seed from the url in frontier entries
+FRONTIER_SEP = "\x1f"
+
+
 @dataclass
 class URLData:
     """`Data` structure for URL metadata"""
@@ -69,11 +78,6 @@ class URLData:
     # is_sitemap_index: bool | None = None
     # kwargs: Dict[str, Any] = field(default_factory=dict, init=False, repr=False, compare=False)
 
-    def __init__(self, a: int, b: str, **kwargs: Any):
-        self.a = a
-        self.b = b
-        self.kwargs = kwargs
-
 
 class URLCache:
     """Redis-based cache for URL data"""
@@ -99,16 +103,17 @@ class URLCache:
         self.rdb.hset(url, "content", content)
         self.rdb.hset(url, "status", status)
 
-    def get_cached_response(self, url: str) -> URLData | None:
-        """Retrieve URL data from cache"""
-        content, status = None, None
-        bcontent = self.rdb.hget(url, "content")
-        bstatus = self.rdb.hget(url, "status")
-        if bcontent:
-            content = bcontent.decode("utf-8")
-        if bstatus:
-            status = bstatus.decode("utf-8")
-        return content, status
+    def get_cached_response(self, url: str) -> tuple[str | None, ...]:
+        """
+        Retrieve a url's cached (content, status, duplicate_of), the last
+        set if the page was found to be a near duplicate of another
+        """
+        fields = self.rdb.hmget(url, ["content", "status", "duplicate_of"])
+        return tuple(value.decode("utf-8") if value else None for value in fields)
+
+    def mark_duplicate(self, url: str, canonical_url: str, status) -> None:
+        """Record a near duplicate page in place of its content"""
+        self.rdb.hset(url, mapping={"duplicate_of": canonical_url, "status": status})
 
     def close_url(self, url: str) -> None:
         """Close a URL"""
@@ -134,14 +139,14 @@ class URLCache:
             results[key] = value
             # results["status"] = CrawlStatus(results["status"])
         # ensures attrs match URLData, thus the db can store it
-        result = URLData(**results)
+        result = URLData(url=url, **results)
         return result
 
     def update_status(self, url: str, status: str) -> None:
         """
         Progresses the status of the URL through the crawl pipeline
         """
-        if status not in CrawlStatus.__members__:
+        if status not in PIPELINE_STAGES:
             raise ValueError(f"Invalid status: {status}")
         if status == "map_site":
             self.rdb.hset(url, "status", CrawlStatus.FRONTIER.value)
@@ -162,6 +167,192 @@ class URLCache:
         """Request a download for a URL"""
         self.rdb.publish(f"{seed_url}:download_needed", url)
 
+    def mark_seen(self, run_id: str, urls) -> None:
+        """Record urls as already handled in this run, so they aren't queued"""
+        urls = list(urls)
+        if urls:
+            self.rdb.sadd(f"{run_id}:seen", *urls)
+
+    def push_frontier(
+        self, run_id: str, seed_url: str, urls: list[str], url_filter=None
+    ) -> int:
+        """
+        Queue the urls not yet seen in this run on their host's frontier
+        list, tagged with the seed they were found under. url_filter is
+        given the new urls and returns whether to queue each of them.
+        Returns the number of urls queued.
+        """
+        urls = list(urls)
+        if not urls:
+            return 0
+        pipe = self.rdb.pipeline(transaction=False)
+        for url in urls:
+            pipe.sadd(f"{run_id}:seen", url)
+        new_urls = [url for url, is_new in zip(urls, pipe.execute()) if is_new]
+        if url_filter is not None and new_urls:
+            new_urls = [url for url, ok in zip(new_urls, url_filter(new_urls)) if ok]
+        return self._push_entries(run_id, [(seed_url, url) for url in new_urls])
+
+    def _push_entries(self, run_id: str, pairs: list[tuple[str, str]]) -> int:
+        """Append (seed_url, url) pairs to their hosts' frontier lists"""
+        by_host = defaultdict(list)
+        for seed_url, url in pairs:
+            by_host[urlparse(url).netloc].append(f"{seed_url}{FRONTIER_SEP}{url}")
+        if not by_host:
+            return 0
+        pipe = self.rdb.pipeline(transaction=False)
+        for host, entries in by_host.items():
+            pipe.rpush(f"{run_id}:frontier:{host}", *entries)
+        pipe.sadd(f"{run_id}:frontier_hosts", *by_host)
+        pipe.execute()
+        return sum(len(entries) for entries in by_host.values())
+
+    def save_pending(
+        self, run_id: str, pages: list[tuple[str, str]], seeds: list[str]
+    ) -> None:
+        """
+        Record the (seed_url, url) pages and the seeds' site maps that the
+        run's jobs have yet to finish. rq keeps jobs under its own keys,
+        so this is how a snapshot of the run's keys carries them.
+        """
+        pipe = self.rdb.pipeline()
+        pipe.delete(f"{run_id}:pending", f"{run_id}:pending_maps")
+        if pages:
+            entries = [f"{seed_url}{FRONTIER_SEP}{url}" for seed_url, url in pages]
+            pipe.rpush(f"{run_id}:pending", *entries)
+        if seeds:
+            pipe.rpush(f"{run_id}:pending_maps", *seeds)
+        pipe.execute()
+
+    def clear_pending(self, run_id: str) -> None:
+        self.rdb.delete(f"{run_id}:pending", f"{run_id}:pending_maps")
+
+    def requeue_pending(self, run_id: str) -> int:
+        """
+        Put what save_pending recorded back on the frontier, once a
+        snapshot is restored without the jobs. The pages are already seen
+        and counted against their seeds' budgets when they were enqueued,
+        so their claims are refunded for drain_frontier to make again.
+        Seeds whose site map was unfinished are crawled from the seed page.
+        Returns the number of urls queued.
+        """
+        pipe = self.rdb.pipeline()
+        pipe.lrange(f"{run_id}:pending", 0, -1)
+        pipe.lrange(f"{run_id}:pending_maps", 0, -1)
+        pipe.delete(f"{run_id}:pending", f"{run_id}:pending_maps")
+        entries, seeds, _ = pipe.execute()
+        pages = [
+            tuple(entry.decode("utf-8").split(FRONTIER_SEP, 1)) for entry in entries
+        ]
+        queued = self._push_entries(run_id, pages)
+        if pages:
+            pipe = self.rdb.pipeline(transaction=False)
+            for seed_url, _ in pages:
+                pipe.hincrby(f"{run_id}:seed_enqueued", seed_url, -1)
+            pipe.execute()
+        for seed_url in seeds:
+            seed_url = seed_url.decode("utf-8")
+            queued += self.push_frontier(run_id, seed_url, [seed_url])
+        return queued
+
+    def pop_frontier(self, run_id: str, count: int = 1000) -> list[tuple[str, str]]:
+        """
+        Take about count (seed_url, url) pairs off the frontier, one per
+        host in turn, so consecutive jobs on the shared queues are spread
+        across hosts rather than hitting one host back to back.
+        """
+        hosts = sorted(self.rdb.smembers(f"{run_id}:frontier_hosts"))
+        popped = []
+        while hosts and len(popped) < count:
+            pipe = self.rdb.pipeline(transaction=False)
+            for host in hosts:
+                pipe.lpop(f"{run_id}:frontier:{host.decode('utf-8')}")
+            entries = pipe.execute()
+            hosts = [host for host, entry in zip(hosts, entries) if entry is not None]
+            for entry in entries:
+                if entry is not None:
+                    seed_url, _, url = entry.decode("utf-8").partition(FRONTIER_SEP)
+                    popped.append((seed_url, url))
+        return popped
+
+    def url_ids(self, run_id: str, urls: list[str]) -> list[int]:
+        """
+        Returns each url's id in the run's registry, registering urls seen
+        for the first time, so that jobs can carry ids instead of urls.
+        """
+        key = f"{run_id}:url_ids"
+        urls = list(urls)
+        if not urls:
+            return []
+        ids = dict(zip(urls, self.rdb.hmget(key, urls)))
+        missing = [url for url, url_id in ids.items() if url_id is None]
+        if missing:
+            # Reserve a block of ids; HSETNX keeps whichever id was given
+            # first if another process registers the same url concurrently
+            last = self.rdb.incrby(f"{run_id}:url_seq", len(missing))
+            new_ids = range(last - len(missing) + 1, last + 1)
+            pipe = self.rdb.pipeline(transaction=False)
+            for url, url_id in zip(missing, new_ids):
+                pipe.hsetnx(key, url, url_id)
+            created = pipe.execute()
+            pipe = self.rdb.pipeline(transaction=False)
+            for url, url_id, is_new in zip(missing, new_ids, created):
+                if is_new:
+                    pipe.hset(f"{run_id}:urls", url_id, url)
+                    ids[url] = url_id
+            pipe.execute()
+            lost = [url for url, is_new in zip(missing, created) if not is_new]
+            if lost:
+                ids.update(zip(lost, self.rdb.hmget(key, lost)))
+        return [int(ids[url]) for url in urls]
+
+    def urls_for_ids(self, run_id: str, url_ids: list[int]) -> list[str | None]:
+        """Look urls up by the ids url_ids gave them"""
+        urls = self.rdb.hmget(f"{run_id}:urls", list(url_ids))
+        return [url.decode("utf-8") if url is not None else None for url in urls]
+
+    def save_run_settings(self, run_id: str, settings: dict) -> None:
+        """Record the options a run was started with, for its jobs' callbacks"""
+        self.rdb.set(f"{run_id}:settings", MsgpackSerializer.dumps(settings))
+
+    def get_run_settings(self, run_id: str) -> dict:
+        settings = self.rdb.get(f"{run_id}:settings")
+        return MsgpackSerializer.loads(settings) if settings is not None else {}
+
+    def set_seed_budgets(self, run_id: str, budgets: dict[str, int | None]) -> None:
+        """Record the max pages for each seed of a run (None for no limit)"""
+        limited = {seed: budget for seed, budget in budgets.items() if budget}
+        if limited:
+            self.rdb.hset(f"{run_id}:seed_budgets", mapping=limited)
+
+    def claim_budget(self, run_id: str, pairs: list[tuple[str, str]]) -> list[bool]:
+        """
+        Count each (seed_url, url) against its seed's page budget.
+        Returns whether each url is still within budget.
+        """
+        if not pairs:
+            return []
+        seeds = sorted({seed_url for seed_url, _ in pairs})
+        pipe = self.rdb.pipeline(transaction=False)
+        for seed_url, _ in pairs:
+            pipe.hincrby(f"{run_id}:seed_enqueued", seed_url, 1)
+        pipe.hmget(f"{run_id}:seed_budgets", seeds)
+        *claimed, budgets = pipe.execute()
+        budgets = dict(zip(seeds, budgets))
+        return [
+            budgets[seed_url] is None or count <= int(budgets[seed_url])
+            for (seed_url, _), count in zip(pairs, claimed)
+        ]
+
+    def count_page(self, run_id: str, seed_url: str) -> int:
+        """Count a downloaded page against its seed, returns the seed's total"""
+        return self.rdb.hincrby(f"{run_id}:seed_pages", seed_url, 1)
+
+    def seed_pages(self, run_id: str) -> dict[str, int]:
+        """The pages downloaded so far in a run, per seed"""
+        counts = self.rdb.hgetall(f"{run_id}:seed_pages")
+        return {seed.decode("utf-8"): int(count) for seed, count in counts.items()}
+
     def add_frontier_seed(self, url: str, seed: str) -> None:
         """Add a frontier seed for a URL"""
         self.rdb.sadd(f"{url}:fseeds", seed)
@@ -189,13 +380,25 @@ class QueueManager:
     def _init_queues(self, is_async: bool = True):
         logger.info("Initializing Queues")
         # Create different work queues for different tasks
+        # Jobs carry msgpack encoded ids rather than pickled arguments
         self.site_map_queue = Queue(
-            connection=self.rdb, is_async=is_async, name="site_map"
+            connection=self.rdb,
+            is_async=is_async,
+            name="site_map",
+            serializer=MsgpackSerializer,
         )
         self.frontier_queue = Queue(
-            connection=self.rdb, is_async=is_async, name="frontier"
+            connection=self.rdb,
+            is_async=is_async,
+            name="frontier",
+            serializer=MsgpackSerializer,
+        )
+        self.parse_queue = Queue(
+            connection=self.rdb,
+            is_async=is_async,
+            name="parse",
+            serializer=MsgpackSerializer,
         )
-        self.parse_queue = Queue(connection=self.rdb, is_async=is_async, name="parse")
         self.queues.append(self.frontier_queue)
         self.queues.append(self.site_map_queue)
         self.queues.append(self.parse_queue)
@@ -233,12 +436,52 @@ class QueueManager:
             for job in queue.jobs:
                 job.cancel()
 
+    def pending_jobs(self, run_id: str) -> list[Job]:
+        """
+        The run's jobs that have yet to finish: queued, scheduled for a
+        retry, waiting on another job or running.
+        """
+        job_ids = []
+        for queue in self.queues:
+            job_ids.extend(queue.get_job_ids())
+            for registry in (
+                queue.scheduled_job_registry,
+                queue.deferred_job_registry,
+                queue.started_job_registry,
+            ):
+                job_ids.extend(registry.get_job_ids())
+        jobs = Job.fetch_many(
+            dict.fromkeys(job_ids), connection=self.rdb, serializer=MsgpackSerializer
+        )
+        return [
+            job for job in jobs if job is not None and job.meta.get("run_id") == run_id
+        ]
+
     def get_running_count(self):
         running = 0
         for registry in self.registries:
             running += registry.get_job_count()
         return running
 
+    def collect_metrics(self, metrics) -> None:
+        """Publish the depth of each queue, and its registries, as gauges"""
+        for queue in self.queues:
+            metrics.set_gauge(
+                "queue_depth", queue.count, queue=queue.name, state="queued"
+            )
+            metrics.set_gauge(
+                "queue_depth",
+                queue.started_job_registry.count,
+                queue=queue.name,
+                state="started",
+            )
+            metrics.set_gauge(
+                "queue_depth",
+                queue.failed_job_registry.count,
+                queue=queue.name,
+                state="failed",
+            )
+
     def get_redis_conn(self):
         """Get the Redis connection"""
         return self.rdb
@@ -0,0 +1,402 @@
+from __future__ import annotations
+
+import json
+import os
+
+import jobs
+import redis
+from blob_store import BlobStore
+from cache import QueueManager, URLCache, URLData
+from config.configuration import get_logger
+from metrics import get_metrics
+from near_duplicates import get_near_duplicate_index
+from retry_policy import RetryPolicy, push_dead_letter
+from site_mapper import map_site
+from traps import get_trap_detector
+from utils import DATA_DIR, get_run_dir
+
+from data import LinksTable, UrlTable
+
+logger = get_logger(__name__)
+
+
+class RunContext:
+    """
+    Everything a run's jobs and callbacks need, rebuilt from redis by
+    run_id. rq imports callbacks by name and calls them in the work horse,
+    so they can't be bound to the Manager, and jobs need to carry no more
+    than the run_id and url ids.
+    """
+
+    def __init__(self, run_id: str, redis_conn: redis.Redis):
+        self.run_id = run_id
+        self.redis_conn = redis_conn
+        self.pid = os.getpid()
+        self.cache = URLCache(redis_conn)
+        settings = self.cache.get_run_settings(run_id)
+        self.fused = settings.get("fused", False)
+        self.incremental = settings.get("incremental", False)
+        # Read by profiling.profile_job from each job's meta
+        self.profile_options = settings.get("profile")
+        self.retry_policy = RetryPolicy.from_config(
+            default_retries=settings.get("retries")
+        )
+        self.is_async = settings.get("is_async", True)
+        self.qmanager = QueueManager(redis_conn, self.is_async)
+        self.metrics = get_metrics(redis_conn, run_id)
+        self.data_dir = get_run_dir(run_id)
+        self.traps = get_trap_detector(redis_conn, run_id, self.metrics)
+        self.near_duplicates = get_near_duplicate_index(
+            redis_conn, run_id, self.metrics
+        )
+        self._url_db = None
+        self._links_db = None
+
+    # Opened on first use, most callbacks only write to one of them
+    @property
+    def url_db(self) -> UrlTable:
+        if self._url_db is None:
+            blob_store = BlobStore(os.path.join(DATA_DIR, "blobs"))
+            self._url_db = UrlTable(self.data_dir + "/sqlite.db", blob_store)
+        return self._url_db
+
+    @property
+    def links_db(self) -> LinksTable:
+        if self._links_db is None:
+            self._links_db = LinksTable(self.data_dir + "/sqlite.db")
+        return self._links_db
+
+    def enqueue(
+        self,
+        args,
+        req_queue,
+        function,
+        on_success_callback=None,
+        on_failure_callback=None,
+        depends_on=None,
+        result_ttl=None,
+    ):
+        """Add a job to the specified queue, with the
+        optionally specified dependencies and callbacks"""
+        meta = {"run_id": self.run_id}
+        if self.profile_options is not None:
+            meta["profile"] = self.profile_options
+        # Lazily formatted, and dropped before formatting unless DEBUG is on
+        logger.debug(
+            "Enqueuing %s%s in %s",
+            function.__name__,
+            args,
+            req_queue.name,
+            extra={"run_id": self.run_id, "queue": req_queue.name},
+        )
+        with self.metrics.timer("enqueue", queue=req_queue.name):
+            job = req_queue.enqueue(
+                function,
+                args=args,
+                on_success=on_success_callback,
+                on_failure=on_failure_callback,
+                depends_on=depends_on,
+                meta=meta,
+                result_ttl=result_ttl,
+            )
+        return job
+
+    def enqueue_pages(self, pairs: list[tuple[str, str]]) -> list:
+        """
+        Enqueue the download (and parse) of each (seed_url, url) pair,
+        registering the urls' ids in one round trip for the whole batch.
+        """
+        urls = list(dict.fromkeys(url for pair in pairs for url in pair))
+        ids = dict(zip(urls, self.cache.url_ids(self.run_id, urls)))
+        return [
+            self._enqueue_page(ids[seed_url], ids[url], url) for seed_url, url in pairs
+        ]
+
+    def _enqueue_page(self, seed_id: int, url_id: int, url: str):
+        """
+        This represents the crawling of a single page.
+        1. Download the content, if possible, cache to redis
+        2. Extract urls from the page, return them
+        3. Enqueue the urls for parsing
+        Callbacks get results in-process and store them, so no page job
+        needs rq to keep its result around in redis (synchronous runs
+        read the result back from redis for the callback, so keep it).
+        """
+        logger.debug(
+            "Enqueuing download for %s",
+            url,
+            extra={"run_id": self.run_id, "url": url},
+        )
+        args = (self.run_id, seed_id, url_id)
+        result_ttl = 0 if self.is_async else None
+        if self.fused:
+            fused_task = self.enqueue(
+                args,
+                self.qmanager.frontier_queue,
+                jobs.fused,
+                on_success_callback=on_fused_success,
+                on_failure_callback=on_download_failure,
+                result_ttl=result_ttl,
+            )
+            return fused_task, None
+        download_task = self.enqueue(
+            args,
+            self.qmanager.frontier_queue,
+            jobs.download,
+            on_success_callback=on_download_success,
+            on_failure_callback=on_download_failure,
+            result_ttl=result_ttl,
+        )
+        parse_task = self.enqueue(
+            args,
+            self.qmanager.parse_queue,
+            jobs.parse,
+            depends_on=download_task.id,
+            on_success_callback=on_parse_success,
+            on_failure_callback=on_parse_failure,
+            result_ttl=result_ttl,
+        )
+        return download_task, parse_task
+
+    def process_url(self, seed_url: str):
+        """Queues the map_site job for the given seed"""
+        return self.enqueue(
+            (seed_url, self.run_id, self.incremental),
+            self.qmanager.site_map_queue,
+            map_site,
+            on_success_callback=on_map_success,
+            on_failure_callback=on_map_failure,
+        )
+
+    def drain_frontier(self, batch_size: int = 1000):
+        """
+        Enqueue the urls waiting on the frontier, alternating between hosts,
+        skipping any whose seed has already used up its page budget.
+        """
+        pairs = self.cache.pop_frontier(self.run_id, batch_size)
+        while pairs:
+            within_budget = self.cache.claim_budget(self.run_id, pairs)
+            allowed = [pair for pair, ok in zip(pairs, within_budget) if ok]
+            if len(allowed) < len(pairs):
+                self.metrics.inc("over_budget_total", len(pairs) - len(allowed))
+            self.enqueue_pages(allowed)
+            pairs = self.cache.pop_frontier(self.run_id, batch_size)
+
+    def crawl_from_seed(self, seed_url: str):
+        """Fall back to following links from the seed page itself"""
+        logger.info("Utilizing fallback to seed_url links")
+        self.cache.push_frontier(self.run_id, seed_url, [seed_url])
+        self.drain_frontier()
+
+    def save_pending(self):
+        """Record the run's unfinished jobs for a snapshot, see URLCache"""
+        pages, seeds = set(), set()
+        for job in self.qmanager.pending_jobs(self.run_id):
+            seed_url, url = self.job_urls(job)
+            if job.func_name.endswith("map_site"):
+                seeds.add(seed_url)
+            elif url is not None:
+                pages.add((seed_url, url))
+        self.cache.save_pending(self.run_id, sorted(pages), sorted(seeds))
+
+    def push_links(self, seed_url: str, links) -> int:
+        """
+        Queue links found on a page. Unlike sitemap entries, which the
+        site chose to publish, these are checked for crawler traps.
+        """
+        url_filter = self.traps.filter if self.traps is not None else None
+        return self.cache.push_frontier(
+            self.run_id, seed_url, links, url_filter=url_filter
+        )
+
+    def job_urls(self, job) -> tuple[str, str]:
+        """The (seed_url, url) a job was enqueued for"""
+        if job.func_name.endswith("map_site"):
+            return job.args[0], job.args[0]
+        _, seed_id, url_id = job.args
+        seed_url, url = self.cache.urls_for_ids(self.run_id, [seed_id, url_id])
+        return seed_url, url
+
+    def log_fields(self, job, url, stage) -> dict:
+        """Structured fields attached to per-job log records"""
+        fields = {"run_id": self.run_id, "url": url, "stage": stage, "job_id": job.id}
+        if job.started_at is not None and job.ended_at is not None:
+            fields["duration"] = (job.ended_at - job.started_at).total_seconds()
+        return fields
+
+    def on_success(self, job, stage) -> tuple[str, str]:
+        """Progress the url of a job that succeeded, returns (seed_url, url)"""
+        seed_url, url = self.job_urls(job)
+        logger.info(
+            "%s job %s succeeded",
+            stage,
+            job.id,
+            extra=self.log_fields(job, url, stage),
+        )
+        self.cache.update_status(url, stage)
+        return seed_url, url
+
+    def on_failure(self, job, value, stage):
+        """
+        Handle a failed job. The retry policy decides whether rq
+        reschedules the job; once it gives up the job is dead-lettered.
+        Returns (url, decision).
+        """
+        seed_url, url = self.job_urls(job)
+        decision = self.retry_policy.apply(job, value, stage=stage)
+        failure_class = decision.failure_class.value
+        self.metrics.inc("job_failures_total", stage=stage, reason=failure_class)
+        if decision.delay is not None:
+            logger.info(
+                "%s job %s failed (%s), retrying in %.0fs",
+                stage,
+                job.id,
+                failure_class,
+                decision.delay,
+                extra=self.log_fields(job, url, stage),
+            )
+            return url, decision
+        logger.info(
+            "%s job %s failed (%s) after %d attempts, giving up",
+            stage,
+            job.id,
+            failure_class,
+            decision.attempt + 1,
+            extra=self.log_fields(job, url, stage),
+        )
+        push_dead_letter(self.redis_conn, self.run_id, url, stage, decision, value)
+        if stage != "map_site":
+            url_data = self.cache.update_status(url, "error")
+            if url_data:
+                self.url_db.store_url(url_data, self.run_id, seed_url=seed_url)
+        return url, decision
+
+
+_contexts: dict[str, RunContext] = {}
+
+
+def get_context(run_id: str, redis_conn: redis.Redis) -> RunContext:
+    """
+    Returns the process's context for the run. Work horses are forked from
+    the process that started the workers, so a context (and its sqlite
+    connections) inherited across a fork is rebuilt rather than reused.
+    """
+    context = _contexts.get(run_id)
+    if context is None or context.pid != os.getpid():
+        context = _contexts[run_id] = RunContext(run_id, redis_conn)
+    return context
+
+
+def _job_context(job, connection) -> RunContext:
+    return get_context(job.meta["run_id"], connection)
+
+
+# Map site specific on end functions
+def on_map_success(job, connection, result):
+    """Callback for when a site mapping job succeeds"""
+    context = _job_context(job, connection)
+    seed_url, _ = context.on_success(job, "map_site")
+    # Entries were streamed to sqlite and the frontier list while mapping
+    root_sitemap_urls, sitemap_indicies, entry_count, queued_count = result
+    logger.info(
+        f"Sitemaps {root_sitemap_urls} listed {entry_count} urls, {queued_count} queued"
+    )
+    with open(f"{context.data_dir}/sitemap_indexes.json", "w") as f:
+        json.dump(sitemap_indicies, f, default=str, indent=4)
+    if queued_count == 0:
+        # No sitemaps, empty ones, or none of their entries in scope
+        context.crawl_from_seed(seed_url)
+        return
+    context.drain_frontier()
+
+
+def on_map_failure(job, connection, type, value, traceback):
+    """Callback for when a site mapping job fails"""
+    context = _job_context(job, connection)
+    url, decision = context.on_failure(job, value, "map_site")
+    if decision.delay is not None:
+        return
+    context.crawl_from_seed(url)
+
+
+# Download specific on end functions
+def on_download_success(job, connection, result):
+    """
+    When a download success, progress the urls status,
+        and enqueue the page for parsing.
+    """
+    context = _job_context(job, connection)
+    seed_url, url = context.on_success(job, "download")
+    content, status = result
+    duplicate = None
+    if context.near_duplicates is not None and str(status) == "200":
+        with context.metrics.timer("fingerprint"):
+            duplicate = context.near_duplicates.check(url, content)
+    with context.metrics.timer("cache_write"):
+        if duplicate is None:
+            context.cache.update_content(url, content, status)
+        else:
+            # The dependent parse job finds no body and skips the page
+            context.cache.mark_duplicate(url, duplicate[0], status)
+    with context.metrics.timer("sqlite_write", table="url_html"):
+        context.url_db.store_url(
+            URLData(url=url, content=content, status=status),
+            context.run_id,
+            seed_url=seed_url,
+        )
+        if duplicate is not None:
+            context.url_db.store_near_duplicate(url, *duplicate, context.run_id)
+    # Budgets are enforced when pages are enqueued (see drain_frontier),
+    # so the crawl winds down on its own once every seed is spent
+    context.cache.count_page(context.run_id, seed_url)
+
+
+def on_fused_success(job, connection, result):
+    """Store the page and links from a fused download and parse job"""
+    context = _job_context(job, connection)
+    seed_url, url = context.on_success(job, "download")
+    content, status, new_links, duplicate, directives = result
+    with context.metrics.timer("sqlite_write", table="url_html"):
+        context.url_db.store_url(
+            URLData(url=url, content=content, status=status),
+            context.run_id,
+            seed_url=seed_url,
+        )
+        if duplicate is not None:
+            context.url_db.store_near_duplicate(url, *duplicate, context.run_id)
+        if directives is not None:
+            context.url_db.store_directives(url, directives, context.run_id)
+    with context.metrics.timer("sqlite_write", table="links"):
+        context.links_db.store_links(seed_url, url, new_links)
+    context.cache.count_page(context.run_id, seed_url)
+    context.push_links(seed_url, new_links)
+    context.drain_frontier()
+
+
+def on_download_failure(job, connection, type, value, traceback):
+    """Callback for when a download job fails"""
+    _job_context(job, connection).on_failure(job, value, "download")
+
+
+# Parse specific on end functions
+def on_parse_success(job, connection, result):
+    """Callback for when a parse job succeeds"""
+    context = _job_context(job, connection)
+    seed_url, current_url, new_links, directives = result
+    logger.info(
+        "Parse job %s succeeded",
+        job.id,
+        extra=context.log_fields(job, current_url, "parse"),
+    )
+    if directives is not None:
+        with context.metrics.timer("sqlite_write", table="page_directives"):
+            context.url_db.store_directives(current_url, directives, context.run_id)
+    with context.metrics.timer("sqlite_write", table="links"):
+        context.links_db.store_links(seed_url, current_url, new_links)
+    context.push_links(seed_url, new_links)
+    context.drain_frontier()
+
+
+def on_parse_failure(job, connection, type, value, traceback):
+    """Callback for when a parse job fails"""
+    _job_context(job, connection).on_failure(job, value, "parse")
@@ -1,7 +1,9 @@
 from __future__ import annotations
 
+import copy
 import logging
 import logging.config
+import logging.handlers
 import os
 import sys
 
@@ -19,10 +21,20 @@ config_file = os.environ.get("MRCRAWLYCONFIG", f"{loc}/config/config.toml")
 log_config = os.environ.get("MRCRAWLY_LOG_CONFIG", f"{loc}/config/logging_config.yml")
 
 
+_log_configured = False
+# config.toml as parsed on first use, so jobs don't re-read it for every page
+_config = None
+
+
 def _load_console_log():
+    # Configuring starts the queue listener thread, so only do it once
+    global _log_configured
+    if _log_configured:
+        return
     with open(log_config) as f:
         config = yaml.safe_load(f.read())
     logging.config.dictConfig(config)
+    _log_configured = True
 
 
 def get_logger(logger_name: str, log_file: str = None, log_level: int = logging.INFO):
@@ -39,7 +51,8 @@ def get_logger(logger_name: str, log_file: str = None, log_level: int = logging.
         isinstance(handler, logging.FileHandler) for handler in logger.handlers
     )
     has_console_handler = any(
-        isinstance(handler, logging.StreamHandler) for handler in logger.handlers
+        isinstance(handler, (logging.StreamHandler, logging.handlers.QueueHandler))
+        for handler in logger.handlers
     )
     if not has_console_handler:
         _load_console_log()
@@ -68,12 +81,16 @@ def get_logger(logger_name: str, log_file: str = None, log_level: int = logging.
 def get_config(**kwargs):
     """
     Returns the config values set in the yaml file as a dict.
+    The file is only read once per process; each call gets its own copy.
     If kwargs are provided these will be added to the config dict,
         overwriting any existing values with the same key.
     """
+    global _config
     try:
-        with open(config_file) as f:
-            config = toml.load(f)
+        if _config is None:
+            with open(config_file) as f:
+                _config = toml.load(f)
+        config = copy.deepcopy(_config)
         for key, value in kwargs.items():
             if key in config:
                 config[key] = value
@@ -1,6 +1,13 @@
 from __future__ import annotations
 
+import atexit
+import json
 import logging
+import multiprocessing
+import os
+import random
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing.queues import SimpleQueue
 from typing import ClassVar
 
 from rich.console import Console
@@ -50,3 +57,114 @@ class ConsoleHandler(logging.StreamHandler):
             self.console.print(message, soft_wrap=True)
         except Exception as e:
             print(f"Error in console handler: {e}")
+
+
+# Attributes set with `extra=` that are promoted to top-level json keys
+STRUCTURED_FIELDS = ("run_id", "url", "stage", "duration", "queue", "job_id")
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as single json lines, for shipping or jq"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "message": record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class JsonFileHandler(logging.FileHandler):
+    """FileHandler that resolves relative paths against the repo root"""
+
+    def __init__(self, filename: str, mode: str = "a", encoding: str = "utf-8"):
+        if not os.path.isabs(filename):
+            root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+            filename = os.path.join(root, filename)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        super().__init__(filename, mode=mode, encoding=encoding, delay=True)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a random fraction of the records at or below `level` from high
+    volume loggers. Rates are keyed by logger name, and apply to child
+    loggers. Sampling is random rather than 1-in-N so that it holds across
+    the short-lived processes rq forks for each job.
+    """
+
+    def __init__(self, rates: dict[str, float] = None, level: int | str = "INFO"):
+        super().__init__()
+        self.rates = dict(rates or {})
+        self.level = level if isinstance(level, int) else logging.getLevelName(level)
+
+    def _rate(self, name: str) -> float:
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition(".")[0]
+        return 1.0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.level:
+            return True
+        rate = self._rate(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class PipeQueue(SimpleQueue):
+    """
+    A queue backed by a pipe. Puts are written straight to the pipe, so
+    records survive forked rq work horses exiting with os._exit.
+    """
+
+    def __init__(self):
+        super().__init__(ctx=multiprocessing.get_context())
+
+    def get(self, block: bool = True):
+        # QueueListener only ever does blocking gets
+        return super().get()
+
+    def put_nowait(self, obj):
+        self.put(obj)
+
+
+class QueueListenerHandler(QueueHandler):
+    """
+    Hands records to a listener thread that runs the wrapped handlers, so
+    formatting, rich rendering and file I/O happen off the logging thread.
+    Processes forked from this one (rq work horses) share the queue and
+    are served by this process's listener.
+    """
+
+    def __init__(self, handlers: list[logging.Handler], respect_handler_level=True):
+        super().__init__(PipeQueue())
+        # dictConfig passes a ConvertingList, which only resolves the
+        # cfg://handlers.<name> references on item access, not on iteration
+        handlers = [handlers[i] for i in range(len(handlers))]
+        self.owner_pid = os.getpid()
+        self.listener = QueueListener(
+            self.queue, *handlers, respect_handler_level=respect_handler_level
+        )
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Flush and stop the listener, only from the process that owns it"""
+        if os.getpid() == self.owner_pid and self.listener._thread is not None:
+            self.listener.stop()
+
+    def close(self):
+        self.stop()
+        super().close()
@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import time
+from collections import defaultdict, deque
+
+import redis
+from rich.console import Group
+from rich.live import Live
+from rich.table import Table
+from rq import Worker
+
+# Rates are averaged over this many seconds of samples
+RATE_WINDOW = 30
+# Statuses recorded by SiteDownloader that are not failures
+OK_STATUSES = {"robots_denied"}
+
+
+def is_error(status: str) -> bool:
+    if status in OK_STATUSES:
+        return False
+    return not (status.isdigit() and int(status) < 400)
+
+
+class Dashboard:
+    """
+    Live terminal view of a crawl. Everything shown is read from the run's
+    page counts and metrics counters, the rq registries and redis INFO, so
+    a refresh costs a handful of redis round trips regardless of crawl size.
+    """
+
+    def __init__(self, manager, refresh_interval: float = 2.0):
+        self.manager = manager
+        self.refresh_interval = refresh_interval
+        self.samples = deque()
+        self.started = time.time()
+
+    def _totals(self) -> dict:
+        """The run's pages per seed, and its downloader counters per host"""
+        manager = self.manager
+        seed_pages = manager.cache.seed_pages(manager.run_id)
+        totals = {
+            "done": sum(seed_pages.values()),
+            "seed_pages": seed_pages,
+            "pages": 0.0,
+            "bytes": 0.0,
+            "hosts": defaultdict(lambda: {"pages": 0.0, "errors": 0.0, "bytes": 0.0}),
+        }
+        for name, labels, value in self.manager.metrics.read_counters():
+            if name == "pages_total":
+                host = totals["hosts"][labels.get("host", "")]
+                totals["pages"] += value
+                host["pages"] += value
+                if is_error(labels.get("status", "")):
+                    host["errors"] += value
+            elif name == "bytes_downloaded_total":
+                host = totals["hosts"][labels.get("host", "")]
+                totals["bytes"] += value
+                host["bytes"] += value
+        return totals
+
+    def _rate(self, now: float, totals: dict, key, host: str = None) -> float:
+        """Per second rate of a counter over the sample window"""
+        then, old = self.samples[0]
+        if now <= then:
+            return 0.0
+        if host is None:
+            return (totals[key] - old[key]) / (now - then)
+        previous = old["hosts"].get(host, {}).get(key, 0.0)
+        return (totals["hosts"][host][key] - previous) / (now - then)
+
+    def _summary(self, now: float, totals: dict) -> Table:
+        pages_rate = self._rate(now, totals, "done")
+        bytes_rate = self._rate(now, totals, "bytes")
+        try:
+            memory = self.manager.redis_conn.info("memory")
+        except redis.RedisError:
+            # Some redis compatible servers don't implement INFO
+            memory = {}
+        budgets = self.manager.seeds
+        max_pages = None if None in budgets.values() else sum(budgets.values())
+        eta = "-"
+        if max_pages and pages_rate > 0:
+            seed_pages = totals["seed_pages"]
+            remaining = sum(
+                max(budget - seed_pages.get(seed, 0), 0)
+                for seed, budget in budgets.items()
+            )
+            eta = time.strftime("%H:%M:%S", time.gmtime(remaining / pages_rate))
+
+        seeds = self.manager.seeds
+        target = next(iter(seeds)) if len(seeds) == 1 else f"{len(seeds)} seeds"
+        table = Table(title=f"Run {self.manager.run_id}  {target}")
+        for column in [
+            "elapsed",
+            "pages",
+            "pages/s",
+            "KiB/s",
+            "redis memory",
+            "eta to max pages",
+        ]:
+            table.add_column(column, justify="right")
+        table.add_row(
+            time.strftime("%H:%M:%S", time.gmtime(now - self.started)),
+            f"{totals['done']}" + (f" / {max_pages}" if max_pages else ""),
+            f"{pages_rate:.1f}",
+            f"{bytes_rate / 1024:.1f}",
+            memory.get("used_memory_human", "-"),
+            eta,
+        )
+        return table
+
+    def _queues(self) -> Table:
+        workers = Worker.all(self.manager.redis_conn)
+        busy, idle = defaultdict(int), defaultdict(int)
+        for worker in workers:
+            counts = busy if worker.get_state() == "busy" else idle
+            for queue_name in worker.queue_names():
+                counts[queue_name] += 1
+
+        table = Table(title="Queues")
+        for column in ["queue", "queued", "started", "failed", "busy", "idle"]:
+            table.add_column(column, justify="right")
+        for queue in self.manager.qmanager.queues:
+            table.add_row(
+                queue.name,
+                str(queue.count),
+                str(queue.started_job_registry.count),
+                str(queue.failed_job_registry.count),
+                str(busy[queue.name]),
+                str(idle[queue.name]),
+            )
+        return table
+
+    def _hosts(self, now: float, totals: dict, limit: int = 10) -> Table:
+        table = Table(title=f"Top {limit} hosts")
+        for column in ["host", "pages", "pages/s", "errors", "KiB"]:
+            table.add_column(column, justify="right")
+        hosts = sorted(
+            totals["hosts"].items(), key=lambda item: item[1]["pages"], reverse=True
+        )
+        for host, counts in hosts[:limit]:
+            table.add_row(
+                host,
+                f"{counts['pages']:.0f}",
+                f"{self._rate(now, totals, 'pages', host):.1f}",
+                f"{counts['errors']:.0f}",
+                f"{counts['bytes'] / 1024:.0f}",
+            )
+        return table
+
+    def render(self) -> Group:
+        now = time.time()
+        totals = self._totals()
+        self.samples.append((now, totals))
+        while len(self.samples) > 1 and self.samples[0][0] < now - RATE_WINDOW:
+            self.samples.popleft()
+        renderables = [self._summary(now, totals), self._queues()]
+        if self.manager.metrics.enabled:
+            renderables.append(self._hosts(now, totals))
+        else:
+            renderables.append("Metrics are disabled in config.toml, so no rates")
+        return Group(*renderables)
+
+    def live(self) -> Live:
+        """A rich Live display that re-renders from its own refresh thread"""
+        return Live(
+            get_renderable=self.render,
+            refresh_per_second=1 / self.refresh_interval,
+            screen=False,
+        )
@@ -3,6 +3,7 @@ from __future__ import annotations
 import sqlite3
 from dataclasses import dataclass
 
+from blob_store import BlobStore
 from cache import URLData
 from config.configuration import get_logger
 
@@ -49,62 +50,197 @@ class RunTable:
         self.connection.commit()
         return self.cursor.lastrowid
 
+    def seed_runs(self) -> dict[str, int]:
+        """The latest run record of each seed, for a resumed run to complete"""
+        self.cursor.execute("SELECT seed_url, MAX(run_id) FROM runs GROUP BY seed_url")
+        return dict(self.cursor.fetchall())
+
     def complete_run(self, run_id, status="completed"):
         """Mark a run as completed and set end time"""
         self.cursor.execute(
             """UPDATE runs SET
                             end_time = datetime('now')
                             WHERE run_id = ?;""",
-            (run_id),
+            (run_id,),
         )
         self.connection.commit()
 
 
 class UrlTable:
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, blob_store: BlobStore | None = None):
         """Initialize URL/HTML storage"""
         self.db_path = db_path
         self.conn = sqlite3.connect(db_path)
+        self.blob_store = blob_store
         self.create_tables()
 
     def create_tables(self):
         """Create URL/HTML storage tables if they don't exist"""
+        # Bodies live in the blob store; only their hash is kept here
         self.conn.execute(
             """
             CREATE TABLE IF NOT EXISTS url_html (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 url TEXT NOT NULL,
-                content BLOB,
+                content_hash TEXT,
                 status INTEGER,
                 run_id INTEGER,
+                seed_url TEXT,
                 links TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 UNIQUE(url, run_id)
             )
         """
         )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_url_html_hash ON url_html (content_hash)"
+        )
+        # Jobs the retry policy gave up on (see retry_policy.py)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS dead_letters (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL,
+                run_id INTEGER,
+                stage TEXT,
+                failure_class TEXT,
+                attempts INTEGER,
+                status INTEGER,
+                error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(url, run_id, stage)
+            )
+        """
+        )
+        # Pages whose text was within a few bits (SimHash) of an earlier
+        # page's, see near_duplicates.py. Their links are not followed
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS near_duplicates (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL,
+                run_id INTEGER,
+                canonical_url TEXT NOT NULL,
+                distance INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(url, run_id)
+            )
+        """
+        )
+        self.conn.execute(
+            """CREATE INDEX IF NOT EXISTS idx_near_duplicates_canonical
+               ON near_duplicates (canonical_url)"""
+        )
+        # Canonical links and meta robots of the pages that set them, see
+        # parser.extract_page. Pages canonical to another are not expanded
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS page_directives (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL,
+                run_id INTEGER,
+                canonical_url TEXT,
+                noindex BOOLEAN DEFAULT 0,
+                nofollow BOOLEAN DEFAULT 0,
+                nofollow_links INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(url, run_id)
+            )
+        """
+        )
+        self.conn.execute(
+            """CREATE INDEX IF NOT EXISTS idx_page_directives_canonical
+               ON page_directives (canonical_url)"""
+        )
         self.conn.commit()
 
-    def store_url(self, url_data: URLData, run_id: int):
-        """Store URL and its HTML content"""
+    def store_url(self, url_data: URLData, run_id: int, seed_url: str = None):
+        """Store URL and a reference to its HTML content"""
         url = url_data.url
         content = url_data.content
         status = url_data.status
+        content_hash = None
+        if content is not None and self.blob_store is not None:
+            content_hash = self.blob_store.put(content)
         try:
             self.conn.execute(
-                "INSERT INTO url_html (url, content, status, run_id) VALUES (?, ?, ?)",
-                (url, content, status, run_id),
+                """INSERT INTO url_html (url, content_hash, status, run_id, seed_url)
+                   VALUES (?, ?, ?, ?, ?)""",
+                (url, content_hash, status, run_id, seed_url),
             )
             self.conn.commit()
         except sqlite3.IntegrityError:
             # Update if URL already exists for this run
             self.conn.execute(
-                "UPDATE url_html SET html = ? WHERE url = ? AND run_id = ?",
-                (content, url, run_id),
+                """UPDATE url_html SET content_hash = COALESCE(?, content_hash),
+                   status = ? WHERE url = ? AND run_id = ?""",
+                (content_hash, status, url, run_id),
             )
             self.conn.commit()
         return True
 
+    def store_dead_letters(self, entries: list[dict], run_id: int):
+        """Record jobs that exhausted their retries, keeping the latest error"""
+        self.conn.executemany(
+            """
+            INSERT INTO dead_letters
+                (url, run_id, stage, failure_class, attempts, status, error)
+            VALUES (:url, :run_id, :stage, :failure_class, :attempts, :status, :error)
+            ON CONFLICT(url, run_id, stage) DO UPDATE SET
+                failure_class = excluded.failure_class,
+                attempts = excluded.attempts,
+                status = excluded.status,
+                error = excluded.error
+            """,
+            [{**entry, "run_id": run_id} for entry in entries],
+        )
+        self.conn.commit()
+
+    def store_near_duplicate(
+        self, url: str, canonical_url: str, distance: int, run_id: int
+    ):
+        """Add a page to the cluster of its canonical page"""
+        self.conn.execute(
+            """INSERT OR REPLACE INTO near_duplicates
+               (url, run_id, canonical_url, distance) VALUES (?, ?, ?, ?)""",
+            (url, run_id, canonical_url, distance),
+        )
+        self.conn.commit()
+
+    def store_directives(self, url: str, directives: dict, run_id: int):
+        """Record a page's canonical url and robots directives"""
+        self.conn.execute(
+            """INSERT OR REPLACE INTO page_directives
+               (url, run_id, canonical_url, noindex, nofollow, nofollow_links)
+               VALUES (?, ?, ?, ?, ?, ?)""",
+            (
+                url,
+                run_id,
+                directives.get("canonical_url"),
+                directives.get("noindex", False),
+                directives.get("nofollow", False),
+                directives.get("nofollow_links", 0),
+            ),
+        )
+        self.conn.commit()
+
+    def get_content_hash(self, url: str, run_id: int) -> str | None:
+        row = self.conn.execute(
+            "SELECT content_hash FROM url_html WHERE url = ? AND run_id = ?",
+            (url, run_id),
+        ).fetchone()
+        return row[0] if row else None
+
+    def get_content(self, url: str, run_id: int):
+        """
+        Returns the stored body for the url as a read-only mmap
+        (or None), so it can be parsed without copying.
+        """
+        content_hash = self.get_content_hash(url, run_id)
+        if content_hash is None or self.blob_store is None:
+            return None
+        return self.blob_store.open(content_hash)
+
 
 class LinksTable:
     def __init__(self, db_path: str):
@@ -114,10 +250,10 @@ class LinksTable:
         self.create_tables()
 
     def create_tables(self):
-        """Create URL/HTML storage tables if they don't exist"""
+        """Create the link edge table if it doesn't exist"""
         self.conn.execute(
             """
-            CREATE TABLE IF NOT EXISTS url_html (
+            CREATE TABLE IF NOT EXISTS links (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 seed_url TEXT NOT NULL,
                 source_url TEXT NOT NULL,
@@ -127,6 +263,9 @@ class LinksTable:
             )
         """
         )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_links_source ON links (source_url)"
+        )
         self.conn.commit()
 
     def store_links(self, seed_url: str, source_url: str, linked_urls: list[str]):
@@ -138,7 +277,7 @@ class LinksTable:
             ]
 
             self.conn.executemany(
-                """INSERT INTO url_html (seed_url, source_url, linked_url)
+                """INSERT OR IGNORE INTO links (seed_url, source_url, linked_url)
                    VALUES (?, ?, ?)""",
                 links_data,
             )
@@ -169,10 +308,13 @@ class SitemapTable:
                 modified TEXT,
                 status TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(source_url, index_url)
+                UNIQUE(source_url, loc)
             )
         """
         )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_sitemap_loc ON sitemap_data (loc)"
+        )
         self.conn.commit()
 
     def store_sitemap_data(self, sitemap_details: dict):
@@ -200,17 +342,48 @@ class SitemapTable:
             self.conn.execute(
                 """
                 UPDATE sitemap_data
-                SET loc = ?, priority = ?, frequency = ?, modified = ?, status = ?
-                WHERE source_url = ? AND index_url = ?
+                SET index_url = ?, priority = ?, frequency = ?, modified = ?,
+                    status = ?
+                WHERE source_url = ? AND loc = ?
                 """,
                 (
-                    sitemap_details["loc"],
+                    sitemap_details["index"],
                     sitemap_details["priority"],
                     sitemap_details["frequency"],
                     sitemap_details["modified"],
                     sitemap_details["status"],
                     sitemap_details["source_url"],
-                    sitemap_details["index"],
+                    sitemap_details["loc"],
                 ),
             )
             self.conn.commit()
+
+    def store_sitemap_batch(self, batch: list[dict]):
+        """Store many sitemap entries in a single transaction"""
+        rows = [
+            (
+                details["source_url"],
+                details["index"],
+                details["loc"],
+                details["priority"],
+                details["frequency"],
+                details["modified"],
+                details["status"],
+            )
+            for details in batch
+        ]
+        with self.conn:
+            self.conn.executemany(
+                """
+                INSERT INTO sitemap_data
+                (source_url, index_url, loc, priority, frequency, modified, status)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(source_url, loc) DO UPDATE SET
+                    index_url = excluded.index_url,
+                    priority = excluded.priority,
+                    frequency = excluded.frequency,
+                    modified = excluded.modified,
+                    status = excluded.status
+                """,
+                rows,
+            )
@@ -0,0 +1,289 @@
+from __future__ import annotations
+
+import ipaddress
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import redis
+from config.configuration import get_config, get_logger
+from metrics import METRIC_PREFIX, Metrics
+from serializer import MsgpackSerializer
+from urllib3.util.connection import allowed_gai_family
+
+logger = get_logger(__name__)
+
+# Kept before install() replaces it, the default resolver calls this
+_system_getaddrinfo = socket.getaddrinfo
+_installed = None
+_install_lock = threading.Lock()
+
+
+def system_resolver(host: str, family: int, type: int, proto: int, flags: int):
+    """
+    Resolve with the system resolver. getaddrinfo doesn't report record
+    TTLs, so entries it returns are kept for the cache's default ttl.
+    """
+    return _system_getaddrinfo(host, None, family, type, proto, flags), None
+
+
+def _is_ip(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host.split("%", 1)[0])
+    except ValueError:
+        return False
+    return True
+
+
+def _with_port(addrinfos: list, port: int) -> list:
+    """Substitute the requested port into addresses resolved without one"""
+    return [
+        (family, type, proto, canonname, (sockaddr[0], port, *sockaddr[2:]))
+        for family, type, proto, canonname, sockaddr in addrinfos
+    ]
+
+
+class DnsCache:
+    """
+    Caches getaddrinfo answers per hostname, for the record's TTL when
+    the resolver reports one (capped at max_ttl) and otherwise for ttl.
+    Failed lookups are cached for negative_ttl and raise the same
+    gaierror until then. Answers are resolved without a port, so one
+    entry serves every port on the host.
+
+    rq runs each job in a freshly forked work horse, so with a redis
+    connection the answers are also shared through redis, where every
+    worker (and prefetch, from the manager) finds them.
+
+    resolver is called as resolver(host, family, type, proto, flags)
+    and returns (addrinfos, ttl or None), so a stub can stand in for DNS.
+    """
+
+    def __init__(
+        self,
+        resolver=system_resolver,
+        ttl: float = 300,
+        max_ttl: float = 3600,
+        negative_ttl: float = 30,
+        max_entries: int = 10_000,
+        redis_conn: redis.Redis = None,
+        metrics: Metrics = None,
+        prefetch_workers: int = 4,
+    ):
+        self.resolver = resolver
+        self.ttl = ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.rdb = redis_conn
+        self.metrics = metrics
+        self.prefetch_workers = prefetch_workers
+        # key -> (expires_at, addrinfos, or the gaierror to raise)
+        self.entries = {}
+        self.lock = threading.Lock()
+        self._executor = None
+        self._prefetching = set()
+        # Set while a lookup is talking to redis, whose own connection
+        # resolves its host through getaddrinfo too
+        self._in_lookup = threading.local()
+
+    def _redis_key(self, key: tuple) -> str:
+        return f"{METRIC_PREFIX}:dns:" + "|".join(str(part) for part in key)
+
+    def _inc(self, result: str):
+        if self.metrics is not None:
+            self.metrics.inc("dns_lookups_total", result=result)
+
+    def _get_local(self, key: tuple):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry[1]
+
+    def _set_local(self, key: tuple, value, ttl: float):
+        with self.lock:
+            if len(self.entries) >= self.max_entries:
+                now = time.time()
+                for stale in [k for k, e in self.entries.items() if e[0] <= now]:
+                    del self.entries[stale]
+                # Still full, drop the oldest entries
+                while len(self.entries) >= self.max_entries:
+                    del self.entries[next(iter(self.entries))]
+            self.entries[key] = (time.time() + ttl, value)
+
+    def _get_shared(self, key: tuple):
+        """Returns (value, remaining ttl) from redis, or None"""
+        if self.rdb is None:
+            return None
+        try:
+            pipe = self.rdb.pipeline(transaction=False)
+            pipe.get(self._redis_key(key))
+            pipe.pttl(self._redis_key(key))
+            data, pttl = pipe.execute()
+        except redis.RedisError as e:
+            logger.debug(f"Shared dns cache unavailable: {e}")
+            return None
+        if data is None or pttl <= 0:
+            return None
+        entry = MsgpackSerializer.loads(data)
+        if "error" in entry:
+            value = socket.gaierror(*entry["error"])
+        else:
+            value = [
+                (
+                    socket.AddressFamily(family),
+                    socket.SocketKind(type),
+                    proto,
+                    canonname,
+                    tuple(sockaddr),
+                )
+                for family, type, proto, canonname, sockaddr in entry["addrs"]
+            ]
+        return value, pttl / 1000
+
+    def _set_shared(self, key: tuple, value, ttl: float):
+        if self.rdb is None:
+            return
+        if isinstance(value, socket.gaierror):
+            entry = {"error": list(value.args)}
+        else:
+            entry = {"addrs": [list(addrinfo) for addrinfo in value]}
+        try:
+            self.rdb.set(
+                self._redis_key(key),
+                MsgpackSerializer.dumps(entry),
+                px=max(int(ttl * 1000), 1),
+            )
+        except redis.RedisError as e:
+            logger.debug(f"Shared dns cache unavailable: {e}")
+
+    def lookup(self, host: str, family=0, type=0, proto=0, flags=0) -> list:
+        """
+        The host's addrinfos without a port, from the cache if fresh.
+        Raises socket.gaierror for hosts that failed to resolve.
+        """
+        key = (host.lower(), int(family), int(type), proto, flags)
+        value = self._get_local(key)
+        if value is None:
+            self._in_lookup.active = True
+            try:
+                shared = self._get_shared(key)
+                if shared is not None:
+                    value, ttl = shared
+                    self._inc("shared")
+                else:
+                    value, ttl = self._resolve(key)
+                    self._set_shared(key, value, ttl)
+            finally:
+                self._in_lookup.active = False
+            self._set_local(key, value, ttl)
+        if isinstance(value, socket.gaierror):
+            raise socket.gaierror(*value.args)
+        return value
+
+    def _resolve(self, key: tuple):
+        host, family, type, proto, flags = key
+        try:
+            addrinfos, ttl = self.resolver(host, family, type, proto, flags)
+        except socket.gaierror as e:
+            self._inc("failed")
+            logger.debug(f"Could not resolve {host}: {e}")
+            return e, self.negative_ttl
+        self._inc("resolved")
+        ttl = self.ttl if ttl is None else min(ttl, self.max_ttl)
+        return list(addrinfos), ttl
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        """A drop in replacement for socket.getaddrinfo"""
+        if isinstance(host, bytes):
+            host = host.decode("idna")
+        if isinstance(port, str) and port.isdigit():
+            port = int(port)
+        # Nothing to cache for addresses, and named services are left
+        # to the system to map to a port
+        uncacheable = (
+            getattr(self._in_lookup, "active", False)
+            or not host
+            or _is_ip(host)
+            or flags & socket.AI_NUMERICHOST
+            or (port is not None and not isinstance(port, int))
+        )
+        if uncacheable:
+            return _system_getaddrinfo(host, port, family, type, proto, flags)
+        addrinfos = self.lookup(host, family, type, proto, flags)
+        return _with_port(addrinfos, port or 0)
+
+    def prefetch(self, hosts):
+        """
+        Resolve hosts in the background, as the downloader will, so the
+        answers are cached (and shared) before their pages are fetched.
+        hosts may be hostnames or netlocs.
+        """
+        for host in hosts:
+            if isinstance(host, bytes):
+                host = host.decode("utf-8")
+            host = urlsplit(f"//{host}").hostname
+            if not host or _is_ip(host):
+                continue
+            key = (host, int(allowed_gai_family()), int(socket.SOCK_STREAM), 0, 0)
+            with self.lock:
+                if key in self._prefetching:
+                    continue
+                self._prefetching.add(key)
+            if self._get_local(key) is not None:
+                with self.lock:
+                    self._prefetching.discard(key)
+                continue
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.prefetch_workers, thread_name_prefix="dns"
+                )
+            self._executor.submit(self._prefetch, key)
+
+    def _prefetch(self, key: tuple):
+        try:
+            self.lookup(*key)
+        except socket.gaierror:
+            pass
+        finally:
+            with self.lock:
+                self._prefetching.discard(key)
+
+
+def install(cache: DnsCache):
+    """Route every socket.getaddrinfo call in the process through cache"""
+    global _installed
+    socket.getaddrinfo = cache.getaddrinfo
+    _installed = cache
+
+
+def uninstall():
+    global _installed
+    socket.getaddrinfo = _system_getaddrinfo
+    _installed = None
+
+
+def install_dns_cache(
+    redis_conn: redis.Redis = None, metrics: Metrics = None
+) -> DnsCache | None:
+    """
+    Install the process wide DnsCache configured in config.toml, once.
+    Returns it, or None if it is disabled.
+    """
+    dns_config = dict(get_config().get("dns", {}))
+    if not dns_config.pop("enabled", True):
+        return None
+    with _install_lock:
+        if _installed is None:
+            share = dns_config.pop("share", True)
+            install(
+                DnsCache(
+                    redis_conn=redis_conn if share else None,
+                    metrics=metrics,
+                    **dns_config,
+                )
+            )
+    return _installed
@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+import os
+import sqlite3
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from blob_store import BlobStore
+from config.configuration import get_logger
+from utils import DATA_DIR, get_run_dir
+
+logger = get_logger(__name__)
+
+# Column types for each exported table, in select order
+TABLE_SCHEMAS = {
+    "runs": pa.schema(
+        [
+            ("run_id", pa.int64()),
+            ("seed_url", pa.string()),
+            ("start_time", pa.string()),
+            ("max_pages", pa.int64()),
+            ("end_time", pa.string()),
+        ]
+    ),
+    "url_html": pa.schema(
+        [
+            ("id", pa.int64()),
+            ("url", pa.string()),
+            ("content_hash", pa.string()),
+            ("status", pa.string()),
+            ("run_id", pa.string()),
+            ("seed_url", pa.string()),
+            ("created_at", pa.string()),
+        ]
+    ),
+    "links": pa.schema(
+        [
+            ("id", pa.int64()),
+            ("seed_url", pa.string()),
+            ("source_url", pa.string()),
+            ("linked_url", pa.string()),
+            ("created_at", pa.string()),
+        ]
+    ),
+    "sitemap_data": pa.schema(
+        [
+            ("id", pa.int64()),
+            ("source_url", pa.string()),
+            ("index_url", pa.string()),
+            ("loc", pa.string()),
+            ("priority", pa.float64()),
+            ("frequency", pa.string()),
+            ("modified", pa.string()),
+            ("status", pa.string()),
+            ("created_at", pa.string()),
+        ]
+    ),
+}
+
+# Status, run_id and seed_url are loosely typed in url_html, so normalize
+# them to text
+SELECT_OVERRIDES = {
+    "url_html": (
+        "id, url, content_hash, CAST(status AS TEXT), CAST(run_id AS TEXT),"
+        " CAST(seed_url AS TEXT), created_at"
+    ),
+}
+
+
+class RunExporter:
+    """
+    Streams a run's sqlite tables into Parquet, one record batch at a time.
+    Output is hive-partitioned as <out_dir>/<table>/run=<run_id>/part-N.parquet
+    so a directory of runs can be scanned as a single dataset. Batches with
+    page bodies are also cut at max_batch_bytes of bodies, so memory stays
+    bounded however large the pages are.
+    """
+
+    def __init__(
+        self,
+        run_id: str,
+        out_dir: str,
+        batch_size: int = 10_000,
+        rows_per_file: int = 1_000_000,
+        include_bodies: bool = False,
+        compression: str = "zstd",
+        max_batch_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.run_id = run_id
+        self.out_dir = out_dir
+        self.batch_size = batch_size
+        self.rows_per_file = rows_per_file
+        self.include_bodies = include_bodies
+        self.compression = compression
+        self.max_batch_bytes = max_batch_bytes
+        db_path = os.path.join(get_run_dir(run_id), "sqlite.db")
+        if not os.path.exists(db_path):
+            raise FileNotFoundError(f"No sqlite.db found for run {run_id}")
+        self.conn = sqlite3.connect(db_path)
+        self.blob_store = BlobStore(os.path.join(DATA_DIR, "blobs"))
+
+    def _table_exists(self, table: str) -> bool:
+        row = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone()
+        return row is not None
+
+    def _schema(self, table: str) -> pa.Schema:
+        schema = TABLE_SCHEMAS[table]
+        if table == "url_html" and self.include_bodies:
+            schema = schema.append(pa.field("content", pa.binary()))
+        return schema
+
+    def _batches(self, table: str, schema: pa.Schema):
+        """
+        Yield record batches of at most batch_size rows, and with bodies,
+        of about max_batch_bytes of bodies
+        """
+        columns = TABLE_SCHEMAS[table].names
+        select = SELECT_OVERRIDES.get(table, ", ".join(columns))
+        cursor = self.conn.execute(f"SELECT {select} FROM {table} ORDER BY rowid")
+        while True:
+            rows = cursor.fetchmany(self.batch_size)
+            if not rows:
+                break
+            if "content" in schema.names:
+                yield from self._body_batches(columns, rows, schema)
+            else:
+                yield self._batch(columns, rows, schema)
+
+    def _body_batches(self, columns: list[str], rows: list[tuple], schema):
+        """Split rows into batches as their bodies are read"""
+        hash_index = columns.index("content_hash")
+        batch_rows, bodies, size = [], [], 0
+        for row in rows:
+            body = self.blob_store.get(row[hash_index])
+            batch_rows.append(row)
+            bodies.append(body)
+            size += len(body) if body is not None else 0
+            if size >= self.max_batch_bytes:
+                yield self._batch(columns, batch_rows, schema, bodies)
+                batch_rows, bodies, size = [], [], 0
+        if batch_rows:
+            yield self._batch(columns, batch_rows, schema, bodies)
+
+    def _batch(self, columns, rows, schema, bodies=None) -> pa.RecordBatch:
+        data = {name: list(values) for name, values in zip(columns, zip(*rows))}
+        if bodies is not None:
+            data["content"] = bodies
+        return pa.RecordBatch.from_pydict(data, schema=schema)
+
+    def export_table(self, table: str) -> int:
+        """Export a single table, returning the number of rows written"""
+        if not self._table_exists(table):
+            logger.warning(f"Run {self.run_id} has no {table} table, skipping")
+            return 0
+        schema = self._schema(table)
+        partition_dir = os.path.join(self.out_dir, table, f"run={self.run_id}")
+        os.makedirs(partition_dir, exist_ok=True)
+
+        writer, part, rows_in_file, total = None, 0, 0, 0
+        try:
+            for batch in self._batches(table, schema):
+                if writer is None or rows_in_file >= self.rows_per_file:
+                    if writer is not None:
+                        writer.close()
+                        part += 1
+                    path = os.path.join(partition_dir, f"part-{part:05d}.parquet")
+                    writer = pq.ParquetWriter(
+                        path, schema, compression=self.compression
+                    )
+                    rows_in_file = 0
+                writer.write_batch(batch)
+                rows_in_file += batch.num_rows
+                total += batch.num_rows
+        finally:
+            if writer is not None:
+                writer.close()
+        logger.info(f"Exported {total} rows from {table} to {partition_dir}")
+        return total
+
+    def export(self, tables: list[str] | None = None) -> dict[str, int]:
+        tables = tables or list(TABLE_SCHEMAS)
+        return {table: self.export_table(table) for table in tables}
+
+
+def export_run(
+    run_id: str,
+    out_dir: str | None = None,
+    include_bodies: bool = False,
+    batch_size: int = 10_000,
+    max_batch_bytes: int = 64 * 1024 * 1024,
+) -> dict[str, int]:
+    """Export a run's tables to parquet, defaulting to <run_dir>/parquet"""
+    out_dir = out_dir or os.path.join(get_run_dir(run_id), "parquet")
+    exporter = RunExporter(
+        run_id,
+        out_dir,
+        batch_size=batch_size,
+        include_bodies=include_bodies,
+        max_batch_bytes=max_batch_bytes,
+    )
+    return exporter.export()
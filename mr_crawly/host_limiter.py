@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+import redis
+from config.configuration import get_config, get_logger
+from metrics import METRIC_PREFIX, Metrics
+
+logger = get_logger(__name__)
+
+# How fast the latency baseline drifts up towards the current latency, so
+# a host that has permanently slowed down is not cut back forever
+BASELINE_DRIFT = 0.01
+
+
+class HostBusy(Exception):
+    """
+    No request slot for the host became free within acquire_timeout. The
+    retry policy requeues the job shortly, without using up its retries.
+    """
+
+    def __init__(self, host: str, limit: int):
+        super().__init__(f"{host} is at its concurrency limit of {limit}")
+        self.host = host
+        self.limit = limit
+
+
+@dataclass
+class HostLimits:
+    """AIMD parameters of the per host limiter, see [host_limits] in config.toml"""
+
+    initial_limit: float = 2
+    min_limit: float = 1
+    max_limit: float = 16
+    # Added to the limit for each limit's worth of good responses
+    increase: float = 1
+    # Multiplied into the limit on a throttled or failed response, or when
+    # latency rises above latency_tolerance times the host's baseline
+    decrease: float = 0.5
+    latency_tolerance: float = 2.0
+    # Weight of each new response in the host's smoothed latency
+    smoothing: float = 0.2
+    # Seconds to wait for a slot before giving up with HostBusy, kept short
+    # so a worker isn't held up by one host while others have work
+    acquire_timeout: float = 1
+    # Seconds before a slot held by a worker that died is reclaimed
+    slot_ttl: float = 120
+
+
+class HostLimiter:
+    """
+    Additive increase / multiplicative decrease of the requests allowed
+    in flight to each host, shared by every worker through redis. While a
+    host answers at its usual latency its limit grows by `increase` per
+    round of requests; a 429/503, a server error or timeout, or a latency
+    well above its baseline cuts the limit by `decrease`. Cuts are applied
+    at most once per smoothed latency, so the requests already in flight
+    when a host slows down only count once.
+
+    State is kept per host, not per run, as it describes the server.
+    """
+
+    def __init__(
+        self,
+        redis_conn: redis.Redis,
+        limits: HostLimits = None,
+        metrics: Metrics = None,
+    ):
+        self.rdb = redis_conn
+        self.limits = limits or HostLimits()
+        self.metrics = metrics
+
+    def _state_key(self, host: str) -> str:
+        return f"{METRIC_PREFIX}:hosts:{host}"
+
+    def _slots_key(self, host: str) -> str:
+        return f"{METRIC_PREFIX}:hosts:{host}:in_flight"
+
+    def _set_gauge(self, name: str, value: float, host: str):
+        if self.metrics is not None:
+            self.metrics.set_gauge(name, value, host=host)
+
+    def try_acquire(self, host: str) -> tuple[str | None, int]:
+        """
+        Take a slot if the host is under its limit. Returns (token, limit),
+        token being None when the host is at its limit.
+        """
+        token = uuid.uuid4().hex
+        now = time.time()
+        slots_key = self._slots_key(host)
+        pipe = self.rdb.pipeline()
+        pipe.zremrangebyscore(slots_key, "-inf", now)
+        pipe.zadd(slots_key, {token: now + self.limits.slot_ttl})
+        pipe.expire(slots_key, int(self.limits.slot_ttl) + 1)
+        pipe.zcard(slots_key)
+        pipe.hget(self._state_key(host), "limit")
+        *_, in_flight, limit = pipe.execute()
+        limit = float(limit) if limit is not None else self.limits.initial_limit
+        limit = max(int(limit), 1)
+        if in_flight > limit:
+            # Racing acquirers may all back out, they retry after a pause
+            self.rdb.zrem(slots_key, token)
+            return None, limit
+        self._set_gauge("host_in_flight", in_flight, host)
+        return token, limit
+
+    def acquire(self, host: str) -> str:
+        """Wait for a slot on the host, raising HostBusy after acquire_timeout"""
+        deadline = time.monotonic() + self.limits.acquire_timeout
+        delay = 0.05
+        while True:
+            token, limit = self.try_acquire(host)
+            if token is not None:
+                return token
+            if time.monotonic() >= deadline:
+                raise HostBusy(host, limit)
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+    def release(self, host: str, token: str):
+        self.rdb.zrem(self._slots_key(host), token)
+
+    @contextmanager
+    def slot(self, host: str):
+        """Hold one of the host's request slots for the duration of the block"""
+        token = self.acquire(host)
+        try:
+            yield
+        finally:
+            self.release(host, token)
+
+    def record(self, host: str, outcome: str, latency: float = None):
+        """
+        Feed a response back into the host's limit. outcome is "ok",
+        "throttled" (429/503) or "error" (5xx, timeout, connection error).
+        """
+        limits = self.limits
+        state_key = self._state_key(host)
+        updated = {}
+
+        def update(pipe):
+            state = {
+                key.decode("utf-8"): float(value)
+                for key, value in pipe.hgetall(state_key).items()
+            }
+            now = time.time()
+            limit = state.get("limit", limits.initial_limit)
+            smoothed = state.get("latency")
+            baseline = state.get("baseline")
+            if latency is not None:
+                if smoothed is None:
+                    smoothed = latency
+                else:
+                    smoothed += limits.smoothing * (latency - smoothed)
+                if baseline is None or smoothed < baseline:
+                    baseline = smoothed
+                else:
+                    baseline += BASELINE_DRIFT * (smoothed - baseline)
+            slow = (
+                outcome == "ok"
+                and smoothed is not None
+                and smoothed > baseline * limits.latency_tolerance
+            )
+            if outcome != "ok" or slow:
+                cooldown = smoothed or 1.0
+                if now - state.get("cut_at", 0) >= cooldown:
+                    limit = max(limit * limits.decrease, limits.min_limit)
+                    state["cut_at"] = now
+            else:
+                limit = min(limit + limits.increase / limit, limits.max_limit)
+            fields = {"limit": limit, "cut_at": state.get("cut_at", 0)}
+            if smoothed is not None:
+                fields.update(latency=smoothed, baseline=baseline)
+            pipe.multi()
+            pipe.hset(state_key, mapping=fields)
+            pipe.hincrby(state_key, outcome, 1)
+            updated.update(fields)
+
+        # Retried if another worker updates the host in between
+        self.rdb.transaction(update, state_key)
+        self._set_gauge("host_concurrency_limit", updated["limit"], host)
+        if "latency" in updated:
+            self._set_gauge("host_latency_seconds", updated["latency"], host)
+        if outcome != "ok":
+            logger.debug(
+                "%s response from %s, limit now %.2f",
+                outcome,
+                host,
+                updated["limit"],
+                extra={"host": host, "stage": "download"},
+            )
+
+
+def get_host_limiter(
+    redis_conn: redis.Redis, metrics: Metrics = None
+) -> HostLimiter | None:
+    """Returns a HostLimiter, if enabled in config.toml"""
+    limiter_config = dict(get_config().get("host_limits", {}))
+    if not limiter_config.pop("enabled", True):
+        return None
+    return HostLimiter(redis_conn, HostLimits(**limiter_config), metrics)
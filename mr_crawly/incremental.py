@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import os
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+from cache import URLCache
+from config.configuration import get_logger
+from utils import DATA_DIR, get_run_dir
+
+logger = get_logger(__name__)
+
+# How long a page is assumed fresh for each sitemap <changefreq> value
+CHANGEFREQ_WINDOWS = {
+    "always": timedelta(0),
+    "hourly": timedelta(hours=1),
+    "daily": timedelta(days=1),
+    "weekly": timedelta(weeks=1),
+    "monthly": timedelta(days=30),
+    "yearly": timedelta(days=365),
+    "never": None,
+}
+
+
+def parse_timestamp(value: str | None) -> datetime | None:
+    """Parse a sitemap lastmod or sqlite timestamp, assuming UTC if naive"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def find_previous_run(seed_url: str, run_id: str) -> str | None:
+    """Returns the most recent earlier run for the same seed url, if any"""
+    if not os.path.isdir(DATA_DIR):
+        return None
+    # Run ids are timestamps, so they sort chronologically
+    for candidate in sorted(os.listdir(DATA_DIR), reverse=True):
+        if candidate >= run_id:
+            continue
+        db_path = os.path.join(get_run_dir(candidate), "sqlite.db")
+        if not os.path.exists(db_path):
+            continue
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            row = conn.execute(
+                "SELECT 1 FROM runs WHERE seed_url = ? LIMIT 1", (seed_url,)
+            ).fetchone()
+        except sqlite3.DatabaseError:
+            row = None
+        finally:
+            conn.close()
+        if row is not None:
+            return candidate
+    return None
+
+
+class IncrementalPlanner:
+    """
+    Decides which sitemap entries need to be re-downloaded, based on the
+    most recent prior run of the same seed. Pages that have not changed
+    are carried forward into the current run by reference: their url_html
+    row keeps the same content hash and their links are copied over.
+    Given a cache, carried forward pages are also marked seen in the run,
+    so links to them from changed pages don't queue them again.
+    url_filter is the filter applied to entries before they are queued.
+    """
+
+    def __init__(
+        self,
+        run_id: str,
+        previous_run_id: str,
+        now: datetime = None,
+        seed_url: str = None,
+        cache: URLCache = None,
+        url_filter=None,
+    ):
+        self.run_id = run_id
+        self.previous_run_id = previous_run_id
+        self.seed_url = seed_url
+        self.cache = cache
+        self.url_filter = url_filter
+        self.now = now or datetime.now(timezone.utc)
+        self.conn = sqlite3.connect(os.path.join(get_run_dir(run_id), "sqlite.db"))
+        previous_db = os.path.join(get_run_dir(previous_run_id), "sqlite.db")
+        self.conn.execute("ATTACH DATABASE ? AS previous", (previous_db,))
+        self.stats = {"new": 0, "changed": 0, "due": 0, "unchanged": 0}
+
+    def _previous_entries(self, urls: list[str]) -> dict[str, tuple]:
+        """Returns loc -> (modified, frequency, last downloaded, status)"""
+        placeholders = ", ".join("?" for _ in urls)
+        rows = self.conn.execute(
+            f"""
+            SELECT sitemap.loc, sitemap.modified, sitemap.frequency,
+                   COALESCE(page.created_at, sitemap.created_at), page.status
+            FROM previous.sitemap_data AS sitemap
+            LEFT JOIN previous.url_html AS page ON page.url = sitemap.loc
+            WHERE sitemap.loc IN ({placeholders})
+            """,
+            urls,
+        ).fetchall()
+        return {row[0]: row[1:] for row in rows}
+
+    def _needs_crawl(self, details: dict, previous: tuple | None) -> str | None:
+        """Returns why the entry must be crawled, or None if it is unchanged"""
+        if previous is None:
+            return "new"
+        prev_modified, prev_frequency, last_crawled, prev_status = previous
+        if str(prev_status) != "200":
+            # Nothing usable to carry forward
+            return "new"
+        modified = details.get("modified")
+        if modified and modified != prev_modified:
+            new_time = parse_timestamp(modified)
+            old_time = parse_timestamp(prev_modified)
+            if new_time is None or old_time is None or new_time > old_time:
+                return "changed"
+        frequency = (details.get("frequency") or prev_frequency or "").lower()
+        window = CHANGEFREQ_WINDOWS.get(frequency)
+        last_crawled = parse_timestamp(last_crawled)
+        if window is not None and (
+            last_crawled is None or last_crawled + window <= self.now
+        ):
+            return "due"
+        return None
+
+    def plan(self, batch: list[dict]) -> list[str]:
+        """
+        Returns the urls from a batch of sitemap entries that need to be
+        crawled, carrying the rest forward from the previous run.
+        """
+        urls = [details["loc"] for details in batch if details.get("loc")]
+        if not urls:
+            return []
+        previous = self._previous_entries(urls)
+        to_crawl, unchanged = [], []
+        for details in batch:
+            url = details.get("loc")
+            if not url:
+                continue
+            reason = self._needs_crawl(details, previous.get(url))
+            if reason is None:
+                unchanged.append(url)
+                self.stats["unchanged"] += 1
+            else:
+                to_crawl.append(url)
+                self.stats[reason] += 1
+        self.carry_forward(unchanged)
+        return to_crawl
+
+    def carry_forward(self, urls: list[str]):
+        """Copy unchanged pages and their outgoing links into this run"""
+        if not urls:
+            return
+        if self.cache is not None:
+            seen = self.url_filter(urls) if self.url_filter is not None else urls
+            self.cache.mark_seen(self.run_id, seen)
+        placeholders = ", ".join("?" for _ in urls)
+        with self.conn:
+            self.conn.execute(
+                f"""
+                INSERT OR IGNORE INTO url_html
+                    (url, content_hash, status, run_id, seed_url, links, created_at)
+                SELECT url, content_hash, status, ?, ?, links, created_at
+                FROM previous.url_html WHERE url IN ({placeholders})
+                """,
+                [self.run_id, self.seed_url, *urls],
+            )
+            self.conn.execute(
+                f"""
+                INSERT OR IGNORE INTO links (seed_url, source_url, linked_url)
+                SELECT seed_url, source_url, linked_url
+                FROM previous.links WHERE source_url IN ({placeholders})
+                """,
+                urls,
+            )
+
+    def close(self):
+        logger.info(
+            f"Incremental crawl against run {self.previous_run_id}: {self.stats}"
+        )
+        self.conn.close()
@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+from parser import download_and_parse, extract_urls
+
+import redis
+from cache import URLCache
+from rq import get_current_job
+from site_downloader import download_page
+
+# Page jobs are enqueued as (run_id, seed_id, url_id), the ids are
+# registered by URLCache.url_ids when the page leaves the frontier
+
+
+def _resolve(
+    run_id: str, seed_id: int, url_id: int, redis_conn: redis.Redis = None
+) -> tuple[str, str]:
+    """
+    Look up the seed and page urls a job was enqueued with, on the
+    connection of the job being run unless one is passed in
+    """
+    if redis_conn is None:
+        job = get_current_job()
+        if job is None:
+            raise RuntimeError(
+                "Page jobs need a redis connection when called outside an rq job"
+            )
+        redis_conn = job.connection
+    seed_url, page_url = URLCache(redis_conn).urls_for_ids(run_id, [seed_id, url_id])
+    if page_url is None:
+        raise LookupError(f"url id {url_id} is not registered in run {run_id}")
+    return seed_url, page_url
+
+
+def download(run_id: str, seed_id: int, url_id: int, redis_conn: redis.Redis = None):
+    seed_url, page_url = _resolve(run_id, seed_id, url_id, redis_conn)
+    return download_page(seed_url, page_url, run_id)
+
+
+def parse(run_id: str, seed_id: int, url_id: int, redis_conn: redis.Redis = None):
+    seed_url, page_url = _resolve(run_id, seed_id, url_id, redis_conn)
+    return extract_urls(seed_url, page_url, run_id)
+
+
+def fused(run_id: str, seed_id: int, url_id: int, redis_conn: redis.Redis = None):
+    seed_url, page_url = _resolve(run_id, seed_id, url_id, redis_conn)
+    return download_and_parse(seed_url, page_url, run_id)
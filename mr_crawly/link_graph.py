@@ -0,0 +1,305 @@
+from __future__ import annotations
+
+import argparse
+import os
+import sqlite3
+import sys
+from array import array
+from urllib.parse import urlsplit
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+
+cwd = os.getcwd()
+loc = os.path.dirname(__file__)
+sys.path.append(loc)
+
+from config.configuration import get_logger  # noqa
+from utils import get_run_dir  # noqa
+
+logger = get_logger(__name__)
+
+EDGE_BATCH_SIZE = 50_000
+
+
+class LinkGraph:
+    """
+    Vectorized analytics over the edges stored by LinksTable.
+    Urls are mapped to integer node ids and the edge list is kept in
+    growable int arrays, so that refresh() only has to read edges
+    written since the last call before rebuilding the sparse matrix.
+    Crawled pages and sitemap entries are nodes too, whether or not
+    anything links to them, so that true orphans are reported.
+    """
+
+    def __init__(
+        self, db_path: str, seed_url: str | None = None, run_id: str | None = None
+    ):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.seed_url = seed_url or self._get_seed_url()
+        self.run_id = run_id
+        self.seed_host = _host(self.seed_url) if self.seed_url else None
+        self.node_ids: dict[str, int] = {}
+        self.urls: list[str] = []
+        self.src = array("q")
+        self.dst = array("q")
+        self.last_edge_id = 0
+        self.last_page_id = 0
+        self.last_sitemap_id = 0
+        self.pagerank_scores: np.ndarray | None = None
+        self.create_table()
+
+    def create_table(self):
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS page_scores (
+                run_id TEXT NOT NULL,
+                seed_url TEXT NOT NULL,
+                url TEXT NOT NULL,
+                in_degree INTEGER,
+                out_degree INTEGER,
+                pagerank REAL,
+                depth INTEGER,
+                is_orphan INTEGER,
+                is_reachable INTEGER,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (run_id, seed_url, url)
+            )
+        """
+        )
+        self.conn.commit()
+
+    def _get_seed_url(self) -> str | None:
+        try:
+            row = self.conn.execute(
+                "SELECT seed_url FROM runs ORDER BY run_id DESC LIMIT 1"
+            ).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row[0] if row else None
+
+    def _node_id(self, url: str) -> int:
+        node_id = self.node_ids.get(url)
+        if node_id is None:
+            node_id = len(self.urls)
+            self.node_ids[url] = node_id
+            self.urls.append(url)
+        return node_id
+
+    def load_edges(self) -> int:
+        """Read edges added since the last load, returning how many were read"""
+        query = """SELECT id, source_url, linked_url FROM links
+                   WHERE id > ? AND linked_url IS NOT NULL"""
+        params = [self.last_edge_id]
+        if self.seed_url is not None:
+            query += " AND seed_url = ?"
+            params.append(self.seed_url)
+        cursor = self.conn.execute(query + " ORDER BY id", params)
+        loaded = 0
+        while True:
+            rows = cursor.fetchmany(EDGE_BATCH_SIZE)
+            if not rows:
+                break
+            for _, source_url, linked_url in rows:
+                source, target = self._node_id(source_url), self._node_id(linked_url)
+                if source != target:
+                    self.src.append(source)
+                    self.dst.append(target)
+            self.last_edge_id = rows[-1][0]
+            loaded += len(rows)
+        if self.seed_url is not None:
+            self._node_id(self.seed_url)
+        return loaded
+
+    def load_pages(self) -> int:
+        """
+        Add the pages crawled and the sitemap entries found since the last
+        load as nodes, returning how many rows were read
+        """
+        loaded = 0
+        query = "SELECT id, url FROM url_html WHERE id > ?"
+        params = [self.last_page_id]
+        if self.seed_url is not None:
+            # Rows from before url_html had a seed_url belong to every seed
+            query += " AND (seed_url = ? OR seed_url IS NULL)"
+            params.append(self.seed_url)
+        for page_id, url in self._read_new(query, params):
+            self._node_id(url)
+            self.last_page_id = page_id
+            loaded += 1
+        # Sitemap entries aren't attributed to a seed, only to its host
+        query = "SELECT id, loc FROM sitemap_data WHERE id > ? AND loc IS NOT NULL"
+        for entry_id, loc in self._read_new(query, [self.last_sitemap_id]):
+            if self.seed_host is None or _host(loc) == self.seed_host:
+                self._node_id(loc)
+            self.last_sitemap_id = entry_id
+            loaded += 1
+        return loaded
+
+    def _read_new(self, query: str, params: list):
+        """Yield rows in id order, nothing if the table doesn't exist yet"""
+        try:
+            cursor = self.conn.execute(query + " ORDER BY id", params)
+        except sqlite3.OperationalError:
+            return
+        while rows := cursor.fetchmany(EDGE_BATCH_SIZE):
+            yield from rows
+
+    def adjacency(self) -> sparse.csr_matrix:
+        """Binary adjacency matrix, rows are sources and columns are targets"""
+        n = len(self.urls)
+        # Copy out of the arrays so they can keep growing on later loads
+        src = np.frombuffer(self.src, dtype=np.int64).copy()
+        dst = np.frombuffer(self.dst, dtype=np.int64).copy()
+        matrix = sparse.csr_matrix(
+            (np.ones(len(src), dtype=np.float64), (src, dst)), shape=(n, n)
+        )
+        # Repeated edges (e.g. from different seeds) only count once
+        matrix.data[:] = 1.0
+        return matrix
+
+    def pagerank(
+        self,
+        matrix: sparse.csr_matrix,
+        damping: float = 0.85,
+        tol: float = 1e-8,
+        max_iter: int = 100,
+    ) -> np.ndarray:
+        """
+        Power iteration PageRank. The previous scores are used as the
+        starting vector, so refreshes during a crawl converge quickly.
+        """
+        n = matrix.shape[0]
+        if n == 0:
+            return np.zeros(0)
+        out_degree = np.asarray(matrix.sum(axis=1)).ravel()
+        dangling = out_degree == 0
+        inv_degree = np.divide(
+            1.0, out_degree, out=np.zeros_like(out_degree), where=~dangling
+        )
+        transition = sparse.diags(inv_degree) @ matrix
+        transition_t = transition.T.tocsr()
+
+        scores = np.full(n, 1.0 / n)
+        if self.pagerank_scores is not None and len(self.pagerank_scores):
+            previous = self.pagerank_scores
+            scores[: len(previous)] = previous * (len(previous) / n)
+            scores /= scores.sum()
+        for _ in range(max_iter):
+            dangling_mass = scores[dangling].sum()
+            updated = damping * (transition_t @ scores)
+            updated += (damping * dangling_mass + 1.0 - damping) / n
+            error = np.abs(updated - scores).sum()
+            scores = updated
+            if error < n * tol:
+                break
+        return scores
+
+    def depths(self, matrix: sparse.csr_matrix) -> np.ndarray:
+        """Link depth from the seed url; unreachable pages are inf"""
+        n = matrix.shape[0]
+        if self.seed_url not in self.node_ids:
+            return np.full(n, np.inf)
+        return csgraph.shortest_path(
+            matrix,
+            directed=True,
+            unweighted=True,
+            indices=self.node_ids[self.seed_url],
+        )
+
+    def compute(self) -> dict[str, np.ndarray]:
+        """Compute all scores for the currently loaded graph"""
+        matrix = self.adjacency()
+        in_degree = np.asarray(matrix.sum(axis=0)).ravel().astype(np.int64)
+        out_degree = np.asarray(matrix.sum(axis=1)).ravel().astype(np.int64)
+        self.pagerank_scores = self.pagerank(matrix)
+        depth = self.depths(matrix)
+        is_orphan = in_degree == 0
+        if self.seed_url in self.node_ids:
+            is_orphan[self.node_ids[self.seed_url]] = False
+        return {
+            "in_degree": in_degree,
+            "out_degree": out_degree,
+            "pagerank": self.pagerank_scores,
+            "depth": depth,
+            "is_orphan": is_orphan,
+            "is_reachable": np.isfinite(depth),
+        }
+
+    def write_scores(self, scores: dict[str, np.ndarray]):
+        """Write the scores back to sqlite in a single transaction"""
+        depth = np.where(scores["is_reachable"], scores["depth"], -1)
+        depth = depth.astype(np.int64)
+        count = len(self.urls)
+        rows = zip(
+            [self.run_id or ""] * count,
+            [self.seed_url or ""] * count,
+            self.urls,
+            scores["in_degree"].tolist(),
+            scores["out_degree"].tolist(),
+            scores["pagerank"].tolist(),
+            depth.tolist(),
+            scores["is_orphan"].astype(int).tolist(),
+            scores["is_reachable"].astype(int).tolist(),
+        )
+        with self.conn:
+            self.conn.executemany(
+                """INSERT OR REPLACE INTO page_scores
+                   (run_id, seed_url, url, in_degree, out_degree, pagerank, depth,
+                    is_orphan, is_reachable)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                rows,
+            )
+
+    def refresh(self) -> dict[str, np.ndarray] | None:
+        """Pull in new edges and, if there were any, recompute and store scores"""
+        loaded = self.load_edges() + self.load_pages()
+        if loaded == 0 and self.pagerank_scores is not None:
+            return None
+        scores = self.compute()
+        self.write_scores(scores)
+        logger.info(
+            f"Link graph refreshed: {len(self.urls)} pages, {len(self.src)} edges, "
+            f"{int(scores['is_orphan'].sum())} orphans, "
+            f"{int((~scores['is_reachable']).sum())} unreachable"
+        )
+        return scores
+
+
+def _host(url: str) -> str:
+    host = urlsplit(url).netloc.lower()
+    return host[4:] if host.startswith("www.") else host
+
+
+def run_seeds(db_path: str) -> list[str]:
+    """Every seed a run was started with"""
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute("SELECT DISTINCT seed_url FROM runs ORDER BY seed_url")
+        return [seed_url for (seed_url,) in rows]
+    except sqlite3.OperationalError:
+        return []
+    finally:
+        conn.close()
+
+
+def analyze_run(
+    run_id: str, seed_url: str | None = None
+) -> dict[str, dict[str, np.ndarray] | None]:
+    """
+    Compute and store link graph scores for a completed run, for the given
+    seed or else each of the run's seeds. Returns the scores by seed.
+    """
+    db_path = os.path.join(get_run_dir(run_id), "sqlite.db")
+    seeds = [seed_url] if seed_url is not None else run_seeds(db_path)
+    return {seed: LinkGraph(db_path, seed, run_id=run_id).refresh() for seed in seeds}
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Link graph analytics")
+    arg_parser.add_argument("run_id", help="Run to analyze")
+    arg_parser.add_argument("--seed-url", default=None, help="Limit to one seed")
+    args = arg_parser.parse_args()
+    analyze_run(args.run_id, args.seed_url)
@@ -2,33 +2,207 @@ from __future__ import annotations
 
 import argparse
 import atexit
+import os
+import sqlite3
+import sys
 import time
+from contextlib import nullcontext
 from datetime import datetime
 from venv import logger
 
+import redis
 from config.configuration import get_logger
+from dashboard import Dashboard
+from export import export_run
 from manager import Manager
+from reparse import reparse_run
+from search_index import SearchIndex
+from snapshot import latest_snapshot
+from snapshot import restore as restore_snapshot
+from utils import get_run_dir
 
 
-def crawl(manager):
+def crawl(manager, dashboard: bool = False):
     """Crawl the given url"""
-    manager.process_url(manager.seed_url)
+    if manager.resumed:
+        # The sites were mapped before, pick up the frontier where it stopped
+        manager.drain_frontier()
+    else:
+        manager.process_seeds()
 
-    get_running_count = manager.qmanager.get_running_count()
-    while get_running_count > 0:
-        logger.info(f"Waiting for {get_running_count} jobs to finish")
-        time.sleep(10)
+    display = Dashboard(manager).live() if dashboard else nullcontext()
+    with display:
         get_running_count = manager.qmanager.get_running_count()
+        while get_running_count > 0:
+            if not dashboard:
+                logger.info(f"Waiting for {get_running_count} jobs to finish")
+            time.sleep(10)
+            manager.drain_frontier()
+            manager.prefetch_dns()
+            manager.refresh_link_graph()
+            manager.flush_search_index()
+            manager.drain_dead_letters()
+            manager.snapshot()
+            get_running_count = manager.qmanager.get_running_count()
     manager.shutdown()
 
 
+def export(argv):
+    """Export a completed run's tables to Parquet"""
+    parser = argparse.ArgumentParser(
+        prog="main.py export", description="Export a run's tables to Parquet"
+    )
+    parser.add_argument("run_id", help="Run to export (its data directory name)")
+    parser.add_argument(
+        "--out-dir", default=None, help="Output directory (default: <run>/parquet)"
+    )
+    parser.add_argument(
+        "--include-bodies",
+        action="store_true",
+        help="Include (zstd compressed) page bodies in the url_html export",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=10_000, help="Rows per record batch"
+    )
+    parser.add_argument(
+        "--max-batch-mb",
+        type=int,
+        default=64,
+        help="With --include-bodies, MiB of bodies per record batch",
+    )
+    args = parser.parse_args(argv)
+    counts = export_run(
+        args.run_id,
+        out_dir=args.out_dir,
+        include_bodies=args.include_bodies,
+        batch_size=args.batch_size,
+        max_batch_bytes=args.max_batch_mb * 1024 * 1024,
+    )
+    logger.info(f"Export complete: {counts}")
+
+
+def search(argv):
+    """Query a run's full-text search index"""
+    parser = argparse.ArgumentParser(
+        prog="main.py search", description="Search the pages crawled in a run"
+    )
+    parser.add_argument("run_id", help="Run to search (its data directory name)")
+    parser.add_argument("query", help="FTS5 query, e.g. 'pricing NOT enterprise'")
+    parser.add_argument("--limit", type=int, default=10, help="Number of results")
+    parser.add_argument(
+        "--plain",
+        action="store_true",
+        help="Match the query's words literally instead of as FTS5 syntax",
+    )
+    args = parser.parse_args(argv)
+    index = SearchIndex(os.path.join(get_run_dir(args.run_id), "sqlite.db"))
+    try:
+        results = index.search(args.query, args.limit, plain=args.plain)
+    except sqlite3.OperationalError as e:
+        parser.error(f"invalid query {args.query!r} ({e}), try --plain")
+    for url, title, snippet, score in results:
+        print(f"{score:8.3f}  {url}")
+        if title:
+            print(f"          {title}")
+        print(f"          {snippet}")
+
+
+def reparse(argv):
+    """Re-extract a stored run's links with the current parsing code"""
+    parser = argparse.ArgumentParser(
+        prog="main.py reparse",
+        description="Reparse a run's stored pages and rewrite its links table",
+    )
+    parser.add_argument("run_id", help="Run to reparse (its data directory name)")
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Parser processes (default: cpus)"
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=200, help="Pages sent to a process at once"
+    )
+    # The redis server holding the run's settings, for the scope it was crawled with
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=7777)
+    args = parser.parse_args(argv)
+    counts = reparse_run(
+        args.run_id,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        redis_conn=redis.Redis(host=args.host, port=args.port),
+    )
+    logger.info(f"Reparse complete: {counts}")
+
+
+def read_run_seeds(run_id: str) -> dict[str, int | None]:
+    """The seeds, and their budgets, an earlier run was started with"""
+    conn = sqlite3.connect(os.path.join(get_run_dir(run_id), "sqlite.db"))
+    try:
+        rows = conn.execute("SELECT seed_url, max_pages FROM runs ORDER BY run_id")
+        return dict(rows.fetchall())
+    finally:
+        conn.close()
+
+
+def restore(argv):
+    """Load a run's latest (or a given) snapshot back into redis"""
+    parser = argparse.ArgumentParser(
+        prog="main.py restore", description="Reload a run's snapshot into redis"
+    )
+    parser.add_argument("run_id", help="Run to restore (its data directory name)")
+    parser.add_argument("--snapshot", default=None, help="Snapshot file to load")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=7777)
+    args = parser.parse_args(argv)
+    path = args.snapshot or latest_snapshot(args.run_id)
+    if path is None:
+        parser.error(f"no snapshot found for run {args.run_id}")
+    restore_snapshot(redis.Redis(host=args.host, port=args.port), path)
+
+
+def read_seeds(path: str, default_budget: int | None) -> dict[str, int | None]:
+    """
+    Read seeds from a file ('-' for stdin), one url per line, optionally
+    followed by that seed's max pages. Blank lines and # comments are skipped.
+    """
+    stream = sys.stdin if path == "-" else open(path)
+    seeds = {}
+    with stream:
+        for line in stream:
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            budget = int(fields[1]) if len(fields) > 1 else default_budget
+            seeds[fields[0]] = budget
+    return seeds
+
+
+COMMANDS = {
+    "export": export,
+    "search": search,
+    "reparse": reparse,
+    "restore": restore,
+}
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        # Sub-commands operate on stored runs, anything else is a url to crawl
+        return COMMANDS[sys.argv[1]](sys.argv[2:])
+
     logger = get_logger("crawler")
     logger.info("Starting crawler")
     parser = argparse.ArgumentParser(description="Basic Web Crawler")
-    parser.add_argument("url", help="Starting URL to crawl")
+    parser.add_argument("url", nargs="?", help="Starting URL to crawl")
     parser.add_argument(
-        "--max-pages", type=int, default=10, help="Maximum number of pages to crawl"
+        "--max-pages",
+        type=int,
+        default=10,
+        help="Maximum number of pages to crawl (per seed with --seeds-file)",
+    )
+    parser.add_argument(
+        "--seeds-file",
+        default=None,
+        help="Crawl every url in this file ('-' for stdin) with one worker pool",
     )
     parser.add_argument(
         "--num_workers", type=int, default=1, help="Delay between requests in seconds"
@@ -43,7 +217,74 @@ def main():
         help="If false, all operations will run synchronously",
     )
 
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only crawl sitemap urls that are new or changed since the last run",
+    )
+
+    parser.add_argument(
+        "--allow",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="Only follow urls whose path matches (glob, or 're:' regex)",
+    )
+    parser.add_argument(
+        "--deny",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="Never follow urls whose path matches (glob, or 're:' regex)",
+    )
+    parser.add_argument(
+        "--max-depth",
+        type=int,
+        default=None,
+        help="Maximum path depth below the seed's directory",
+    )
+    parser.add_argument(
+        "--include-subdomains",
+        action="store_true",
+        default=None,
+        help="Also follow links to subdomains of the seed's host",
+    )
+
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="cProfile each job and write a merged report to the run directory",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="Also take a tracemalloc snapshot per job (implies --profile)",
+    )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="Download and parse each page in one job, skipping the parse queue",
+    )
+    parser.add_argument(
+        "--resume",
+        default=None,
+        metavar="RUN_ID",
+        help="Continue an earlier run from its redis state or latest snapshot",
+    )
+    parser.add_argument(
+        "--dashboard",
+        action="store_true",
+        help="Show a live view of throughput, queues, workers and hosts",
+    )
+
     args = parser.parse_args()
+    seeds = None
+    if args.seeds_file is not None:
+        seeds = read_seeds(args.seeds_file, args.max_pages)
+    if args.resume is not None and not args.url and not seeds:
+        seeds = read_run_seeds(args.resume)
+    if not args.url and not seeds:
+        parser.error("a url or a non-empty --seeds-file is required")
 
     # Initialize URL/HTML storage
     formatted_datetime = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
@@ -55,9 +296,21 @@ def main():
         num_workers=args.num_workers,
         retries=args.retries,
         debug=args.debug,
+        incremental=args.incremental,
+        profile=args.profile,
+        profile_memory=args.profile_memory,
+        seeds=seeds,
+        fused=args.fused,
+        run_id=args.resume,
+        scope={
+            "allow": args.allow,
+            "deny": args.deny,
+            "max_depth": args.max_depth,
+            "include_subdomains": args.include_subdomains,
+        },
     )
     atexit.register(manager.shutdown)
-    crawl(manager)
+    crawl(manager, dashboard=args.dashboard)
 
 
 if __name__ == "__main__":
@@ -1,15 +1,13 @@
 from __future__ import annotations
 
-import json
 import os
-import shutil
 import sys
 import time
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import redis
-from rq import Retry, Worker
+from rq import Worker
 from rq.command import send_shutdown_command
 
 cwd = os.getcwd()
@@ -17,12 +15,19 @@ loc = os.path.dirname(__file__)
 print(loc)
 sys.path.append(loc)
 
-from parser import extract_urls  # noqa
-
-from cache import CrawlStatus, QueueManager, URLCache  # noqa
-from config.configuration import get_logger  # noqa
-from site_downloader import download_page  # noqa
-from site_mapper import map_site  # noqa
+from blob_store import BlobStore  # noqa
+from cache import URLCache  # noqa
+from callbacks import get_context  # noqa
+from config.configuration import get_config, get_logger  # noqa
+from dns_cache import install_dns_cache  # noqa
+from link_graph import LinkGraph  # noqa
+from metrics import MetricsServer  # noqa
+from profiling import build_report  # noqa
+from retry_policy import pop_dead_letters  # noqa
+from search_index import SearchIndex  # noqa
+from serializer import MsgpackSerializer  # noqa
+from snapshot import RunSnapshotter, latest_snapshot, restore  # noqa
+from utils import DATA_DIR, get_run_dir  # noqa
 
 from data import LinksTable, RunTable, SitemapTable, UrlTable  # noqa
 
@@ -30,11 +35,9 @@ logger = get_logger(__name__)
 
 
 def start_worker(queue, redis_conn):
-    worker = Worker(connection=redis_conn, queues=[queue])
-    worker.work()
-
-
-BACKOFF_STRATEGY = [10, 30, 60]
+    worker = Worker(connection=redis_conn, queues=[queue], serializer=MsgpackSerializer)
+    # The scheduler moves jobs whose retry backoff has elapsed back onto the queue
+    worker.work(with_scheduler=True)
 
 
 class Manager:
@@ -47,28 +50,70 @@ class Manager:
         port=7777,
         retries: int = 3,
         debug: bool = False,
+        incremental: bool = False,
+        profile: bool = False,
+        profile_memory: bool = False,
+        seeds: dict[str, int | None] = None,
+        fused: bool = False,
+        scope: dict = None,
+        run_id: str = None,
     ):
         formatted_datetime = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
         print("Formatted datetime:", formatted_datetime)
-        self.run_id = formatted_datetime
+        # Resuming continues an earlier run from its redis state or snapshot
+        self.resumed = run_id is not None
+        self.run_id = run_id or formatted_datetime
         logger.info(f"Initializing Manager for run_id {self.run_id}")
-        self.seed_url = seed_url
+        # Every seed shares the run's queues and workers, with its own budget
+        self.seeds = dict(seeds or {})
+        if seed_url is not None:
+            self.seeds.setdefault(seed_url, max_pages)
+        self.seed_url = seed_url or next(iter(self.seeds), None)
         self.max_pages = max_pages
         self.retries = retries
         self.is_async = not debug
+        self.incremental = incremental
+        # Download and parse each page in one job instead of two
+        self.fused = fused
+        # Command line additions to [scope] in config.toml, see scope.py
+        self.scope = scope or {}
+        # Read by profiling.profile_job from each job's meta
+        self.profile_options = None
+        if profile or profile_memory:
+            self.profile_options = {"memory": profile_memory}
         self.num_workers = num_workers
 
-        self.visited_urls = set()
         self.queues = []
         self.redis_conn = redis.Redis(host=host, port=port, decode_responses=False)
-        self.cache = URLCache(self.redis_conn)
-        self.qmanager = QueueManager(self.redis_conn, self.is_async)
+        if self.resumed:
+            self._restore_snapshot()
+        # Callbacks run in the work horses, and rebuild what they need of
+        # the run from these settings rather than from the Manager
+        URLCache(self.redis_conn).save_run_settings(
+            self.run_id,
+            {
+                "fused": self.fused,
+                "incremental": self.incremental,
+                "profile": self.profile_options,
+                "retries": self.retries,
+                "is_async": self.is_async,
+                "scope": self.scope,
+            },
+        )
+        self.context = get_context(self.run_id, self.redis_conn)
+        self.cache = self.context.cache
+        self.qmanager = self.context.qmanager
+        self.metrics = self.context.metrics
+        # Inherited by the work horses rq forks from this process
+        self.dns_cache = install_dns_cache(self.redis_conn, self.metrics)
         self._init_dirs()
         self._init_db()
+        self._init_snapshots()
+        self._start_metrics_server()
         self._start_workers()
 
     def _init_dirs(self):
-        self.data_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+        self.data_dir = DATA_DIR
         try:
             print("Making directory" + self.data_dir)
             os.makedirs(self.data_dir, exist_ok=True)
@@ -76,25 +121,61 @@ class Manager:
             print("Directory already exists")
             pass
         logger.info("Initializing Directories")
-        self.data_dir = os.path.join(self.data_dir, f"{self.run_id}")
+        self.data_dir = get_run_dir(self.run_id)
         try:
             print("Making directory" + self.data_dir)
             os.makedirs(self.data_dir, exist_ok=True)
         except FileExistsError:
             print("Directory already exists")
             pass
-        self.rdb_path = os.path.join(self.data_dir, "data.rdb")
 
     ## Specify start-up behavior
     def _init_db(self):
         # Initialize databases
         print(self.data_dir)
+        # Bodies are shared across runs so identical pages are only stored once
+        self.blob_store = BlobStore(os.path.join(DATA_DIR, "blobs"))
         self.run_db = RunTable(self.data_dir + "/sqlite.db")
-        self.url_db = UrlTable(self.data_dir + "/sqlite.db")
+        self.url_db = UrlTable(self.data_dir + "/sqlite.db", self.blob_store)
         self.links_db = LinksTable(self.data_dir + "/sqlite.db")
         self.sitemap_table = SitemapTable(self.data_dir + "/sqlite.db")
         self.url_db.create_tables()
-        self.run_db.start_run(self.seed_url, self.max_pages)
+        # A resumed run completes the records it was started with
+        started = self.run_db.seed_runs() if self.resumed else {}
+        self.seed_runs = {
+            seed: started.get(seed) or self.run_db.start_run(seed, budget)
+            for seed, budget in self.seeds.items()
+        }
+        self.cache.set_seed_budgets(self.run_id, self.seeds)
+        analytics_config = get_config().get("analytics", {})
+        self.link_graph = None
+        self.graph_refresh_interval = analytics_config.get("refresh_interval", 60)
+        self.last_graph_refresh = 0
+        # Graphs are per seed, so batch runs are analyzed after the fact
+        # with link_graph.py <run_id> --seed-url
+        if analytics_config.get("link_graph", False) and len(self.seeds) == 1:
+            self.link_graph = LinkGraph(
+                self.data_dir + "/sqlite.db", self.seed_url, run_id=self.run_id
+            )
+        search_config = get_config().get("search", {})
+        self.search_index = None
+        self.search_batch_size = search_config.get("batch_size", 500)
+        if search_config.get("enabled", False):
+            self.search_index = SearchIndex(self.data_dir + "/sqlite.db")
+
+    def _start_metrics_server(self):
+        """Expose the metrics aggregated in redis on a local /metrics endpoint"""
+        self.metrics_server = None
+        metrics_config = get_config().get("metrics", {})
+        if not self.metrics.enabled:
+            return
+        self.metrics_server = MetricsServer(
+            self.metrics,
+            host=metrics_config.get("host", "127.0.0.1"),
+            port=metrics_config.get("port", 9108),
+            collectors=[self.qmanager.collect_metrics],
+        )
+        self.metrics_server.start()
 
     def _start_workers(self):
         """
@@ -103,6 +184,9 @@ class Manager:
         we don't save pointers to the workers in the manager.
         """
         queues = self.qmanager.get_queues()
+        if self.fused:
+            # Pages are parsed by the download workers
+            queues = [queue for queue in queues if queue.name != "parse"]
         executor = ThreadPoolExecutor(max_workers=1)
         for queue in queues:
             for i in range(self.num_workers):
@@ -112,9 +196,18 @@ class Manager:
     ## Specify shutdown behavior
     def shutdown(self, force: bool = False):
         self._stop_workers()
-        self.run_db.complete_run(self.run_id)
+        self.refresh_link_graph(force=True)
+        self.flush_search_index()
+        self.drain_dead_letters()
+        for seed_run_id in self.seed_runs.values():
+            self.run_db.complete_run(seed_run_id)
         self.qmanager._close_queues(force=force)
-        self.save_cache()
+        self.snapshot(force=True)
+        if self.profile_options is not None:
+            build_report(self.run_id)
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
 
     def _flush_db(self):
         """Flush the database"""
@@ -139,145 +232,97 @@ class Manager:
             logger.info(f"Waiting for workers to finish: {len(workers)} remaining")
         logger.info(f"Worker Stats: {worker_stats}")
 
-    def save_cache(self):
-        logger.info("Saving cache")
-        self.redis_conn.save()
-        shutil.copy(loc, self.rdb_path)
-
-    ## Specify runtime behavior
-    def enqueue(
-        self,
-        args,
-        req_queue,
-        function,
-        on_success_callback,
-        on_failure_callback,
-        depends_on=None,
-    ):
-        """Add a job to the specified queue, with the
-        optionally specified dependencies and callbacks"""
-        if isinstance(args, str):
-            args = (args,)
-        logger.info(
-            f"Enqueuing {args} in {req_queue.name}: {on_success_callback} {on_failure_callback}"
-        )
-        job = req_queue.enqueue(
-            function,
-            args=args,
-            on_success=on_success_callback,
-            on_failure=on_failure_callback,
-            depends_on=depends_on,
-            retry=Retry(max=self.retries),
-            interval=BACKOFF_STRATEGY,
-        )
-        return job
-
-    def enqueue_page(self, seed_url, curr_url):
-        """
-        This represents the crawling of a single page.
-        1. Download the content, if possible, cache to redis
-        2. Extract urls from the page, return them
-        3. Enqueue the urls for parsing
-        """
-        logger.debug(f"Enqueuing download for {curr_url}")
-        download_task = self.enqueue(
-            (seed_url, curr_url), self.qmanager.frontier_queue, download_page
-        )  # noqa
-        parse_task = self.enqueue(
-            (seed_url, curr_url),
-            self.qmanager.parse_queue,
-            extract_urls,
-            depends_on=download_task.id,
-            on_success=self.on_parse_success,
-            on_failure=self.on_parse_failure,
-        )  # noqa
-
-        return download_task, parse_task
-
-    #   General on end functions to update status/save data
-    def on_success(self, job, connection, result, func_name):
-        """Callback for when a job succeeds"""
-        url = job.args[0]
-        logger.info(f"{func_name} job {job.id} succeeded")
-        self.cache.update_status(url, "status", func_name)
-        return url, result
-
-    def on_failure(self, job, connection, type, value, traceback, func_name):
-        """Callback for when a job succeeds"""
-        url = job.args[0]
-        logger.info(f"{func_name} job {job.id} failed")
-        if func_name != "map_site":
-            url_data = self.cache.update_status(url, "status", "error")
-            if url_data:
-                self.url_db.store_url_content(url_data, self.run_id)
-                self.url_db.store_url(url_data)
-        return url
-
-    # Map site specific on end functions
-    def on_map_success(self, job, connection, result):
-        url, result = self.on_success(job, connection, result, "map_site")
-        """Callback for when a site mapping job succeeds"""
-        root_sitemap_url, sitemap_indicies, sitemap_details = result
-        self.logger.info(
-            "Writing sitemap data to sqlite and the top level urls to rdb cache"
-        )
-        with open(f"{self.data_dir}/sitemap_indexes.json", "w") as f:
-            json.dump(sitemap_indicies, f, default=str, indent=4)
-
-        for detail in sitemap_details:
-            self.sitemap_table.store_sitemap_data(detail)
-            url = detail.get("loc")
-            self.enqueue_page(self.seed_url, url)
-
-    def on_map_failure(self, job, connection, type, value, traceback):
-        """Callback for when a site mapping job fails"""
-        url, result = self.on_failure(
-            job, connection, type, value, traceback, "map_site"
-        )
-        logger.info("Utilizing fallback to seed_url links")
-        self.enqueue_page(self.seed_url, self.seed_url)
-
-    # Download specific on end functions
-    def on_download_success(self, job, connection, queue, result):
+    def refresh_link_graph(self, force: bool = False):
+        """Recompute link graph scores if the refresh interval has passed"""
+        if self.link_graph is None:
+            return
+        now = time.time()
+        if force or now - self.last_graph_refresh >= self.graph_refresh_interval:
+            self.link_graph.refresh()
+            self.last_graph_refresh = now
+
+    def flush_search_index(self):
+        """Index the page text queued by the parse workers"""
+        if self.search_index is None:
+            return
+        self.search_index.drain(self.redis_conn, self.run_id, self.search_batch_size)
+
+    def prefetch_dns(self):
+        """Resolve the hosts on the frontier ahead of their downloads"""
+        if self.dns_cache is None:
+            return
+        hosts = self.redis_conn.smembers(f"{self.run_id}:frontier_hosts")
+        self.dns_cache.prefetch(hosts)
+
+    def drain_dead_letters(self, batch_size: int = 500):
+        """Record the jobs the retry policy has given up on"""
+        entries = pop_dead_letters(self.redis_conn, self.run_id, batch_size)
+        while entries:
+            self.url_db.store_dead_letters(entries, self.run_id)
+            entries = pop_dead_letters(self.redis_conn, self.run_id, batch_size)
+
+    def _init_snapshots(self):
+        snapshot_config = get_config().get("snapshot", {})
+        self.snapshotter = None
+        self.snapshot_interval = snapshot_config.get("interval", 300)
+        self.last_snapshot = time.time()
+        if snapshot_config.get("enabled", True):
+            self.snapshotter = RunSnapshotter(
+                self.redis_conn,
+                self.run_id,
+                mode=snapshot_config.get("mode", "scan"),
+                batch_size=snapshot_config.get("batch_size", 500),
+                keep=snapshot_config.get("keep", 3),
+            )
+
+    def snapshot(self, force: bool = False):
+        """Snapshot the run's redis state if the snapshot interval has passed"""
+        if self.snapshotter is None:
+            return
+        now = time.time()
+        if force or now - self.last_snapshot >= self.snapshot_interval:
+            with self.metrics.timer("snapshot"):
+                self.context.save_pending()
+                try:
+                    self.snapshotter.snapshot()
+                finally:
+                    self.cache.clear_pending(self.run_id)
+            self.last_snapshot = now
+
+    def _restore_snapshot(self):
         """
-        When a download success, progress the urls status,
-            and enqueue the page for parsing.
+        Reload a resumed run's keys, unless redis still has them, and
+        requeue the pages whose jobs were unfinished when it was taken
         """
-        url, result = self.on_success(job, connection, result, "download")
-        self.cache.update_content(url, result[0], result[1])
-        self.visited_urls.add(url)
-        if len(self.visited_urls) >= self.max_pages:
-            # Allow submitted tasks to finish, but shutdown workers
-            logger.info(f"Downloaded {len(self.visited_urls)} urls")
-            logger.info("Shutting down...")
-            self.shutdown()
+        cache = URLCache(self.redis_conn)
+        if self.redis_conn.exists(f"{self.run_id}:settings"):
+            logger.info(f"Resuming run {self.run_id} from its keys in redis")
+            # Its jobs are still queued, drop any record of them left over
+            # from a snapshot that was interrupted
+            cache.clear_pending(self.run_id)
+            return
+        path = latest_snapshot(self.run_id)
+        if path is None:
+            raise FileNotFoundError(f"No snapshot found to resume run {self.run_id}")
+        logger.info(f"Resuming run {self.run_id} from {path}")
+        restore(self.redis_conn, path)
+        requeued = cache.requeue_pending(self.run_id)
+        logger.info(f"Requeued {requeued} urls whose jobs were unfinished")
 
-    def on_download_failure(self, job, connection, type, value, traceback):
-        """Callback for when a download job fails"""
-        url, result = self.on_failure(job, connection, type, value, traceback, "error")
+    ## Specify runtime behavior
+    def enqueue_page(self, seed_url, curr_url):
+        """Enqueue the download (and parse) of a single page"""
+        return self.context.enqueue_pages([(seed_url, curr_url)])[0]
 
-    # Parse specific on end functions
-    def on_parse_success(self, job, connection, result):
-        """Callback for when a parse job succeeds"""
-        logger.info(f"Parse job {job.id} succeeded")
-        seed_url, current_url, new_links = result
-        self.links_db.store_links(seed_url, current_url, new_links)
-        for link in new_links:
-            self.enqueue_page(seed_url, link)
+    def drain_frontier(self, batch_size: int = 1000):
+        """Enqueue the urls waiting on the frontier, within seed budgets"""
+        self.context.drain_frontier(batch_size)
 
-    def on_parse_failure(self, job, connection, type, value, traceback):
-        """Callback for when a download job fails"""
-        url, result = self.on_failure(job, connection, type, value, traceback, "error")
+    def process_seeds(self):
+        """Map every seed's site, the results feed the shared frontier"""
+        for seed_url in self.seeds:
+            self.process_url(seed_url)
 
     def process_url(self, seed_url):
-        """
-        Queues the download, map_site, and parse_page jobs for the given url.
-        Returns the download, map_site, and parse_page jobs.
-        """
-        _ = self.enqueue(
-            args=seed_url,
-            req_queue=self.qmanager.site_map_queue,
-            function=map_site,
-            on_success_callback=self.on_map_success,
-            on_failure_callback=self.on_map_failure,
-        )  # noqa
+        """Queues the map_site job for the given url, returns the job"""
+        return self.context.process_url(seed_url)
@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import redis
+from config.configuration import get_config, get_logger
+
+logger = get_logger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRIC_PREFIX = "mrcrawly"
+
+
+def _field(name: str, labels: dict) -> str:
+    """Encode a metric name and its labels as a redis hash field"""
+    label_str = ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+    return f"{name}|{label_str}"
+
+
+def _split_field(field: str) -> tuple[str, str]:
+    name, _, label_str = field.partition("|")
+    return name, label_str
+
+
+def parse_labels(label_str: str) -> dict[str, str]:
+    """Decode the label part of a hash field back into a dict"""
+    labels = {}
+    for pair in label_str.split(","):
+        if pair:
+            key, _, value = pair.partition("=")
+            labels[key] = value.strip('"')
+    return labels
+
+
+def _series(name: str, label_str: str) -> str:
+    return f"{name}{{{label_str}}}" if label_str else name
+
+
+def _with_label(label_str: str, key: str, value) -> str:
+    extra = f'{key}="{value}"'
+    return f"{label_str},{extra}" if label_str else extra
+
+
+class Metrics:
+    """
+    Counters, gauges and latency histograms shared by every worker process.
+    Values are accumulated in redis hashes (one round trip per update),
+    and rendered in the Prometheus text format by the manager. With a
+    run_id they are kept with the run's other keys, so concurrent and
+    successive runs each count their own.
+    """
+
+    def __init__(
+        self,
+        redis_conn: redis.Redis,
+        enabled: bool = True,
+        buckets: tuple = DEFAULT_BUCKETS,
+        run_id: str = None,
+    ):
+        self.rdb = redis_conn
+        self.enabled = enabled
+        self.buckets = buckets
+        self.run_id = run_id
+        prefix = f"{run_id}:metrics" if run_id else f"{METRIC_PREFIX}:metrics"
+        self.counters_key = f"{prefix}:counters"
+        self.gauges_key = f"{prefix}:gauges"
+        self.histograms_key = f"{prefix}:histograms"
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if self.enabled:
+            self.rdb.hincrbyfloat(self.counters_key, _field(name, labels), value)
+
+    def set_gauge(self, name: str, value: float, **labels):
+        if self.enabled:
+            self.rdb.hset(self.gauges_key, _field(name, labels), value)
+
+    def observe(self, name: str, value: float, **labels):
+        """Record a single observation in a histogram"""
+        if not self.enabled:
+            return
+        field = _field(name, labels)
+        index = bisect_left(self.buckets, value)
+        bucket = self.buckets[index] if index < len(self.buckets) else "+Inf"
+        pipe = self.rdb.pipeline(transaction=False)
+        pipe.hincrby(self.histograms_key, f"{field}|{bucket}", 1)
+        pipe.hincrbyfloat(self.histograms_key, f"{field}|sum", value)
+        pipe.hincrby(self.histograms_key, f"{field}|count", 1)
+        pipe.execute()
+
+    @contextmanager
+    def timer(self, stage: str, **labels):
+        """Time a block of work, recording it under the stage's histogram"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.observe("stage_seconds", duration, stage=stage, **labels)
+            logger.debug(
+                "%s took %.4fs",
+                stage,
+                duration,
+                extra={"stage": stage, "duration": duration},
+            )
+
+    def reset(self):
+        self.rdb.delete(self.counters_key, self.gauges_key, self.histograms_key)
+
+    def _read(self, key: str) -> dict[str, float]:
+        return {
+            field.decode("utf-8"): float(value)
+            for field, value in self.rdb.hgetall(key).items()
+        }
+
+    def read_counters(self) -> list[tuple[str, dict, float]]:
+        """Returns every counter as (name, labels, value), in one round trip"""
+        counters = []
+        for field, value in self._read(self.counters_key).items():
+            name, label_str = _split_field(field)
+            counters.append((name, parse_labels(label_str), value))
+        return counters
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+        for key, metric_type in [
+            (self.counters_key, "counter"),
+            (self.gauges_key, "gauge"),
+        ]:
+            by_name = defaultdict(list)
+            for field, value in self._read(key).items():
+                name, label_str = _split_field(field)
+                by_name[name].append((label_str, value))
+            for name, samples in sorted(by_name.items()):
+                full_name = f"{METRIC_PREFIX}_{name}"
+                lines.append(f"# TYPE {full_name} {metric_type}")
+                for label_str, value in sorted(samples):
+                    lines.append(f"{_series(full_name, label_str)} {value:g}")
+
+        # Buckets are stored individually and made cumulative here
+        histograms = defaultdict(lambda: {"buckets": {}, "sum": 0.0, "count": 0.0})
+        for field, value in self._read(self.histograms_key).items():
+            series, _, part = field.rpartition("|")
+            if part in ("sum", "count"):
+                histograms[series][part] = value
+            else:
+                histograms[series]["buckets"][part] = value
+        by_name = defaultdict(list)
+        for series, data in histograms.items():
+            name, label_str = _split_field(series)
+            by_name[name].append((label_str, data))
+        for name, samples in sorted(by_name.items()):
+            full_name = f"{METRIC_PREFIX}_{name}"
+            lines.append(f"# TYPE {full_name} histogram")
+            for label_str, data in sorted(samples, key=lambda sample: sample[0]):
+                cumulative = 0.0
+                for bound in [*self.buckets, "+Inf"]:
+                    cumulative += data["buckets"].get(str(bound), 0.0)
+                    bucket_labels = _with_label(label_str, "le", bound)
+                    lines.append(
+                        f"{full_name}_bucket{{{bucket_labels}}} {cumulative:g}"
+                    )
+                lines.append(
+                    f"{_series(full_name + '_sum', label_str)} {data['sum']:g}"
+                )
+                lines.append(
+                    f"{_series(full_name + '_count', label_str)} {data['count']:g}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+def get_metrics(redis_conn: redis.Redis, run_id: str = None) -> Metrics:
+    """Returns the run's Metrics, enabled according to config.toml"""
+    enabled = get_config().get("metrics", {}).get("enabled", False)
+    return Metrics(redis_conn, enabled=enabled, run_id=run_id)
+
+
+class MetricsServer:
+    """
+    Serves /metrics over http from a daemon thread. Collectors are called
+    before each scrape, to refresh gauges that are cheaper to read on
+    demand (e.g. queue depths) than to maintain on every update. If the
+    port is taken (e.g. by another run's server) any free port is used.
+    """
+
+    def __init__(self, metrics: Metrics, host="127.0.0.1", port=9108, collectors=()):
+        self.metrics = metrics
+        self.collectors = list(collectors)
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = server.scrape().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        try:
+            self.httpd = ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            logger.warning(f"Metrics port {port} unavailable ({e}), using a free port")
+            self.httpd = ThreadingHTTPServer((host, 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def scrape(self) -> str:
+        for collector in self.collectors:
+            try:
+                collector(self.metrics)
+            except Exception as e:
+                logger.warning(f"Metrics collector {collector} failed: {e}")
+        return self.metrics.render()
+
+    def start(self):
+        host, port = self.httpd.server_address[:2]
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import html
+import re
+from hashlib import blake2b
+
+import numpy as np
+import redis
+from config.configuration import get_config, get_logger
+from metrics import Metrics
+
+logger = get_logger(__name__)
+
+FINGERPRINT_BITS = 64
+# Markup whose text is not part of the page's content
+HIDDEN_BLOCKS = re.compile(
+    r"<(script|style|noscript|template)\b.*?</\1\s*>", re.IGNORECASE | re.DOTALL
+)
+TAGS = re.compile(r"<[^>]*>")
+TOKENS = re.compile(r"\w+")
+
+
+def page_text(content: str | bytes) -> str:
+    """
+    The visible text of a page, approximately. Tags are stripped with
+    regexes rather than parsed, as this runs on pages that may not be
+    parsed at all.
+    """
+    if isinstance(content, bytes):
+        content = content.decode("utf-8", errors="replace")
+    content = HIDDEN_BLOCKS.sub(" ", content)
+    return html.unescape(TAGS.sub(" ", content))
+
+
+def shingle_hashes(tokens: list[str], shingle_size: int = 3) -> np.ndarray:
+    """64 bit hashes of each run of shingle_size consecutive tokens"""
+    count = max(len(tokens) - shingle_size + 1, 1)
+    digests = b"".join(
+        blake2b(
+            " ".join(tokens[i : i + shingle_size]).encode("utf-8"), digest_size=8
+        ).digest()
+        for i in range(count)
+    )
+    return np.frombuffer(digests, dtype="<u8")
+
+
+def simhash(tokens: list[str], shingle_size: int = 3) -> int:
+    """
+    SimHash of a token sequence: each bit is set if most of the shingles'
+    hashes have it set, so similar texts differ in only a few bits.
+    """
+    hashes = shingle_hashes(tokens, shingle_size)
+    bits = np.unpackbits(
+        hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder="little"
+    )
+    majority = (bits.sum(axis=0) * 2 > len(hashes)).astype(np.uint8)
+    return int.from_bytes(np.packbits(majority, bitorder="little").tobytes(), "little")
+
+
+def band_ranges(bands: int, bits: int = FINGERPRINT_BITS) -> list[tuple[int, int]]:
+    """Split the fingerprint into (shift, width) bands of near equal width"""
+    edges = [bits * band // bands for band in range(bands + 1)]
+    return [(start, end - start) for start, end in zip(edges, edges[1:])]
+
+
+class NearDuplicateIndex:
+    """
+    Banded LSH over page SimHashes, in redis so every worker shares it.
+    Fingerprints are split into max_distance + 1 bands, so by pigeonhole
+    any two within max_distance bits agree on at least one whole band;
+    only pages sharing a band are compared. The first page of a cluster
+    is indexed, later pages within max_distance of it are duplicates.
+    """
+
+    def __init__(
+        self,
+        redis_conn: redis.Redis,
+        run_id: str,
+        max_distance: int = 3,
+        shingle_size: int = 3,
+        min_tokens: int = 50,
+        max_candidates: int = 100,
+        metrics: Metrics = None,
+    ):
+        self.rdb = redis_conn
+        self.run_id = run_id
+        self.max_distance = max_distance
+        self.shingle_size = shingle_size
+        self.min_tokens = min_tokens
+        self.max_candidates = max_candidates
+        self.metrics = metrics
+        self.bands = band_ranges(max_distance + 1)
+
+    def _band_keys(self, fingerprint: int) -> list[str]:
+        keys = []
+        for index, (shift, width) in enumerate(self.bands):
+            band = (fingerprint >> shift) & ((1 << width) - 1)
+            keys.append(f"{self.run_id}:lsh:{index}:{band:x}")
+        return keys
+
+    def check(self, url: str, content: str | bytes) -> tuple[str, int] | None:
+        """
+        Returns (canonical url, distance) if the page is a near duplicate
+        of one already indexed, otherwise indexes it and returns None.
+        Pages too short to fingerprint reliably are never duplicates.
+        """
+        tokens = TOKENS.findall(page_text(content).lower())
+        if len(tokens) < self.min_tokens:
+            return None
+        fingerprint = simhash(tokens, self.shingle_size)
+        keys = self._band_keys(fingerprint)
+        pipe = self.rdb.pipeline(transaction=False)
+        for key in keys:
+            # Sampled, so a band shared by very many pages stays cheap to check
+            pipe.srandmember(key, self.max_candidates)
+        best = None
+        for members in pipe.execute():
+            for member in members:
+                other, _, other_url = member.decode("utf-8").partition(" ")
+                distance = (int(other, 16) ^ fingerprint).bit_count()
+                if distance <= self.max_distance and (
+                    best is None or distance < best[1]
+                ):
+                    best = (other_url, distance)
+        if best is not None and best[0] != url:
+            if self.metrics is not None:
+                self.metrics.inc("near_duplicates_total")
+            logger.debug(
+                "%s is a near duplicate of %s (%d bits)",
+                url,
+                best[0],
+                best[1],
+                extra={"run_id": self.run_id, "url": url, "stage": "fingerprint"},
+            )
+            return best
+        pipe = self.rdb.pipeline(transaction=False)
+        for key in keys:
+            pipe.sadd(key, f"{fingerprint:016x} {url}")
+        pipe.execute()
+        return None
+
+
+def get_near_duplicate_index(
+    redis_conn: redis.Redis, run_id: str, metrics: Metrics = None
+) -> NearDuplicateIndex | None:
+    """Returns the run's NearDuplicateIndex, if enabled in config.toml"""
+    dedupe_config = dict(get_config().get("near_duplicates", {}))
+    if not dedupe_config.pop("enabled", False):
+        return None
+    return NearDuplicateIndex(redis_conn, run_id, metrics=metrics, **dedupe_config)
@@ -1,11 +1,105 @@
 from __future__ import annotations
 
-from urllib.parse import urljoin, urlparse
+from dataclasses import asdict, dataclass
+from urllib.parse import urldefrag, urljoin
 
 import redis
 from bs4 import BeautifulSoup
 from cache import URLCache
-from config.configuration import get_logger
+from config.configuration import get_config, get_logger
+from metrics import get_metrics
+from near_duplicates import get_near_duplicate_index
+from profiling import profile_job
+from scope import Scope, load_scope
+from search_index import queue_document
+from site_downloader import download_page
+
+logger = get_logger("crawler")
+
+# Link types that ask crawlers not to follow a link
+NOFOLLOW_RELS = {"nofollow", "ugc", "sponsored"}
+
+
+def _rel(tag) -> set[str]:
+    return {value.lower() for value in tag.get("rel") or []}
+
+
+@dataclass
+class PageDirectives:
+    """What a page asks of crawlers, from its canonical link and meta robots"""
+
+    canonical_url: str = None
+    noindex: bool = False
+    nofollow: bool = False
+    # Links skipped for their own rel="nofollow"
+    nofollow_links: int = 0
+
+    def is_canonical(self, url: str) -> bool:
+        return self.canonical_url is None or self.canonical_url == url
+
+    def any(self) -> bool:
+        """Whether the page set any directive worth recording"""
+        return bool(
+            self.canonical_url or self.noindex or self.nofollow or self.nofollow_links
+        )
+
+
+def extract_page(
+    url: str, soup: BeautifulSoup, scope: Scope
+) -> tuple[set[str], PageDirectives]:
+    """
+    The links to follow from a parsed page, and the page's directives,
+    in one pass over its tags. A page marked nofollow has no links to
+    follow, and one whose canonical url is another page only links to
+    that page, whose own links are followed when it is parsed. Pure, so
+    that stored pages can be reparsed (see reparse.py) exactly as they
+    are parsed while crawling.
+    """
+    found = set()
+    directives = PageDirectives()
+    # Future state: look for other linkable tags like <img> or <script>
+    for tag in soup.find_all(["a", "link", "meta"]):
+        try:
+            if tag.name == "meta":
+                if (tag.get("name") or "").lower() == "robots":
+                    content = {
+                        value.strip()
+                        for value in (tag.get("content") or "").lower().split(",")
+                    }
+                    none = "none" in content
+                    directives.noindex |= none or "noindex" in content
+                    directives.nofollow |= none or "nofollow" in content
+            elif tag.name == "link":
+                href = tag.get("href")
+                if href and "canonical" in _rel(tag) and not directives.canonical_url:
+                    directives.canonical_url = urldefrag(urljoin(url, href)).url
+            elif tag.get("href") is not None:
+                if _rel(tag) & NOFOLLOW_RELS:
+                    directives.nofollow_links += 1
+                    continue
+                found.add(urldefrag(urljoin(url, tag["href"])).url)
+        except Exception as e:
+            logger.error("Error parsing %s: %s", url, e)
+            return set(), directives
+    if directives.nofollow:
+        logger.debug("Not following links on %s (meta robots nofollow)", url)
+        found = set()
+    elif not directives.is_canonical(url):
+        logger.debug("%s is canonically %s", url, directives.canonical_url)
+        found = {directives.canonical_url}
+    # Each distinct link is checked once, against the seed's scope,
+    # before anything is written to redis or enqueued
+    links = set(scope.filter(found))
+    if len(links) < len(found):
+        logger.debug("%d links on %s out of scope", len(found) - len(links), url)
+    if links:
+        links.add(url)
+    return links, directives
+
+
+def extract_links(url: str, soup: BeautifulSoup, scope: Scope) -> set[str]:
+    """The links to follow from a parsed page, see extract_page"""
+    return extract_page(url, soup, scope)[0]
 
 
 class Parser:
@@ -13,12 +107,15 @@ class Parser:
         self,
         seed_url: str,
         current_url: str,
+        run_id: str = None,
         max_pages: int = 10,
         host: str = "localhost",
         port: int = 7777,
     ):
         self.seed_url = seed_url
         self.current_url = current_url
+        self.run_id = run_id
+        self.soup = None
         self.max_pages = max_pages
         self.visited_urls = set()
         self.to_visit = []
@@ -27,35 +124,39 @@ class Parser:
         self.port = port
         self.redis_conn = redis.Redis(host=host, port=port, decode_responses=False)
         self.cache = URLCache(self.redis_conn)
+        self.metrics = get_metrics(self.redis_conn, run_id)
+        self.scope = None
+        # Set by get_links from the page's canonical link and meta robots
+        self.directives = None
+        # Set by request_page when the cached page is a near duplicate
+        self.duplicate_of = None
 
     def request_page(self, url: str):
         """Get the contents of the sitemap"""
-        content, req_status = self.cache.get_cached_response(url)
-        if content is None or req_status != 200:
+        with self.metrics.timer("cache_read"):
+            content, req_status, duplicate_of = self.cache.get_cached_response(url)
+        self.duplicate_of = duplicate_of
+        # Statuses come back from the cache as text
+        if content is None or str(req_status) != "200":
             return None
         return content
 
-    def get_links(self, url: str) -> set[str]:
-        """Extract all links from a webpage"""
-        content = self.request_page(url)
+    def get_links(self, url: str, content: str = None) -> set[str]:
+        """Extract all links from a webpage, read from the cache unless given"""
         if content is None:
-            self.logger.warning(f"Skipping {url} (no content cached)")
+            content = self.request_page(url)
+        if content is None and self.duplicate_of is not None:
+            self.logger.info("Skipping %s (duplicate of %s)", url, self.duplicate_of)
+            return set()
+        if content is None:
+            self.logger.warning("Skipping %s (no content cached)", url)
             return set()
         soup = BeautifulSoup(content, "html.parser")
-        links = set()
-        # Looking for <a></a> tags with an href
-        # Future state: look for other linkable tags like <img> or <script>
-        for anchor in soup.find_all("a", href=True):
-            try:
-                href = anchor["href"]
-                absolute_url = urljoin(url, href)
-            except Exception as e:
-                self.logger.error(f"Error parsing {url}: {e}")
-                return set()
-            # Only include URLs from the same domain
-            if urlparse(absolute_url).netloc == urlparse(url).netloc:
-                links.add(absolute_url)
-                links.add(url)
+        # Kept so later stages (e.g. indexing) don't have to re-parse the page
+        self.soup = soup
+        if self.scope is None:
+            self.scope = load_scope(self.cache, self.run_id, self.seed_url)
+        links, self.directives = extract_page(url, soup, self.scope)
         return links
 
     def recurse_links(self, src_link: str) -> set[str]:
@@ -69,28 +170,74 @@ class Parser:
         return links
 
     # Crawling Logic
-    def crawl(self):
+    def crawl(self, content: str = None):
         """Main crawling method"""
         current_url = self.current_url
-        self.logger.info(f"Crawling: {current_url}")
+        self.logger.info(
+            "Crawling: %s", current_url, extra={"url": current_url, "stage": "parse"}
+        )
         if current_url is None:
             return None
-        if not self.can_fetch(current_url):
-            self.logger.info(f"Skipping {current_url} (not allowed by robots.txt)")
-            return None
+        # robots.txt has already been checked by the downloader
         self.visited_urls.add(current_url)
 
-        new_links = self.get_links(current_url)
+        with self.metrics.timer("parse"):
+            new_links = self.get_links(current_url, content)
+        noindex = self.directives is not None and self.directives.noindex
+        if self.soup is not None and self.run_id is not None and not noindex:
+            self.index_page(current_url)
         return new_links
 
+    def directives_found(self) -> dict | None:
+        """The page's directives as a job result, or None if it set none"""
+        if self.directives is None or not self.directives.any():
+            return None
+        return asdict(self.directives)
+
+    def index_page(self, url: str):
+        """Queue the page's text for the run's full-text search index"""
+        if not get_config().get("search", {}).get("enabled", False):
+            return
+        queue_document(self.redis_conn, self.run_id, url, self.soup)
+
+
+@profile_job
+def extract_urls(seed_url: str, curr_url: str, run_id: str = None):
+    """
+    Extract URLs from a webpage. Returns (seed_url, curr_url, new_links,
+    directives), directives being a PageDirectives dict or None.
+    """
+    parser = Parser(seed_url, curr_url, run_id=run_id)
+    new_links = parser.crawl() or set()
+    return seed_url, curr_url, new_links, parser.directives_found()
+
 
-def extract_urls(args):
-    """Extract URLs from a webpage"""
-    seed_url, curr_url = args
-    parser = Parser(seed_url, curr_url)
-    new_links = parser.crawl()
-    return new_links
+@profile_job
+def download_and_parse(seed_url: str, page_url: str, run_id: str = None):
+    """
+    Download a page and extract its links in the same job (--fused), so
+    the body goes straight to the parser rather than through the cache
+    and a dependent parse job. Near duplicates of pages already crawled are
+    not parsed. Returns (content, status, new_links, duplicate, directives),
+    where duplicate is (canonical url, distance) or None and directives
+    as returned by extract_urls.
+    """
+    # Unwrapped, as this job is already being profiled if requested
+    content, status = download_page.__wrapped__(seed_url, page_url, run_id)
+    new_links, duplicate, directives = set(), None, None
+    if content is not None and str(status) == "200":
+        parser = Parser(seed_url, page_url, run_id=run_id)
+        near_duplicates = get_near_duplicate_index(
+            parser.redis_conn, run_id, parser.metrics
+        )
+        if near_duplicates is not None:
+            with parser.metrics.timer("fingerprint"):
+                duplicate = near_duplicates.check(page_url, content)
+        if duplicate is None:
+            new_links = parser.crawl(content=content) or set()
+            directives = parser.directives_found()
+    return content, status, new_links, duplicate, directives
 
 
 if __name__ == "__main__":
-    extract_urls("https://www.google.com")
+    extract_urls("https://www.google.com", "https://www.google.com")
@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import argparse
+import cProfile
+import functools
+import glob
+import io
+import os
+import pstats
+import sys
+import tracemalloc
+from collections import defaultdict
+
+from rq import get_current_job
+
+cwd = os.getcwd()
+loc = os.path.dirname(__file__)
+sys.path.append(loc)
+
+from config.configuration import get_logger  # noqa
+from utils import get_run_dir  # noqa
+
+logger = get_logger(__name__)
+
+# Frames kept per allocation, more frames give better attribution but cost more
+TRACEMALLOC_FRAMES = 10
+
+
+def profile_dir(run_id: str) -> str:
+    return os.path.join(get_run_dir(run_id), "profiles")
+
+
+def profile_job(func):
+    """
+    Profile an RQ job function when the job was enqueued with profiling
+    requested in its meta (see Manager.enqueue). Otherwise the function
+    is called directly, so the wrapper costs nothing in normal runs.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        job = get_current_job()
+        options = job.meta.get("profile") if job is not None else None
+        if not options:
+            return func(*args, **kwargs)
+
+        out_dir = profile_dir(job.meta["run_id"])
+        os.makedirs(out_dir, exist_ok=True)
+        # A retried or requeued job runs again under the same id (see
+        # retry_policy.py), so each run gets its own files
+        run = job.meta.get("attempts", 0) + job.meta.get("busy_requeues", 0)
+        base_path = os.path.join(out_dir, f"{func.__name__}-{job.id}-{run}")
+        trace_memory = options.get("memory", False) and not tracemalloc.is_tracing()
+        if trace_memory:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            profiler.dump_stats(f"{base_path}.prof")
+            if trace_memory:
+                snapshot = tracemalloc.take_snapshot().filter_traces(
+                    [tracemalloc.Filter(False, tracemalloc.__file__)]
+                )
+                tracemalloc.stop()
+                snapshot.dump(f"{base_path}.snap")
+
+    return wrapper
+
+
+def _cpu_report(prof_files: list[str], top: int) -> str:
+    stream = io.StringIO()
+    stats = pstats.Stats(*prof_files, stream=stream)
+    stats.strip_dirs()
+    for sort_key in ["cumulative", "tottime"]:
+        stream.write(f"\n--- Top {top} functions by {sort_key} ---\n")
+        stats.sort_stats(sort_key).print_stats(top)
+    return stream.getvalue()
+
+
+def _memory_report(snap_files: list[str], top: int) -> str:
+    """Sum the live allocations per source line across all job snapshots"""
+    sizes, counts = defaultdict(int), defaultdict(int)
+    for snap_file in snap_files:
+        snapshot = tracemalloc.Snapshot.load(snap_file)
+        for stat in snapshot.statistics("lineno"):
+            frame = stat.traceback[0]
+            key = f"{frame.filename}:{frame.lineno}"
+            sizes[key] += stat.size
+            counts[key] += stat.count
+    lines = [f"\n--- Top {top} allocation sites over {len(snap_files)} jobs ---"]
+    for key in sorted(sizes, key=sizes.get, reverse=True)[:top]:
+        lines.append(f"{sizes[key] / 1024:10.1f} KiB {counts[key]:8d} blocks  {key}")
+    return "\n".join(lines) + "\n"
+
+
+def build_report(run_id: str, top: int = 30) -> str | None:
+    """
+    Merge the per-job profiles of a run into a single report, grouped by
+    job function, written to <run_dir>/profile_report.txt.
+    """
+    out_dir = profile_dir(run_id)
+    prof_files = glob.glob(os.path.join(out_dir, "*.prof"))
+    if not prof_files:
+        logger.info(f"No profiles recorded for run {run_id}")
+        return None
+    by_function = defaultdict(list)
+    for prof_file in prof_files:
+        by_function[os.path.basename(prof_file).split("-", 1)[0]].append(prof_file)
+
+    sections = []
+    for func_name, files in sorted(by_function.items()):
+        sections.append(f"===== {func_name} ({len(files)} jobs) =====")
+        sections.append(_cpu_report(files, top))
+        snap_files = [
+            file.replace(".prof", ".snap")
+            for file in files
+            if os.path.exists(file.replace(".prof", ".snap"))
+        ]
+        if snap_files:
+            sections.append(_memory_report(snap_files, top))
+
+    report_path = os.path.join(get_run_dir(run_id), "profile_report.txt")
+    with open(report_path, "w") as f:
+        f.write("\n".join(sections))
+    logger.info(f"Wrote profile report for {len(prof_files)} jobs to {report_path}")
+    return report_path
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Merge a run's job profiles")
+    arg_parser.add_argument("run_id", help="Run to report on")
+    arg_parser.add_argument("--top", type=int, default=30, help="Rows per section")
+    args = arg_parser.parse_args()
+    build_report(args.run_id, args.top)
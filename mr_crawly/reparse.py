@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import os
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict
+from parser import extract_page
+
+import redis
+from blob_store import BlobStore
+from bs4 import BeautifulSoup
+from cache import URLCache
+from config.configuration import get_logger
+from scope import Scope, ScopeRules, load_scope_rules
+from utils import DATA_DIR, get_run_dir
+
+logger = get_logger(__name__)
+
+# Set in each pool process by _init_worker
+_blob_store = None
+_scope_rules = None
+_scopes = {}
+
+
+def _init_worker(blob_root: str, scope_rules: ScopeRules):
+    global _blob_store, _scope_rules
+    _blob_store = BlobStore(blob_root)
+    _scope_rules = scope_rules
+
+
+def _reparse_chunk(chunk: list[tuple[str, str, str]]) -> list[tuple]:
+    """
+    Extract the links and directives from a chunk of (seed_url, url,
+    content_hash) rows. Bodies are read from the blob store here, so only
+    hashes are sent to the pool and only links and directives come back.
+    """
+    results = []
+    for seed_url, url, content_hash in chunk:
+        content = _blob_store.get(content_hash)
+        if content is None:
+            continue
+        scope = _scopes.get(seed_url)
+        if scope is None:
+            scope = _scopes[seed_url] = Scope(seed_url, _scope_rules)
+        soup = BeautifulSoup(content, "html.parser")
+        links, directives = extract_page(url, soup, scope)
+        # As parser.Parser.directives_found, pages that set none aren't recorded
+        directives = asdict(directives) if directives.any() else None
+        results.append((seed_url, url, links, directives))
+    return results
+
+
+class RunReparser:
+    """
+    Re-extracts the links and directives of a stored run with the current
+    parsing code, from the bodies kept in the blob store, and rewrites the
+    run's links and page_directives tables. Pages are parsed as the crawl
+    parsed them: within the scope the run was started with (read from its
+    settings in redis, when redis_conn is given) and skipping the near
+    duplicates it didn't expand. Nothing else touches the network, redis
+    or rq, so a run is reparsed as fast as the pool's processes can parse.
+    """
+
+    def __init__(
+        self,
+        run_id: str,
+        workers: int | None = None,
+        chunk_size: int = 200,
+        batch_size: int = 10_000,
+        scope_rules: ScopeRules = None,
+        redis_conn: redis.Redis = None,
+    ):
+        self.run_id = run_id
+        self.workers = workers or os.cpu_count()
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        db_path = os.path.join(get_run_dir(run_id), "sqlite.db")
+        if not os.path.exists(db_path):
+            raise FileNotFoundError(f"No sqlite.db found for run {run_id}")
+        self.conn = sqlite3.connect(db_path)
+        self.scope_rules = scope_rules or self._run_scope_rules(redis_conn)
+
+    def _run_scope_rules(self, redis_conn: redis.Redis | None) -> ScopeRules:
+        """The scope rules the run was crawled with, see scope.load_scope"""
+        cache = URLCache(redis_conn) if redis_conn is not None else None
+        try:
+            if cache is not None and cache.get_run_settings(self.run_id):
+                return load_scope_rules(cache, self.run_id)
+        except redis.RedisError as e:
+            logger.warning(f"Could not read run {self.run_id}'s settings: {e}")
+        logger.warning(
+            f"No stored settings for run {self.run_id}, "
+            "reparsing with the scope in config.toml"
+        )
+        return ScopeRules.from_config()
+
+    def _table_exists(self, table: str) -> bool:
+        row = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone()
+        return row is not None
+
+    def _default_seed(self) -> str | None:
+        """Rows stored before url_html had a seed_url belong to the run's seed"""
+        rows = self.conn.execute("SELECT DISTINCT seed_url FROM runs").fetchall()
+        return rows[0][0] if len(rows) == 1 else None
+
+    def _chunks(self):
+        """Stream (seed_url, url, content_hash) rows of the parsed pages"""
+        default_seed = self._default_seed()
+        # The crawl doesn't parse near duplicates, see near_duplicates.py
+        skip_duplicates = ""
+        if self._table_exists("near_duplicates"):
+            skip_duplicates = "AND url NOT IN (SELECT url FROM near_duplicates)"
+        cursor = self.conn.execute(
+            f"""SELECT seed_url, url, content_hash FROM url_html
+                WHERE content_hash IS NOT NULL AND CAST(status AS TEXT) = '200'
+                {skip_duplicates}
+                ORDER BY rowid"""
+        )
+        while True:
+            rows = cursor.fetchmany(self.chunk_size)
+            if not rows:
+                break
+            yield [
+                (seed_url or default_seed or url, url, content_hash)
+                for seed_url, url, content_hash in rows
+            ]
+
+    def _results(self, executor):
+        """
+        Yield each page's links and directives in table order, keeping
+        only a few chunks per process in flight so memory stays flat
+        however large the run.
+        """
+        pending = deque()
+        for chunk in self._chunks():
+            pending.append(executor.submit(_reparse_chunk, chunk))
+            if len(pending) >= self.workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+    def reparse(self) -> dict[str, int]:
+        """
+        Replace the links and page_directives tables with freshly extracted
+        ones. The tables are rewritten in a single transaction (in batches
+        of batch_size rows), so an interrupted reparse leaves the previous
+        links in place.
+        """
+        start = time.perf_counter()
+        pages, links, batch, directives = 0, 0, [], []
+        has_directives = self._table_exists("page_directives")
+        with (
+            ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_worker,
+                initargs=(os.path.join(DATA_DIR, "blobs"), self.scope_rules),
+            ) as executor,
+            self.conn,
+        ):
+            self.conn.execute("DELETE FROM links")
+            if has_directives:
+                self.conn.execute("DELETE FROM page_directives")
+            for seed_url, url, page_links, page_directives in self._results(executor):
+                pages += 1
+                batch.extend((seed_url, url, link) for link in page_links)
+                if page_directives is not None and has_directives:
+                    directives.append((url, page_directives))
+                if len(batch) >= self.batch_size:
+                    links += self._write(batch)
+                    batch = []
+                if len(directives) >= self.batch_size:
+                    self._write_directives(directives)
+                    directives = []
+                if pages % 10_000 == 0:
+                    logger.info(f"Reparsed {pages} pages of run {self.run_id}")
+            links += self._write(batch)
+            self._write_directives(directives)
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"Reparsed {pages} pages into {links} links in {elapsed:.1f}s "
+            f"({pages / elapsed if elapsed else 0:.0f} pages/s)"
+        )
+        return {"pages": pages, "links": links}
+
+    def _write(self, batch: list[tuple[str, str, str]]) -> int:
+        self.conn.executemany(
+            """INSERT OR IGNORE INTO links (seed_url, source_url, linked_url)
+               VALUES (?, ?, ?)""",
+            batch,
+        )
+        return len(batch)
+
+    def _write_directives(self, batch: list[tuple[str, dict]]):
+        """Insert pages' directives, as data.UrlTable.store_directives"""
+        self.conn.executemany(
+            """INSERT OR REPLACE INTO page_directives
+               (url, run_id, canonical_url, noindex, nofollow, nofollow_links)
+               VALUES (?, ?, ?, ?, ?, ?)""",
+            [
+                (
+                    url,
+                    self.run_id,
+                    directives["canonical_url"],
+                    directives["noindex"],
+                    directives["nofollow"],
+                    directives["nofollow_links"],
+                )
+                for url, directives in batch
+            ],
+        )
+
+
+def reparse_run(
+    run_id: str,
+    workers: int | None = None,
+    chunk_size: int = 200,
+    redis_conn: redis.Redis = None,
+) -> dict[str, int]:
+    """Re-extract a stored run's links and directives with the current parser"""
+    return RunReparser(
+        run_id, workers=workers, chunk_size=chunk_size, redis_conn=redis_conn
+    ).reparse()
@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import json
+import math
+import random
+import socket
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from enum import Enum
+
+import redis
+import requests
+from config.configuration import get_config, get_logger
+from host_limiter import HostBusy
+from rq.timeouts import JobTimeoutException
+
+logger = get_logger(__name__)
+
+
+class FailureClass(Enum):
+    """Enum for the kinds of job failure that are retried differently"""
+
+    PERMANENT = "permanent"
+    THROTTLED = "throttled"
+    BUSY = "busy"
+    TIMEOUT = "timeout"
+    DNS = "dns"
+    CONNECTION = "connection"
+    SERVER = "server"
+    PARSE = "parse"
+    UNKNOWN = "unknown"
+
+
+@dataclass
+class BackoffRule:
+    """How often, and how far apart, a class of failure is retried"""
+
+    max_retries: int
+    base_delay: float = 10
+    max_delay: float = 300
+
+
+DEFAULT_RULES = {
+    # 4xx other than 408/429, and robots denials, will not change on retry
+    FailureClass.PERMANENT: BackoffRule(max_retries=0),
+    FailureClass.THROTTLED: BackoffRule(max_retries=5, base_delay=30, max_delay=900),
+    # Our own per host limit was full, requeued promptly and counted apart
+    # from the page's retries
+    FailureClass.BUSY: BackoffRule(max_retries=100, base_delay=1, max_delay=10),
+    FailureClass.TIMEOUT: BackoffRule(max_retries=3, base_delay=10, max_delay=120),
+    FailureClass.DNS: BackoffRule(max_retries=2, base_delay=60, max_delay=300),
+    FailureClass.CONNECTION: BackoffRule(max_retries=3, base_delay=10, max_delay=120),
+    FailureClass.SERVER: BackoffRule(max_retries=3, base_delay=15, max_delay=300),
+    # The page is already cached, parsing it again gives the same result
+    FailureClass.PARSE: BackoffRule(max_retries=0),
+    FailureClass.UNKNOWN: BackoffRule(max_retries=3, base_delay=10, max_delay=60),
+}
+
+
+def dead_letter_key(run_id: str) -> str:
+    return f"{run_id}:dead_letter"
+
+
+def parse_retry_after(value: str | None, now: datetime = None) -> float | None:
+    """Parse a Retry-After header, given either in seconds or as an http date"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    now = now or datetime.now(timezone.utc)
+    return max((retry_at - now).total_seconds(), 0.0)
+
+
+def _exception_chain(exc: BaseException):
+    """
+    Yield the exception and everything it wraps. requests hides the
+    underlying error in args (ConnectionError(MaxRetryError(...))) and
+    urllib3 in .reason, as well as in __cause__.
+    """
+    seen, pending = set(), [exc]
+    while pending:
+        current = pending.pop()
+        if not isinstance(current, BaseException) or id(current) in seen:
+            continue
+        seen.add(id(current))
+        yield current
+        pending.extend([current.__cause__, current.__context__])
+        pending.extend(current.args)
+        pending.append(getattr(current, "reason", None))
+
+
+def classify(exc_value: BaseException, stage: str = None) -> FailureClass:
+    """Map the exception a job raised to the class of failure it represents"""
+    if isinstance(exc_value, requests.HTTPError) and exc_value.response is not None:
+        status = exc_value.response.status_code
+        if status in (429, 503):
+            return FailureClass.THROTTLED
+        if status == 408:
+            return FailureClass.TIMEOUT
+        if 400 <= status < 500:
+            return FailureClass.PERMANENT
+        return FailureClass.SERVER
+    if isinstance(exc_value, HostBusy):
+        return FailureClass.BUSY
+    if isinstance(exc_value, (requests.Timeout, JobTimeoutException)):
+        return FailureClass.TIMEOUT
+    if any(isinstance(exc, socket.gaierror) for exc in _exception_chain(exc_value)):
+        return FailureClass.DNS
+    if isinstance(exc_value, (requests.ConnectionError, redis.ConnectionError)):
+        return FailureClass.CONNECTION
+    invalid_request = (requests.exceptions.InvalidURL, requests.TooManyRedirects)
+    if isinstance(exc_value, invalid_request):
+        return FailureClass.PERMANENT
+    if stage == "parse":
+        return FailureClass.PARSE
+    return FailureClass.UNKNOWN
+
+
+@dataclass
+class RetryDecision:
+    failure_class: FailureClass
+    attempt: int
+    # Seconds until the retry, or None if the job has been given up on
+    delay: float | None
+
+
+class RetryPolicy:
+    """
+    Decides whether, and when, a failed job is retried. Backoff is
+    exponential per failure class with jitter, so that pages that failed
+    together are not all retried in the same instant, and a throttled
+    host's Retry-After is treated as the minimum delay.
+    """
+
+    def __init__(
+        self,
+        rules: dict[FailureClass, BackoffRule] = None,
+        jitter: float = 0.5,
+        max_retry_after: float = 3600,
+    ):
+        self.rules = dict(DEFAULT_RULES)
+        self.rules.update(rules or {})
+        self.jitter = jitter
+        self.max_retry_after = max_retry_after
+
+    @classmethod
+    def from_config(cls, default_retries: int = None) -> RetryPolicy:
+        """
+        Build a policy from the [retry] section of config.toml, e.g.
+        [retry.throttled] max_retries = 5. default_retries (the --retries
+        flag) applies to failures that could not be classified.
+        """
+        retry_config = get_config().get("retry", {})
+        rules = {}
+        for failure_class in FailureClass:
+            rule = DEFAULT_RULES[failure_class]
+            overrides = retry_config.get(failure_class.value, {})
+            rules[failure_class] = BackoffRule(
+                max_retries=overrides.get("max_retries", rule.max_retries),
+                base_delay=overrides.get("base_delay", rule.base_delay),
+                max_delay=overrides.get("max_delay", rule.max_delay),
+            )
+        if default_retries is not None and "unknown" not in retry_config:
+            rules[FailureClass.UNKNOWN].max_retries = default_retries
+        return cls(
+            rules,
+            jitter=retry_config.get("jitter", 0.5),
+            max_retry_after=retry_config.get("max_retry_after", 3600),
+        )
+
+    def backoff(self, rule: BackoffRule, attempt: int) -> float:
+        """Exponential backoff, reduced by up to `jitter` of itself at random"""
+        delay = min(rule.max_delay, rule.base_delay * 2**attempt)
+        return delay * (1 - self.jitter * random.random())
+
+    def decide(
+        self, exc_value: BaseException, attempt: int, stage: str = None
+    ) -> RetryDecision:
+        """
+        attempt is the number of times the job has already been retried,
+        or for a busy host requeued
+        """
+        failure_class = classify(exc_value, stage)
+        rule = self.rules[failure_class]
+        if attempt >= rule.max_retries:
+            return RetryDecision(failure_class, attempt, None)
+        delay = self.backoff(rule, attempt)
+        if failure_class == FailureClass.THROTTLED:
+            response = getattr(exc_value, "response", None)
+            retry_after = parse_retry_after(
+                response.headers.get("Retry-After") if response is not None else None
+            )
+            if retry_after is not None:
+                if retry_after > self.max_retry_after:
+                    # The host is asking us to go away for longer than a crawl
+                    return RetryDecision(failure_class, attempt, None)
+                delay = max(delay, retry_after)
+        return RetryDecision(failure_class, attempt, delay)
+
+    def apply(self, job, exc_value: BaseException, stage: str = None) -> RetryDecision:
+        """
+        Decide on a failed job from inside its failure callback. rq checks
+        job.retries_left after the callback returns, and schedules the job
+        (keeping its id, so dependent jobs still wait on it) after the
+        first of job.retry_intervals.
+        """
+        # Waiting for a slot on a busy host is not a failed attempt at the page
+        busy = classify(exc_value, stage) == FailureClass.BUSY
+        counter = "busy_requeues" if busy else "attempts"
+        attempt = job.meta.get(counter, 0)
+        decision = self.decide(exc_value, attempt, stage)
+        job.meta[counter] = attempt + 1
+        job.meta["failure_class"] = decision.failure_class.value
+        if decision.delay is None:
+            job.retries_left = 0
+        else:
+            job.retries_left = 1
+            job.retry_intervals = [max(1, math.ceil(decision.delay))]
+        return decision
+
+
+def push_dead_letter(
+    redis_conn: redis.Redis,
+    run_id: str,
+    url: str,
+    stage: str,
+    decision: RetryDecision,
+    exc_value: BaseException,
+):
+    """Record a job that will not be retried, for the manager to store"""
+    response = getattr(exc_value, "response", None)
+    entry = {
+        "url": url,
+        "stage": stage,
+        "failure_class": decision.failure_class.value,
+        "attempts": decision.attempt + 1,
+        "status": getattr(response, "status_code", None),
+        "error": f"{type(exc_value).__name__}: {exc_value}",
+    }
+    redis_conn.rpush(dead_letter_key(run_id), json.dumps(entry))
+
+
+def pop_dead_letters(redis_conn: redis.Redis, run_id: str, count: int = 500):
+    entries = redis_conn.lpop(dead_letter_key(run_id), count) or []
+    return [json.loads(entry) for entry in entries]
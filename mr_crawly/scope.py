@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import fnmatch
+import os
+import re
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit
+
+from config.configuration import get_config
+
+# Patterns starting with this are regular expressions, anything else is a glob
+REGEX_PREFIX = "re:"
+SCHEMES = ("http", "https")
+
+
+@dataclass
+class ScopeRules:
+    """
+    What a crawl may follow, see [scope] in config.toml. allow and deny
+    patterns are matched against a url's path and query, e.g. "/docs/*"
+    or "re:^/(en|de)/". With allow patterns, only matching urls are in
+    scope; deny patterns take precedence over allow.
+    """
+
+    allow: list[str] = field(default_factory=list)
+    deny: list[str] = field(default_factory=list)
+    # Path segments below the seed's directory, 0 for no limit
+    max_depth: int = 0
+    include_subdomains: bool = False
+    deny_extensions: list[str] = field(default_factory=list)
+
+    @classmethod
+    def from_config(cls, overrides: dict = None) -> ScopeRules:
+        """
+        Rules from config.toml, with overrides (from the command line)
+        adding to the pattern lists and replacing everything else.
+        """
+        rules = dict(get_config().get("scope", {}))
+        for key, value in (overrides or {}).items():
+            if key in ("allow", "deny", "deny_extensions"):
+                rules[key] = [*rules.get(key, []), *value]
+            elif value is not None:
+                rules[key] = value
+        return cls(**rules)
+
+
+def compile_patterns(patterns: list[str]) -> re.Pattern | None:
+    """Combine globs and regexes into a single alternation, None if empty"""
+    if not patterns:
+        return None
+    parts = []
+    for pattern in patterns:
+        if pattern.startswith(REGEX_PREFIX):
+            # Regexes may match anywhere, globs must match the whole target
+            parts.append(f"(?:.*?(?:{pattern[len(REGEX_PREFIX) :]}))")
+        else:
+            parts.append(f"(?:{fnmatch.translate(pattern)})")
+    return re.compile("|".join(parts))
+
+
+def _strip_www(host: str) -> str:
+    return host[4:] if host.startswith("www.") else host
+
+
+class Scope:
+    """
+    A seed's compiled scope rules. Links are checked against the seed
+    rather than the page they were found on, so that a crawl never
+    drifts off site by way of a page that was itself off site.
+    """
+
+    def __init__(self, seed_url: str, rules: ScopeRules = None):
+        self.rules = rules or ScopeRules()
+        seed = urlsplit(seed_url)
+        # www.example.com and example.com are treated as the same site
+        self.site = _strip_www(seed.netloc.lower())
+        seed_dir = seed.path.rsplit("/", 1)[0]
+        self.seed_depth = len([segment for segment in seed_dir.split("/") if segment])
+        self.seed_dir = seed_dir + "/"
+        self.allow = compile_patterns(self.rules.allow)
+        self.deny = compile_patterns(self.rules.deny)
+        self.deny_extensions = {
+            ext.lower() if ext.startswith(".") else f".{ext.lower()}"
+            for ext in self.rules.deny_extensions
+        }
+
+    def host_in_scope(self, host: str) -> bool:
+        host = _strip_www(host)
+        if host == self.site:
+            return True
+        return self.rules.include_subdomains and host.endswith(f".{self.site}")
+
+    def depth(self, path: str) -> int:
+        """Path segments below the seed's directory (or the root, if not below it)"""
+        depth = len([segment for segment in path.split("/") if segment])
+        if path.startswith(self.seed_dir):
+            depth -= self.seed_depth
+        return depth
+
+    def reason(self, url: str) -> str | None:
+        """Why the url is out of scope, or None if it is in scope"""
+        parts = urlsplit(url)
+        if parts.scheme not in SCHEMES:
+            return "scheme"
+        if not self.host_in_scope(parts.netloc.lower()):
+            return "host"
+        path = parts.path or "/"
+        if os.path.splitext(path)[1].lower() in self.deny_extensions:
+            return "extension"
+        if self.rules.max_depth and self.depth(path) > self.rules.max_depth:
+            return "depth"
+        target = f"{path}?{parts.query}" if parts.query else path
+        if self.deny is not None and self.deny.match(target):
+            return "deny"
+        if self.allow is not None and not self.allow.match(target):
+            return "allow"
+        return None
+
+    def filter(self, urls) -> list[str]:
+        """The urls that are in scope"""
+        return [url for url in urls if self.reason(url) is None]
+
+
+def load_scope_rules(cache, run_id: str | None) -> ScopeRules:
+    """The scope rules, with the overrides the run was started with"""
+    overrides = None
+    if run_id is not None:
+        overrides = cache.get_run_settings(run_id).get("scope")
+    return ScopeRules.from_config(overrides)
+
+
+def load_scope(cache, run_id: str | None, seed_url: str) -> Scope:
+    """A seed's scope, with the overrides the run was started with"""
+    return Scope(seed_url, load_scope_rules(cache, run_id))
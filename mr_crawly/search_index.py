@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+import json
+import re
+import sqlite3
+
+import redis
+from bs4 import BeautifulSoup
+from config.configuration import get_logger
+
+logger = get_logger(__name__)
+
+# Tags whose text is never rendered in the page body
+INVISIBLE_TAGS = ["script", "style", "noscript", "template", "svg", "head", "title"]
+WHITESPACE = re.compile(r"\s+")
+
+
+def search_queue_key(run_id: str) -> str:
+    """Redis list the parse workers push extracted documents onto"""
+    return f"{run_id}:search_docs"
+
+
+def extract_text(soup: BeautifulSoup) -> tuple[str, str]:
+    """
+    Returns the (title, visible text) of an already parsed page.
+    Note: invisible tags are removed from the soup in the process.
+    """
+    title = soup.title.get_text(" ", strip=True) if soup.title else ""
+    for tag in soup(INVISIBLE_TAGS):
+        tag.decompose()
+    text = WHITESPACE.sub(" ", soup.get_text(" ", strip=True))
+    return title, text
+
+
+def plain_query(terms: str) -> str:
+    """
+    An FTS5 query matching pages with all of the given words, each quoted
+    so characters FTS5 treats as syntax (-, +, ", :, ...) are searched for
+    """
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms.split())
+
+
+def queue_document(redis_conn: redis.Redis, run_id: str, url: str, soup) -> None:
+    """Hand a parsed page's text off to the indexer"""
+    title, text = extract_text(soup)
+    doc = json.dumps({"url": url, "title": title, "text": text})
+    redis_conn.rpush(search_queue_key(run_id), doc)
+
+
+class SearchIndex:
+    """
+    SQLite FTS5 index over the visible text of crawled pages.
+    search_docs assigns each url a stable rowid, so re-indexing a page
+    replaces its previous entry rather than duplicating it.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.create_tables()
+
+    def create_tables(self):
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS search_docs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL UNIQUE,
+                indexed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """
+        )
+        self.conn.execute(
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS page_text USING fts5(
+                title,
+                body,
+                tokenize = 'porter unicode61'
+            )
+        """
+        )
+        self.conn.commit()
+
+    def add_documents(self, docs: list[dict]) -> int:
+        """Index a batch of {url, title, text} documents in one transaction"""
+        if not docs:
+            return 0
+        urls = [doc["url"] for doc in docs]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO search_docs (url) VALUES (?)",
+                [(url,) for url in urls],
+            )
+            placeholders = ", ".join("?" for _ in urls)
+            ids = dict(
+                self.conn.execute(
+                    f"SELECT url, id FROM search_docs WHERE url IN ({placeholders})",
+                    urls,
+                ).fetchall()
+            )
+            rows = [(ids[doc["url"]], doc["title"], doc["text"]) for doc in docs]
+            self.conn.executemany(
+                "DELETE FROM page_text WHERE rowid = ?", [(row[0],) for row in rows]
+            )
+            self.conn.executemany(
+                "INSERT INTO page_text (rowid, title, body) VALUES (?, ?, ?)", rows
+            )
+        return len(rows)
+
+    def drain(self, redis_conn: redis.Redis, run_id: str, batch_size: int = 500):
+        """Index everything the parse workers have queued, batch_size at a time"""
+        key = search_queue_key(run_id)
+        total = 0
+        while True:
+            raw_docs = redis_conn.lpop(key, batch_size)
+            if not raw_docs:
+                break
+            # A url may be queued more than once in a batch, keep the latest
+            docs = {}
+            for raw_doc in raw_docs:
+                doc = json.loads(raw_doc)
+                docs[doc["url"]] = doc
+            total += self.add_documents(list(docs.values()))
+        if total:
+            logger.info(f"Indexed {total} pages for search")
+        return total
+
+    def search(self, query: str, limit: int = 10, plain: bool = False) -> list[tuple]:
+        """
+        Returns (url, title, snippet, score) for the best matches, best
+        first. query is in FTS5 syntax, or with plain, a list of words.
+        Raises sqlite3.OperationalError for queries FTS5 can't parse.
+        """
+        if plain:
+            query = plain_query(query)
+        return self.conn.execute(
+            """
+            SELECT search_docs.url,
+                   page_text.title,
+                   snippet(page_text, 1, '[', ']', '...', 16),
+                   bm25(page_text, 5.0, 1.0) AS score
+            FROM page_text
+            JOIN search_docs ON search_docs.id = page_text.rowid
+            WHERE page_text MATCH ?
+            ORDER BY score
+            LIMIT ?
+            """,
+            (query, limit),
+        ).fetchall()
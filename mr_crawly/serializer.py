@@ -0,0 +1,28 @@
+from __future__ import annotations
+
+import msgpack
+
+
+def _default(obj):
+    """Encode the types msgpack has no mapping for"""
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    # e.g. datetimes in sitemap details, as json.dump(default=str) would
+    return str(obj)
+
+
+class MsgpackSerializer:
+    """
+    rq serializer for job args, meta and results. Job payloads are a few
+    integer ids (see jobs.py), which msgpack encodes in a handful of bytes
+    where pickle spends most of a job's data on framing and type names.
+    Tuples come back as lists, and sets as lists.
+    """
+
+    @staticmethod
+    def dumps(obj) -> bytes:
+        return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+    @staticmethod
+    def loads(data: bytes):
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
@@ -1,12 +1,30 @@
 from __future__ import annotations
 
+import os
+import threading
+from contextlib import nullcontext
 from urllib.parse import urlparse
 from urllib.robotparser import RobotFileParser
 
 import redis
 import requests
 from cache import URLCache
-from config.configuration import get_logger
+from config.configuration import get_config, get_logger
+from dns_cache import install_dns_cache
+from host_limiter import get_host_limiter
+from metrics import get_metrics
+from profiling import profile_job
+from utils import get_run_dir
+from warc_writer import WarcWriter
+
+
+def response_outcome(status: int) -> str:
+    """How a response status feeds back into the host's concurrency limit"""
+    if status in (429, 503):
+        return "throttled"
+    if status >= 500:
+        return "error"
+    return "ok"
 
 
 class SiteDownloader:
@@ -15,9 +33,13 @@ class SiteDownloader:
         page_url: str,
         host="localhost",
         port=7777,
+        run_id: str = None,
     ):
         self.page_url = page_url
-        self.robot_parser = RobotFileParser()
+        # robots.txt is parsed once per host. Site mapping checks urls from
+        # several threads, so parsers are created under a lock and then shared
+        self.robot_parsers: dict[str, RobotFileParser] = {}
+        self.robots_lock = threading.Lock()
         self.logger = get_logger("crawler")
         self.host = host
         self.port = port
@@ -32,6 +54,11 @@ class SiteDownloader:
         self.port = port
         self.redis_conn = redis.Redis(host=host, port=port, decode_responses=False)
         self.cache = URLCache(self.redis_conn)
+        self.metrics = get_metrics(self.redis_conn, run_id)
+        self.host_limiter = get_host_limiter(self.redis_conn, self.metrics)
+        # Once per process, requests then resolves hosts through the cache
+        install_dns_cache(self.redis_conn, self.metrics)
+        self.last_response = None
         # self.frontier_urls = self.cache.get_frontier_seeds(self.seed_url)
 
     def save_html(self, html: str, filename: str):
@@ -39,32 +66,101 @@ class SiteDownloader:
             f.write(html)
 
     # Politeness
+    def robot_parser(self, scheme: str, netloc: str) -> RobotFileParser:
+        """Returns the host's parsed robots.txt, reading it on first use"""
+        with self.robots_lock:
+            robot_parser = self.robot_parsers.get(netloc)
+            if robot_parser is None:
+                robot_parser = RobotFileParser(f"{scheme}://{netloc}/robots.txt")
+                with self.metrics.timer("robots_check"):
+                    robot_parser.read()
+                # Not stored if read() raised, so it's tried again next time
+                self.robot_parsers[netloc] = robot_parser
+        return robot_parser
+
     def can_fetch(self, url: str) -> bool:
         """Check if we're allowed to crawl this URL according to robots.txt"""
         parsed_url = urlparse(url)
-        robots_url = f"{parsed_url.scheme}://{parsed_url.netloc}/robots.txt"
         try:
-            self.robot_parser.set_url(robots_url)
-            self.robot_parser.read()
-            return self.robot_parser.can_fetch("*", url) or "sitemap" in url
+            robot_parser = self.robot_parser(parsed_url.scheme, parsed_url.netloc)
+            return robot_parser.can_fetch("*", url) or "sitemap" in url
         except Exception as e:
             self.logger.warning(f"Error checking robots.txt for {url}: {e}")
             return True  # If we can't check robots.txt, we probably want to set a reasonable default
 
+    def limit(self, host: str):
+        """Hold one of the host's request slots, see host_limiter.py"""
+        if self.host_limiter is None:
+            return nullcontext()
+        return self.host_limiter.slot(host)
+
+    def record_response(self, host: str, outcome: str, elapsed=None):
+        if self.host_limiter is None:
+            return
+        latency = elapsed.total_seconds() if elapsed is not None else None
+        self.host_limiter.record(host, outcome, latency)
+
     def get_page_elements(self, url: str) -> set[str]:
         """Get the page elements from a webpage"""
+        host = urlparse(url).netloc
         if not self.can_fetch(url):
-            self.logger.info(f"Skipping {url} (not allowed by robots.txt)")
+            self.logger.info("Skipping %s (not allowed by robots.txt)", url)
+            self.metrics.inc("pages_total", host=host, status="robots_denied")
             return None, "403"
 
-        response = requests.get(url, timeout=10)
-        self.logger.debug(f"Getting elements for: {url}")
+        try:
+            with self.limit(host), self.metrics.timer("download"):
+                response = requests.get(url, timeout=10)
+        except requests.RequestException as e:
+            self.metrics.inc("pages_total", host=host, status=type(e).__name__)
+            if isinstance(e, (requests.Timeout, requests.ConnectionError)):
+                self.record_response(host, "error")
+            raise
+        self.last_response = response
+        # Time from sending the request to parsing the response headers,
+        # i.e. dns + connect + server time, excluding the body transfer
+        self.metrics.observe("http_response_seconds", response.elapsed.total_seconds())
+        self.metrics.inc("pages_total", host=host, status=response.status_code)
+        self.record_response(
+            host, response_outcome(response.status_code), response.elapsed
+        )
+        self.metrics.inc("bytes_downloaded_total", len(response.content), host=host)
+        self.logger.debug(
+            "Getting elements for: %s", url, extra={"url": url, "stage": "download"}
+        )
         response.raise_for_status()
         return response.text, response.status_code
 
 
-def download_page(seed_url: str, page_url: str):
+# The process's WarcWriter of each run, or None if WARC output is disabled
+_warc_writers: dict[str, WarcWriter | None] = {}
+
+
+def get_warc_writer(run_id: str) -> WarcWriter | None:
+    """Returns the process's WarcWriter for the run, if WARC output is enabled"""
+    if run_id not in _warc_writers:
+        warc_config = get_config().get("warc", {})
+        writer = None
+        if warc_config.get("enabled", False):
+            writer = WarcWriter(
+                os.path.join(get_run_dir(run_id), "warc"),
+                prefix=warc_config.get("prefix", "mr-crawly"),
+                max_file_size=warc_config.get("max_file_size", 1_000_000_000),
+            )
+        _warc_writers[run_id] = writer
+    return _warc_writers[run_id]
+
+
+@profile_job
+def download_page(seed_url: str, page_url: str, run_id: str = None):
     """Get the page from a webpage"""
-    downloader = SiteDownloader(page_url=page_url)
-    results = downloader.get_page_elements(page_url)
+    downloader = SiteDownloader(page_url=page_url, run_id=run_id)
+    try:
+        results = downloader.get_page_elements(page_url)
+    finally:
+        # Archive whatever the server sent back, including error responses
+        response = downloader.last_response
+        warc_writer = get_warc_writer(run_id) if run_id is not None else None
+        if response is not None and warc_writer is not None:
+            warc_writer.write_exchange(response)
     return results
@@ -1,136 +1,329 @@
 from __future__ import annotations
 
+import gzip
+import io
 import os
+import queue
 import sys
+import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree.ElementTree import ParseError, iterparse
 
 import redis
+import requests
 
 cwd = os.getcwd()
 loc = os.path.dirname(os.path.dirname(__file__))
 print(loc)
 sys.path.append(loc)
 
-import bs4  # noqa
-from bs4 import BeautifulSoup  # noqa
 from cache import URLCache  # noqa
-from config.configuration import get_logger  # noqa
+from config.configuration import get_config, get_logger  # noqa
+from incremental import IncrementalPlanner, find_previous_run  # noqa
+from metrics import get_metrics  # noqa
+from profiling import profile_job  # noqa
+from scope import load_scope  # noqa
 from site_downloader import SiteDownloader  # noqa
-from utils import parse_url  # noqa
+from utils import get_run_dir, parse_url  # noqa
+
+from data import SitemapTable  # noqa
+
+GZIP_MAGIC = b"\x1f\x8b"
+# Where sites commonly publish a sitemap without declaring it in robots.txt
+SITEMAP_LOCATIONS = [
+    "sitemap.xml",
+    "sitemap_index.xml",
+    "sitemap-index.xml",
+    "sitemap.xml.gz",
+    "wp-sitemap.xml",
+    "sitemap/sitemap.xml",
+    "sitemaps/sitemap.xml",
+]
+
+
+def local_name(tag: str) -> str:
+    """Strip the xml namespace from a tag, e.g. '{http://...}url' -> 'url'"""
+    return tag.rsplit("}", 1)[-1]
+
+
+def open_sitemap(url: str, timeout: int = 30):
+    """
+    Open a streaming, decompressed file-like object for a sitemap.
+    Handles both transport compression (Content-Encoding) and
+    gzipped sitemap files (e.g. sitemap.xml.gz).
+    """
+    response = requests.get(url, timeout=timeout, stream=True)
+    response.raise_for_status()
+    response.raw.decode_content = True
+    # Keep the raw stream readable at EOF, io.BufferedReader expects it
+    response.raw.auto_close = False
+    stream = io.BufferedReader(response.raw, buffer_size=64 * 1024)
+    if stream.peek(2)[:2] == GZIP_MAGIC:
+        return response, gzip.GzipFile(fileobj=stream)
+    return response, stream
+
+
+def iter_sitemap(stream, source_url: str, index: str | None = None):
+    """
+    Incrementally parse a sitemap or sitemap index, yielding
+    ("url", details) for each <url> and ("sitemap", loc) for each
+    child <sitemap>. Elements are cleared as soon as they are read,
+    so memory use does not grow with the size of the sitemap.
+    """
+    root = None
+    for event, elem in iterparse(stream, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            continue
+        tag = local_name(elem.tag)
+        if tag == "url":
+            fields = {
+                local_name(child.tag): (child.text or "").strip() for child in elem
+            }
+            priority = None
+            if fields.get("priority"):
+                try:
+                    priority = float(fields["priority"])
+                except ValueError:
+                    pass
+            yield (
+                "url",
+                {
+                    "source_url": source_url,
+                    "index": index,
+                    "loc": fields.get("loc"),
+                    "priority": priority,
+                    "frequency": fields.get("changefreq"),
+                    "modified": fields.get("lastmod"),
+                    "status": "Success" if fields.get("loc") else "Parsing Error",
+                },
+            )
+            root.clear()
+        elif tag == "sitemap":
+            child_loc = next(
+                (child.text for child in elem if local_name(child.tag) == "loc"), None
+            )
+            if child_loc:
+                yield "sitemap", child_loc.strip()
+            root.clear()
 
 
 class SiteMapper:
     def __init__(
         self,
         seed_url: str,
+        run_id: str = None,
+        incremental: bool = False,
         parse=True,
         host="localhost",
         port=7777,
     ):
         self.seed_url = seed_url
-        self.seed_url = seed_url
-        self.to_visit: list[str] = [seed_url]
+        self.run_id = run_id
         self.logger = get_logger("crawler")
-        self.results = dict.fromkeys(
-            [
-                "seed_url",
-                "sitemap_index",
-                "sitemap",
-                "max_pages",
-                "delay",
-                "parse",
-                "visited_urls",
-                "to_visit",
-                "robot_parser",
-            ],
-            None,
-        )
-        self.sitemap_details = []
+        sitemap_config = get_config().get("sitemap", {})
+        self.batch_size = sitemap_config.get("batch_size", 1000)
+        self.max_workers = sitemap_config.get("max_workers", 8)
         self.sitemap_indexes = defaultdict(list)
-        self.frontier = []
+        self.entry_count = 0
+        # Entries that made it onto the frontier, after scope and planning
+        self.queued_count = 0
         self.host = host
         self.port = port
         self.redis_conn = redis.Redis(host=host, port=port, decode_responses=False)
         self.cache = URLCache(self.redis_conn)
-        self.downloader = SiteDownloader(page_url=seed_url, host=host, port=port)
+        self.metrics = get_metrics(self.redis_conn, run_id)
+        # Sitemaps can list whole sections the crawl was told to leave out
+        self.scope = load_scope(self.cache, run_id, seed_url)
+        self.downloader = SiteDownloader(
+            page_url=seed_url, host=host, port=port, run_id=run_id
+        )
+        self.sitemap_table = None
+        if run_id is not None:
+            self.sitemap_table = SitemapTable(
+                os.path.join(get_run_dir(run_id), "sqlite.db")
+            )
+        self.planner = None
+        if incremental and run_id is not None:
+            previous_run_id = find_previous_run(seed_url, run_id)
+            if previous_run_id is None:
+                self.logger.info(f"No previous run of {seed_url}, crawling in full")
+            else:
+                self.planner = IncrementalPlanner(
+                    run_id,
+                    previous_run_id,
+                    seed_url=seed_url,
+                    cache=self.cache,
+                    url_filter=self.scope.filter,
+                )
+        # Completed batches wait here for the mapping thread to store them.
+        # It is bounded so fetch threads stall rather than buffer whole sitemaps
+        self.ready_batches = queue.Queue(maxsize=self.max_workers * 2)
 
-    def request_page(self, url: str):
-        """We allow a direct connection here given the limited
-        number of pages we are requesting as part of this process
-        """
-        content, status = self.cache.get_cached_response(url)
-        if content is None:
-            content, req_status = self.downloader.get_page_elements(url)
-            if req_status != 200:
-                return None
-        return content
-
-    # Link Aggregation
-    def process_sitemaps(
-        self, cur_url: str, scheme: str, index: str = None
-    ) -> set[str]:
-        """Extract links from sitemap.xml if available"""
-        contents = self.request_page(cur_url)
-        if contents is None:
-            return None
-        sm_soup = BeautifulSoup(contents, "lxml")
-        if sm_soup.find("sitemapindex") is not None:
-            # Page is a sitemapindex and locs represent more
-            # sitemap urls that need to be passed to the downloader
-            sm_urls = [loc.text for loc in sm_soup.find_all("loc")]
-            self.sitemap_indexes[cur_url].extend(sm_urls)
-            self.logger.info(f"New Sitemap URLs: {sm_urls}")
-            for sm_url in sm_urls:
-                details = self.process_sitemaps(sm_url, scheme, index=cur_url)
+    def store_batch(self, batch: list[dict]):
+        """Write a batch of sitemap entries to sqlite and the crawl frontier"""
+        self.entry_count += len(batch)
+        if self.sitemap_table is None:
+            return
+        with self.metrics.timer("sqlite_write", table="sitemap_data"):
+            self.sitemap_table.store_sitemap_batch(batch)
+        if self.planner is not None:
+            urls = self.planner.plan(batch)
         else:
-            # Page is a sitemap and sites represent
-            # seed urls for the crawler
-            details = defaultdict(list)
-            details["source_url"] = cur_url
-            details["index"] = index
-            url = sm_soup.find("url")
-            if url is not None:
-                try:
-                    details["loc"] = url.loc
-                    details["priority"] = url.priority
-                    details["frequency"] = url.changefreq
-                    details["modified"] = url.lastmod
-                    details["status"] = "Success"
-                except Exception as e:
-                    self.logger.error(f"Error processing sitemap: {e}")
-                    details["status"] = "Parsing Error"
-            for key, value in details.items():
-                if isinstance(value, bs4.element.Tag):
-                    details[key] = value.text
-
-            # Save the sitemap details for the db
-            self.sitemap_indexes[cur_url].append(cur_url)
-            self.sitemap_details.append(dict(details))
-
-            # Push url to the queue to be downloaded
-            self.cache.request_download(details.get("loc"))
-
-    def get_sitemap_urls(self, url: str) -> str:
-        """Process a sitemap index and return all URLs found"""
+            urls = [detail["loc"] for detail in batch if detail["loc"]]
+        self.queued_count += self.cache.push_frontier(
+            self.run_id, self.seed_url, self.scope.filter(urls)
+        )
+
+    def _drain_batches(self, timeout: float = 0.1):
+        try:
+            batch = self.ready_batches.get(timeout=timeout)
+        except queue.Empty:
+            return
+        while batch is not None:
+            self.store_batch(batch)
+            try:
+                batch = self.ready_batches.get_nowait()
+            except queue.Empty:
+                batch = None
+
+    def process_sitemap(self, cur_url: str, index: str = None) -> list[str]:
+        """
+        Stream a single sitemap, queuing its entries in batches.
+        Returns the child sitemap urls if cur_url is a sitemap index.
+        """
+        if not self.downloader.can_fetch(cur_url):
+            self.logger.info(f"Skipping {cur_url} (not allowed by robots.txt)")
+            return []
+        child_sitemaps, batch = [], []
+        try:
+            response, stream = open_sitemap(cur_url)
+            with response:
+                for kind, value in iter_sitemap(stream, cur_url, index):
+                    if kind == "sitemap":
+                        child_sitemaps.append(value)
+                        continue
+                    batch.append(value)
+                    if len(batch) >= self.batch_size:
+                        self.ready_batches.put(batch)
+                        batch = []
+        except (requests.RequestException, ParseError, OSError) as e:
+            self.logger.error(f"Error processing sitemap {cur_url}: {e}")
+        if batch:
+            self.ready_batches.put(batch)
+        if child_sitemaps:
+            self.logger.info(f"{cur_url} lists {len(child_sitemaps)} sitemaps")
+        return child_sitemaps
+
+    def process_sitemaps(self, root_urls: list[str]) -> int:
+        """
+        Walk sitemap indexes breadth first, fetching sibling sitemaps
+        concurrently. Returns the number of url entries found.
+        """
+        start = time.time()
+        # Roots often overlap (e.g. robots.txt lists an index that a probed
+        # sitemap.xml also points to), so each sitemap is only read once
+        seen = set(root_urls)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = {
+                executor.submit(self.process_sitemap, url, "root"): url
+                for url in root_urls
+            }
+            while pending:
+                self._drain_batches()
+                for future in [future for future in pending if future.done()]:
+                    cur_url = pending.pop(future)
+                    for child_url in future.result():
+                        self.sitemap_indexes[cur_url].append(child_url)
+                        if child_url in seen:
+                            continue
+                        seen.add(child_url)
+                        pending[
+                            executor.submit(self.process_sitemap, child_url, cur_url)
+                        ] = child_url
+        self._drain_batches(timeout=0)
+        if self.planner is not None:
+            self.planner.close()
+        self.logger.info(
+            f"Mapped {self.entry_count} urls from {len(self.sitemap_indexes)} "
+            f"sitemap indexes in {time.time() - start:.1f}s"
+        )
+        return self.entry_count
+
+    def robots_sitemaps(self, scheme: str, netloc: str) -> list[str]:
+        """Returns the urls listed in robots.txt 'Sitemap:' directives"""
+        robots_url = f"{scheme}://{netloc}/robots.txt"
+        try:
+            response = requests.get(robots_url, timeout=10)
+        except requests.RequestException as e:
+            self.logger.warning(f"Could not read {robots_url}: {e}")
+            return []
+        if response.status_code != 200:
+            return []
+        sitemaps = []
+        for line in response.text.splitlines():
+            key, _, value = line.partition(":")
+            if key.strip().lower() == "sitemap" and value.strip():
+                sitemaps.append(value.strip())
+        return sitemaps
+
+    def probe_sitemap(self, sitemap_url: str) -> bool:
+        """Check whether a sitemap exists at the url without downloading it"""
+        try:
+            response = requests.head(sitemap_url, timeout=10, allow_redirects=True)
+            if response.status_code in (403, 405, 501):
+                # Some servers refuse HEAD, fall back to a streamed GET
+                response = requests.get(sitemap_url, timeout=10, stream=True)
+                response.close()
+        except requests.RequestException:
+            return False
+        # Soft 404s commonly serve the home page with a 200
+        content_type = response.headers.get("Content-Type", "")
+        return response.status_code == 200 and "text/html" not in content_type
+
+    def discover_sitemaps(self, url: str) -> list[str]:
+        """
+        Find every sitemap root for the site: those declared in robots.txt
+        plus any found by probing the common locations, all in parallel.
+        """
         scheme, netloc, _ = parse_url(url)
-        sitemap_url = f"{scheme}://{netloc}/sitemap-index.xml"
-        contents = self.request_page(sitemap_url)
-        if contents is None:
-            sitemap_url = f"{scheme}://{netloc}/sitemap.xml"
-            contents = self.request_page(sitemap_url)
-            if contents is None:
-                self.logger.warning(f"No sitemap found for {url}")
-                self.sitemap_indexes = None
-                raise Exception(f"No sitemap found for {url}")
+        candidates = [f"{scheme}://{netloc}/{path}" for path in SITEMAP_LOCATIONS]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            declared = executor.submit(self.robots_sitemaps, scheme, netloc)
+            probes = [
+                (candidate, executor.submit(self.probe_sitemap, candidate))
+                for candidate in candidates
+            ]
+            roots = list(declared.result())
+            for candidate, probe in probes:
+                if probe.result() and candidate not in roots:
+                    roots.append(candidate)
+        self.logger.info(f"Discovered sitemaps for {netloc}: {roots}")
+        return roots
+
+    def get_sitemap_urls(self, url: str) -> tuple[list[str], dict, int, int]:
+        """
+        Process every sitemap root for the site. Returns the roots, the
+        child sitemaps of each index, and the number of entries found and
+        queued on the frontier.
+        """
+        roots = self.discover_sitemaps(url)
+        if not roots:
+            # Nothing a retry would find, on_map_success crawls from the seed
+            self.logger.warning(f"No sitemap found for {url}")
+            return roots, {}, 0, 0
 
-        self.process_sitemaps(sitemap_url, scheme, index="root")
+        self.process_sitemaps(roots)
 
-        return sitemap_url, self.sitemap_indexes, self.sitemap_details
+        return roots, dict(self.sitemap_indexes), self.entry_count, self.queued_count
 
 
-def map_site(url: str):
+@profile_job
+def map_site(url: str, run_id: str = None, incremental: bool = False):
     """Map a site"""
-    site_mapper = SiteMapper(url)
+    site_mapper = SiteMapper(url, run_id=run_id, incremental=incremental)
     result = site_mapper.get_sitemap_urls(url)
     return result
 
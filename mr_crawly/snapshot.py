@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+import glob
+import os
+import shutil
+import struct
+import tempfile
+import time
+from datetime import datetime
+
+import redis
+from config.configuration import get_logger
+from utils import get_run_dir
+
+logger = get_logger(__name__)
+
+MAGIC = b"MRSNAP1\n"
+# key length, key, pttl (-1 for none), DUMP length, DUMP payload
+FRAME_HEADER = struct.Struct(">I")
+FRAME_TTL = struct.Struct(">q")
+
+
+def snapshot_dir(run_id: str) -> str:
+    return os.path.join(get_run_dir(run_id), "snapshots")
+
+
+def latest_snapshot(run_id: str) -> str | None:
+    """The most recent snapshot of a run, or None"""
+    paths = sorted(glob.glob(os.path.join(snapshot_dir(run_id), "*.snap")))
+    return paths[-1] if paths else None
+
+
+def _write_frame(f, key: bytes, pttl: int, payload: bytes):
+    f.write(FRAME_HEADER.pack(len(key)))
+    f.write(key)
+    f.write(FRAME_TTL.pack(pttl))
+    f.write(FRAME_HEADER.pack(len(payload)))
+    f.write(payload)
+
+
+def _read_exactly(f, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("Snapshot is truncated")
+    return data
+
+
+def iter_frames(path: str):
+    """Yield (key, pttl, payload) from a snapshot file"""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a crawl snapshot")
+        while header := f.read(FRAME_HEADER.size):
+            key = _read_exactly(f, FRAME_HEADER.unpack(header)[0])
+            (pttl,) = FRAME_TTL.unpack(_read_exactly(f, FRAME_TTL.size))
+            (size,) = FRAME_HEADER.unpack(_read_exactly(f, FRAME_HEADER.size))
+            yield key, pttl, _read_exactly(f, size)
+
+
+class RunSnapshotter:
+    """
+    Snapshots a run's redis state without blocking the server.
+
+    "scan" mode walks only the run's keys ({run_id}:*) with SCAN and
+    copies each with DUMP/PTTL, a batch per round trip, into a framed
+    file that restore() loads back with RESTORE. Workers keep running
+    in between batches. Keys written during the scan may or may not be
+    included, as with any SCAN. rq keeps jobs under its own keys, so the
+    manager records the run's unfinished ones under the run's keys first
+    (see URLCache.save_pending) and requeues them after a restore.
+
+    "bgsave" mode has redis fork and write its whole dataset, polls until
+    the save completes, and copies the dump file into the run directory.
+    It needs the redis data directory to be readable from here.
+    """
+
+    def __init__(
+        self,
+        redis_conn: redis.Redis,
+        run_id: str,
+        mode: str = "scan",
+        batch_size: int = 500,
+        keep: int = 3,
+    ):
+        if mode not in ("scan", "bgsave"):
+            raise ValueError(f"Invalid snapshot mode: {mode}")
+        self.rdb = redis_conn
+        self.run_id = run_id
+        self.mode = mode
+        self.batch_size = batch_size
+        self.keep = keep
+        self.out_dir = snapshot_dir(run_id)
+
+    def snapshot(self) -> str:
+        """Take a snapshot, returns its path"""
+        os.makedirs(self.out_dir, exist_ok=True)
+        stamp = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+        if self.mode == "bgsave":
+            path = self._bgsave(os.path.join(self.out_dir, f"{stamp}.rdb"))
+        else:
+            path = self._scan(os.path.join(self.out_dir, f"{stamp}.snap"))
+        self._prune()
+        return path
+
+    def _scan(self, path: str) -> str:
+        start = time.perf_counter()
+        seen, count = set(), 0
+        # Written aside and renamed, so a snapshot on disk is always complete
+        fd, tmp_path = tempfile.mkstemp(dir=self.out_dir, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(MAGIC)
+                batch = []
+                for key in self.rdb.scan_iter(
+                    match=f"{self.run_id}:*", count=self.batch_size
+                ):
+                    # SCAN may return a key more than once
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    batch.append(key)
+                    if len(batch) >= self.batch_size:
+                        count += self._dump_batch(f, batch)
+                        batch = []
+                count += self._dump_batch(f, batch)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        logger.info(
+            f"Snapshot of {count} keys for run {self.run_id} written to {path} "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
+        return path
+
+    def _dump_batch(self, f, keys: list[bytes]) -> int:
+        if not keys:
+            return 0
+        pipe = self.rdb.pipeline(transaction=False)
+        for key in keys:
+            pipe.dump(key)
+            pipe.pttl(key)
+        results = pipe.execute()
+        written = 0
+        for key, payload, pttl in zip(keys, results[::2], results[1::2]):
+            # Deleted since it was scanned
+            if payload is None:
+                continue
+            _write_frame(f, key, pttl, payload)
+            written += 1
+        return written
+
+    def _bgsave(self, path: str, poll_interval: float = 1.0) -> str:
+        last_save = self.rdb.lastsave()
+        try:
+            self.rdb.bgsave()
+        except redis.ResponseError as e:
+            # Another background save is running, wait for that one instead
+            logger.info(f"BGSAVE not started: {e}")
+        while True:
+            persistence = self.rdb.info("persistence")
+            in_progress = persistence.get("rdb_bgsave_in_progress", 0)
+            if not in_progress and self.rdb.lastsave() != last_save:
+                break
+            if not in_progress and persistence.get("rdb_last_bgsave_status") == "err":
+                raise RuntimeError("Redis background save failed")
+            time.sleep(poll_interval)
+        config = self.rdb.config_get("dir")
+        config.update(self.rdb.config_get("dbfilename"))
+        shutil.copy(os.path.join(config["dir"], config["dbfilename"]), path)
+        logger.info(f"Copied redis background save to {path}")
+        return path
+
+    def _prune(self):
+        """Keep only the most recent snapshots of each kind"""
+        for pattern in ("*.snap", "*.rdb"):
+            paths = sorted(glob.glob(os.path.join(self.out_dir, pattern)))
+            for old_path in paths[: -self.keep] if self.keep else []:
+                os.remove(old_path)
+
+
+def restore(redis_conn: redis.Redis, path: str, batch_size: int = 500) -> int:
+    """
+    Load a scan mode snapshot back into redis, replacing any existing
+    keys of the same name. Returns the number of keys restored.
+    """
+    count = 0
+    pipe = redis_conn.pipeline(transaction=False)
+    for key, pttl, payload in iter_frames(path):
+        pipe.restore(key, max(pttl, 0), payload, replace=True)
+        count += 1
+        if count % batch_size == 0:
+            pipe.execute()
+    pipe.execute()
+    logger.info(f"Restored {count} keys from {path}")
+    return count
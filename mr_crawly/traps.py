@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit
+
+import redis
+from config.configuration import get_config, get_logger
+from metrics import Metrics
+
+logger = get_logger(__name__)
+
+# Path segments that identify one record among many, e.g. uuids, hashes
+# and long mixed tokens (session ids, slugs with ids appended)
+ID_SEGMENT = re.compile(
+    r"^(?:[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+    r"|[0-9a-f]{12,}|(?=[a-z]*\d)(?=\d*[a-z])[a-z0-9_-]{16,})$",
+    re.IGNORECASE,
+)
+DIGITS = re.compile(r"\d+")
+
+
+def path_template(path: str) -> str:
+    """
+    Reduce a path to the pattern it was generated from, e.g.
+    /calendar/2024/05/17 -> /calendar/{n}/{n}/{n}, /item/9f3c...e1 -> /item/{id}
+    """
+    segments = []
+    for segment in path.split("/"):
+        if ID_SEGMENT.match(segment):
+            segments.append("{id}")
+        else:
+            segments.append(DIGITS.sub("{n}", segment))
+    return "/".join(segments)
+
+
+def has_repeating_segments(segments: list[str], max_repeats: int) -> bool:
+    """
+    Whether any segment, or run of segments, recurs more than max_repeats
+    times, as in the /a/b/a/b/a/b paths relative links produce when a
+    site serves the same page below itself.
+    """
+    if not segments:
+        return False
+    if Counter(segments).most_common(1)[0][1] > max_repeats:
+        return True
+    # Runs of several segments, e.g. /x/a/b/a/b/a/b with max_repeats 2
+    for size in range(2, len(segments) // (max_repeats + 1) + 1):
+        for start in range(len(segments) - size * (max_repeats + 1) + 1):
+            run = segments[start : start + size]
+            repeats = 1
+            offset = start + size
+            while segments[offset : offset + size] == run:
+                repeats += 1
+                offset += size
+            if repeats > max_repeats:
+                return True
+    return False
+
+
+@dataclass
+class TrapLimits:
+    """Caps on the url space crawled per site, see [traps] in config.toml"""
+
+    max_depth: int = 12
+    max_segment_repeats: int = 2
+    max_urls_per_template: int = 500
+    max_query_variants: int = 50
+    # Per host overrides of max_depth
+    host_max_depth: dict[str, int] = field(default_factory=dict)
+
+
+class TrapDetector:
+    """
+    Rejects urls that look like an infinite url space before they are
+    enqueued: too deep for their host, repeating path segments, too many
+    urls sharing one path template, or too many query strings on one
+    path. Template and query counts are kept in redis so that every
+    process enqueueing for the run shares them. Each rejection is logged
+    and counted in trapped_urls_total by reason.
+    """
+
+    def __init__(
+        self,
+        redis_conn: redis.Redis,
+        run_id: str,
+        limits: TrapLimits = None,
+        metrics: Metrics = None,
+    ):
+        self.rdb = redis_conn
+        self.run_id = run_id
+        self.limits = limits or TrapLimits()
+        self.metrics = metrics
+        self.templates_key = f"{run_id}:trap_templates"
+        self.queries_key = f"{run_id}:trap_queries"
+
+    def _local_reason(self, host: str, segments: list[str]) -> str | None:
+        """Checks that need nothing but the url itself"""
+        max_depth = self.limits.host_max_depth.get(host, self.limits.max_depth)
+        if len(segments) > max_depth:
+            return "depth"
+        if has_repeating_segments(segments, self.limits.max_segment_repeats):
+            return "repeating_segments"
+        return None
+
+    def filter(self, urls: list[str]) -> list[bool]:
+        """
+        Returns whether each url may be crawled. Urls are expected to be
+        new to the run, as each one counts towards its template's cap.
+        """
+        allowed = [True] * len(urls)
+        reasons = [None] * len(urls)
+        counted = []
+        pipe = self.rdb.pipeline(transaction=False)
+        for index, url in enumerate(urls):
+            parts = urlsplit(url)
+            segments = [segment for segment in parts.path.split("/") if segment]
+            reasons[index] = self._local_reason(parts.netloc, segments)
+            if reasons[index] is not None:
+                continue
+            template = f"{parts.netloc}{path_template(parts.path)}"
+            pipe.hincrby(self.templates_key, template, 1)
+            if parts.query:
+                pipe.hincrby(self.queries_key, f"{parts.netloc}{parts.path}", 1)
+            counted.append((index, template, bool(parts.query)))
+        results = iter(pipe.execute() if counted else [])
+        for index, template, has_query in counted:
+            template_count = next(results)
+            query_count = next(results) if has_query else 0
+            if template_count > self.limits.max_urls_per_template:
+                reasons[index] = "template"
+                if template_count == self.limits.max_urls_per_template + 1:
+                    logger.info("Capped urls matching %s", template)
+            elif query_count > self.limits.max_query_variants:
+                reasons[index] = "query_variants"
+                if query_count == self.limits.max_query_variants + 1:
+                    logger.info("Capped query strings on %s", urls[index].split("?")[0])
+
+        for index, reason in enumerate(reasons):
+            if reason is None:
+                continue
+            allowed[index] = False
+            logger.debug(
+                "Skipping %s (%s)",
+                urls[index],
+                reason,
+                extra={"run_id": self.run_id, "url": urls[index], "stage": "traps"},
+            )
+        if self.metrics is not None:
+            for reason, count in Counter(filter(None, reasons)).items():
+                self.metrics.inc("trapped_urls_total", count, reason=reason)
+        return allowed
+
+
+def get_trap_detector(
+    redis_conn: redis.Redis, run_id: str, metrics: Metrics = None
+) -> TrapDetector | None:
+    """Returns the run's TrapDetector, if enabled in config.toml"""
+    trap_config = dict(get_config().get("traps", {}))
+    if not trap_config.pop("enabled", True):
+        return None
+    return TrapDetector(redis_conn, run_id, TrapLimits(**trap_config), metrics)
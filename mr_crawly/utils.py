@@ -4,6 +4,8 @@ import os
 import time
 from urllib.parse import urlparse
 
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+
 
 def parse_url(url: str):
     """Parse a url and return the page elements"""
@@ -11,6 +13,11 @@ def parse_url(url: str):
     return parsed_url.scheme, parsed_url.netloc, parsed_url.path
 
 
+def get_run_dir(run_id: str) -> str:
+    """Return the data directory for the given run"""
+    return os.path.join(DATA_DIR, f"{run_id}")
+
+
 def create_dir(dir_name):
     # Method 1: Using os.mkdir() to create a single directory
     dir_name = "my_new_directory"
@@ -0,0 +1,239 @@
+from __future__ import annotations
+
+import base64
+import fcntl
+import hashlib
+import os
+import uuid
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+from config.configuration import get_logger
+
+logger = get_logger(__name__)
+
+WARC_VERSION = "WARC/1.1"
+CDX_HEADER = " CDX N b a m s k r M S V g\n"
+# requests hands us decoded bodies, so these no longer describe the payload
+STRIPPED_HEADERS = ("content-encoding", "transfer-encoding", "content-length")
+CHUNK_SIZE = 64 * 1024
+
+
+def warc_date(when: datetime | None = None) -> str:
+    """Format a timestamp as a WARC-Date"""
+    when = when or datetime.now(timezone.utc)
+    return when.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def cdx_timestamp(date: str) -> str:
+    """Convert a WARC-Date to the 14 digit CDX timestamp"""
+    return "".join(ch for ch in date if ch.isdigit())[:14]
+
+
+def surt(url: str) -> str:
+    """Build a SURT-style sort key (reversed host, path, query) for a url"""
+    parsed = urlparse(url)
+    host = parsed.hostname or ""
+    if host.startswith("www."):
+        host = host[4:]
+    key = ",".join(reversed(host.split("."))) + ")"
+    key += parsed.path or "/"
+    if parsed.query:
+        key += "?" + "&".join(sorted(parsed.query.split("&")))
+    return key.lower()
+
+
+def payload_digest(body: bytes) -> str:
+    """Base32 sha1 digest, as used by WARC-Payload-Digest and CDX"""
+    return base64.b32encode(hashlib.sha1(body).digest()).decode("ascii")
+
+
+class WarcWriter:
+    """
+    Appends request/response records to rotating .warc.gz files.
+    Each record is written as its own gzip member so that any record can be
+    read back given only its offset and length, which are recorded in a
+    CDX-style index alongside the WARC files.
+    Writes are guarded by a file lock, as download workers run in
+    separate processes and share the same output directory.
+    """
+
+    def __init__(
+        self,
+        warc_dir: str,
+        prefix: str = "mr-crawly",
+        max_file_size: int = 1_000_000_000,
+    ):
+        self.warc_dir = warc_dir
+        self.prefix = prefix
+        self.max_file_size = max_file_size
+        os.makedirs(self.warc_dir, exist_ok=True)
+        self.lock_path = os.path.join(self.warc_dir, ".lock")
+        self.cdx_path = os.path.join(self.warc_dir, "index.cdx")
+        # Serial of the file being appended to, found on first write
+        self.serial = None
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _file_name(self, serial: int) -> str:
+        return f"{self.prefix}-{serial:05d}.warc.gz"
+
+    def _latest_serial(self) -> int:
+        serials = [
+            int(name[len(self.prefix) + 1 : -len(".warc.gz")])
+            for name in os.listdir(self.warc_dir)
+            if name.startswith(self.prefix + "-") and name.endswith(".warc.gz")
+        ]
+        return max(serials, default=0)
+
+    def _current_file(self) -> str:
+        """
+        Returns the file to append to, rotating once it passes max_file_size.
+        The directory is only listed on first use; after that the current
+        file's size is checked, moving past files that are full (including
+        ones other processes filled and rotated away from).
+        """
+        if self.serial is None:
+            self.serial = self._latest_serial()
+        path = os.path.join(self.warc_dir, self._file_name(self.serial))
+        while os.path.exists(path) and os.path.getsize(path) >= self.max_file_size:
+            self.serial += 1
+            path = os.path.join(self.warc_dir, self._file_name(self.serial))
+        if not os.path.exists(path):
+            logger.info(f"Starting new WARC file {path}")
+            self._write_member(path, self._warcinfo_record(os.path.basename(path)))
+        return path
+
+    def _warcinfo_record(self, filename: str) -> list[bytes]:
+        info = "software: mr-crawly\r\nformat: WARC File Format 1.1\r\n".encode()
+        headers = {
+            "WARC-Type": "warcinfo",
+            "WARC-Record-ID": f"<urn:uuid:{uuid.uuid4()}>",
+            "WARC-Date": warc_date(),
+            "WARC-Filename": filename,
+            "Content-Type": "application/warc-fields",
+        }
+        return self._record(headers, [info])
+
+    def _record(self, headers: dict, block: list[bytes]) -> list[bytes]:
+        """Returns the record as a list of chunks, to avoid re-copying the body"""
+        length = sum(len(chunk) for chunk in block)
+        lines = [WARC_VERSION]
+        lines += [f"{key}: {value}" for key, value in headers.items()]
+        lines.append(f"Content-Length: {length}")
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode("utf-8")
+        return [head, *block, b"\r\n\r\n"]
+
+    def _write_member(self, path: str, chunks: list[bytes]) -> tuple[int, int]:
+        """Compress the record as a single gzip member and append it to path"""
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        with open(path, "ab") as f:
+            offset = f.seek(0, os.SEEK_END)
+            for chunk in chunks:
+                for start in range(0, len(chunk), CHUNK_SIZE):
+                    f.write(compressor.compress(chunk[start : start + CHUNK_SIZE]))
+            f.write(compressor.flush())
+            length = f.tell() - offset
+        return offset, length
+
+    def write_exchange(self, response) -> dict:
+        """
+        Write the request and response records for a `requests` response.
+        Returns the CDX entry for the response record.
+        """
+        request = response.request
+        url = response.url
+        date = warc_date()
+        body = response.content or b""
+        response_id = f"<urn:uuid:{uuid.uuid4()}>"
+
+        version = {10: "HTTP/1.0", 11: "HTTP/1.1"}.get(
+            getattr(response.raw, "version", 11), "HTTP/1.1"
+        )
+        status_line = f"{version} {response.status_code} {response.reason or ''}"
+        resp_headers = [status_line]
+        for key, value in response.headers.items():
+            if key.lower() in STRIPPED_HEADERS:
+                key = f"X-Crawler-{key}"
+            resp_headers.append(f"{key}: {value}")
+        resp_headers.append(f"Content-Length: {len(body)}")
+        resp_head = ("\r\n".join(resp_headers) + "\r\n\r\n").encode(
+            "latin-1", "replace"
+        )
+        digest = payload_digest(body)
+        response_record = self._record(
+            {
+                "WARC-Type": "response",
+                "WARC-Record-ID": response_id,
+                "WARC-Date": date,
+                "WARC-Target-URI": url,
+                "WARC-Payload-Digest": f"sha1:{digest}",
+                "Content-Type": "application/http;msgtype=response",
+            },
+            [resp_head, body],
+        )
+
+        parsed = urlparse(request.url)
+        req_lines = [f"{request.method} {request.path_url} {version}"]
+        if "Host" not in request.headers:
+            req_lines.append(f"Host: {parsed.netloc}")
+        req_lines += [f"{key}: {value}" for key, value in request.headers.items()]
+        req_block = ("\r\n".join(req_lines) + "\r\n\r\n").encode("latin-1", "replace")
+        request_record = self._record(
+            {
+                "WARC-Type": "request",
+                "WARC-Record-ID": f"<urn:uuid:{uuid.uuid4()}>",
+                "WARC-Date": date,
+                "WARC-Target-URI": request.url,
+                "WARC-Concurrent-To": response_id,
+                "Content-Type": "application/http;msgtype=request",
+            },
+            [req_block],
+        )
+
+        mime = response.headers.get("Content-Type", "-").split(";")[0].strip() or "-"
+        with self._locked():
+            path = self._current_file()
+            offset, length = self._write_member(path, response_record)
+            self._write_member(path, request_record)
+            entry = {
+                "urlkey": surt(url),
+                "timestamp": cdx_timestamp(date),
+                "url": url,
+                "mime": mime,
+                "status": response.status_code,
+                "digest": digest,
+                "length": length,
+                "offset": offset,
+                "filename": os.path.basename(path),
+            }
+            self._append_cdx(entry)
+        return entry
+
+    def _append_cdx(self, entry: dict):
+        new_index = not os.path.exists(self.cdx_path)
+        with open(self.cdx_path, "a", encoding="utf-8") as f:
+            if new_index:
+                f.write(CDX_HEADER)
+            f.write(
+                f"{entry['urlkey']} {entry['timestamp']} {entry['url']} "
+                f"{entry['mime']} {entry['status']} {entry['digest']} - - "
+                f"{entry['length']} {entry['offset']} {entry['filename']}\n"
+            )
+
+
+def read_record(warc_path: str, offset: int, length: int) -> bytes:
+    """Read back a single (decompressed) record using its CDX offset and length"""
+    with open(warc_path, "rb") as f:
+        f.seek(offset)
+        member = f.read(length)
+    return zlib.decompress(member, 31)
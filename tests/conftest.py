@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fakeredis
+import pytest
+
+loc = os.path.join(os.path.dirname(os.path.dirname(__file__)), "mr_crawly")
+sys.path.append(loc)
+
+import utils  # noqa
+
+
+@pytest.fixture
+def redis_conn():
+    return fakeredis.FakeRedis()
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """Runs' data directories under a temporary DATA_DIR"""
+    monkeypatch.setattr(utils, "DATA_DIR", str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def run_context(redis_conn, data_dir):
+    """A RunContext on the fake redis, enqueueing without running jobs"""
+    import callbacks
+    from cache import URLCache
+
+    run_id = "run1"
+    os.makedirs(data_dir / run_id)
+    URLCache(redis_conn).save_run_settings(run_id, {"is_async": True})
+    callbacks._contexts.pop(run_id, None)
+    yield callbacks.get_context(run_id, redis_conn)
+    callbacks._contexts.pop(run_id, None)
+
+
+@pytest.fixture
+def local_redis(redis_conn, monkeypatch):
+    """
+    Connections the crawler opens itself (redis.Redis(host, port)) go to
+    the fake redis, and the process wide dns cache they install is removed
+    """
+    import dns_cache
+    import redis
+
+    monkeypatch.setattr(redis, "Redis", lambda *args, **kwargs: redis_conn)
+    yield redis_conn
+    dns_cache.uninstall()
+
+
+@pytest.fixture
+def site_server():
+    """
+    A local http server returning the bytes in `server.pages` by path, or a
+    404. Functions in `server.hooks` are called before their path is served
+    """
+    pages = {}
+    hooks = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path in hooks:
+                hooks[self.path]()
+            body = pages.get(self.path)
+            self.send_response(200 if body is not None else 404)
+            self.send_header("Content-Length", str(len(body or b"")))
+            self.end_headers()
+            self.wfile.write(body or b"")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.pages, server.hooks = pages, hooks
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    yield server
+    server.shutdown()
+    server.server_close()
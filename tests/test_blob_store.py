@@ -0,0 +1,54 @@
+import hashlib
+import os
+
+from blob_store import BlobStore
+
+
+def stored_files(root) -> list[str]:
+    return sorted(
+        os.path.relpath(os.path.join(dirpath, name), root)
+        for dirpath, _, names in os.walk(root)
+        for name in names
+    )
+
+
+def test_put_shards_by_hash_and_is_idempotent(tmp_path):
+    store = BlobStore(str(tmp_path))
+    body = b"<html>same page</html>"
+    content_hash = store.put(body)
+
+    assert content_hash == hashlib.sha256(body).hexdigest()
+    expected = os.path.join(content_hash[:2], content_hash[2:4], content_hash)
+    assert stored_files(tmp_path) == [expected]
+    mtime = os.stat(tmp_path / expected).st_mtime_ns
+
+    # Text is stored as utf-8, so the same page as str is the same blob
+    assert store.put(body.decode()) == content_hash
+    assert stored_files(tmp_path) == [expected]
+    assert os.stat(tmp_path / expected).st_mtime_ns == mtime
+
+
+def test_get_and_open_return_the_stored_bytes(tmp_path):
+    store = BlobStore(str(tmp_path))
+    body = "<html>café</html>".encode()
+    content_hash = store.put(body)
+
+    assert store.get(content_hash) == body
+    with store.open(content_hash) as blob:
+        assert blob[:] == body
+        assert blob.find(b"caf") == 6
+
+    empty_hash = store.put(b"")
+    assert store.open(empty_hash) == b""
+    assert store.get(empty_hash) == b""
+    assert store.get("0" * 64) is None
+    assert store.get(None) is None
+
+
+def test_put_leaves_no_temp_files(tmp_path):
+    store = BlobStore(str(tmp_path))
+    hashes = {store.put(f"page {i}".encode()) for i in range(20)}
+
+    files = stored_files(tmp_path)
+    assert not [name for name in files if ".tmp-" in name]
+    assert sorted(os.path.basename(name) for name in files) == sorted(hashes)
@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+from types import SimpleNamespace
+
+import callbacks
+
+SEED = "http://example.com/"
+
+
+def map_job(run_id: str) -> SimpleNamespace:
+    return SimpleNamespace(
+        id="map-job",
+        meta={"run_id": run_id},
+        func_name="site_mapper.map_site",
+        args=(SEED, run_id, False),
+        started_at=None,
+        ended_at=None,
+    )
+
+
+def enqueued_urls(context) -> list[str]:
+    urls = []
+    for job in context.qmanager.frontier_queue.jobs:
+        _, seed_id, url_id = job.args
+        urls.append(context.cache.urls_for_ids(context.run_id, [url_id])[0])
+    return urls
+
+
+def test_seed_is_crawled_when_sitemaps_queue_nothing(run_context, redis_conn):
+    # Sitemaps were found, but every entry was out of scope
+    result = (["http://example.com/sitemap.xml"], {}, 25, 0)
+    callbacks.on_map_success(map_job(run_context.run_id), redis_conn, result)
+    assert enqueued_urls(run_context) == [SEED]
+
+
+def test_seed_is_not_queued_when_sitemaps_queue_urls(run_context, redis_conn):
+    run_context.cache.push_frontier(run_context.run_id, SEED, [SEED + "listed"])
+    result = (["http://example.com/sitemap.xml"], {}, 1, 1)
+    callbacks.on_map_success(map_job(run_context.run_id), redis_conn, result)
+    assert enqueued_urls(run_context) == [SEED + "listed"]
@@ -0,0 +1,41 @@
+from types import SimpleNamespace
+
+from cache import URLCache
+from dashboard import Dashboard
+from metrics import Metrics
+from rich.console import Console
+
+SEED = "https://example.com/"
+
+
+def make_dashboard(redis_conn, run_id):
+    manager = SimpleNamespace(
+        run_id=run_id,
+        seeds={SEED: 10},
+        redis_conn=redis_conn,
+        cache=URLCache(redis_conn),
+        metrics=Metrics(redis_conn, run_id=run_id),
+    )
+    return Dashboard(manager)
+
+
+def test_summary_counts_only_the_run_pages(redis_conn):
+    cache = URLCache(redis_conn)
+    for _ in range(7):
+        cache.count_page("old_run", SEED)
+    Metrics(redis_conn, run_id="old_run").inc("pages_total", 7, status="200")
+    for _ in range(3):
+        cache.count_page("run1", SEED)
+
+    dashboard = make_dashboard(redis_conn, "run1")
+    totals = dashboard._totals()
+    assert totals["done"] == 3
+    assert totals["pages"] == 0
+
+    console = Console(width=200, record=True)
+    dashboard.samples.append((0.0, {**totals, "done": 0}))
+    console.print(dashboard._summary(1.0, totals))
+    output = console.export_text()
+    assert "3 / 10" in output
+    # 7 pages left at 3 pages/s
+    assert "00:00:02" in output
@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import socket
+
+import dns_cache
+import pytest
+from dns_cache import DnsCache, _with_port
+
+ADDRS = [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("192.0.2.1", 0))]
+
+
+class StubResolver:
+    """Answers from a table, counting the lookups that reach it"""
+
+    def __init__(self, answers: dict, ttl: float = None):
+        self.answers = answers
+        self.ttl = ttl
+        self.calls = 0
+
+    def __call__(self, host, family, type, proto, flags):
+        self.calls += 1
+        answer = self.answers[host]
+        if isinstance(answer, socket.gaierror):
+            raise answer
+        return answer, self.ttl
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Controls time.time() as seen by the cache"""
+    now = [1000.0]
+    monkeypatch.setattr(dns_cache.time, "time", lambda: now[0])
+    return now
+
+
+def test_answers_are_cached_until_their_ttl(clock):
+    resolver = StubResolver({"example.com": ADDRS}, ttl=60)
+    cache = DnsCache(resolver, ttl=300)
+    assert cache.lookup("example.com") == ADDRS
+    clock[0] += 59
+    assert cache.lookup("EXAMPLE.com") == ADDRS
+    assert resolver.calls == 1
+    clock[0] += 2
+    cache.lookup("example.com")
+    assert resolver.calls == 2
+
+
+def test_record_ttls_are_capped(clock):
+    resolver = StubResolver({"example.com": ADDRS}, ttl=86400)
+    cache = DnsCache(resolver, max_ttl=3600)
+    cache.lookup("example.com")
+    clock[0] += 3601
+    cache.lookup("example.com")
+    assert resolver.calls == 2
+
+
+def test_failures_are_cached_and_raised_again(clock):
+    error = socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+    resolver = StubResolver({"missing.example": error})
+    cache = DnsCache(resolver, negative_ttl=30)
+    for _ in range(2):
+        with pytest.raises(socket.gaierror) as raised:
+            cache.lookup("missing.example")
+        assert raised.value.args == error.args
+    assert resolver.calls == 1
+    clock[0] += 31
+    with pytest.raises(socket.gaierror):
+        cache.lookup("missing.example")
+    assert resolver.calls == 2
+
+
+def test_requested_port_is_substituted():
+    addrs = [
+        (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("192.0.2.1", 0)),
+        (socket.AF_INET6, socket.SOCK_STREAM, 6, "", ("2001:db8::1", 0, 0, 0)),
+    ]
+    assert _with_port(addrs, 443) == [
+        (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("192.0.2.1", 443)),
+        (socket.AF_INET6, socket.SOCK_STREAM, 6, "", ("2001:db8::1", 443, 0, 0)),
+    ]
+    cache = DnsCache(StubResolver({"example.com": ADDRS}))
+    assert cache.getaddrinfo("example.com", "8080")[0][4] == ("192.0.2.1", 8080)
+    assert cache.getaddrinfo("example.com", None)[0][4] == ("192.0.2.1", 0)
+
+
+def test_answers_are_shared_through_redis(redis_conn):
+    error = socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+    first = StubResolver({"example.com": ADDRS, "missing.example": error})
+    DnsCache(first, redis_conn=redis_conn).lookup("example.com")
+    with pytest.raises(socket.gaierror):
+        DnsCache(first, redis_conn=redis_conn).lookup("missing.example")
+
+    # Another worker's cache finds both answers without resolving
+    second = StubResolver({})
+    other = DnsCache(second, redis_conn=redis_conn)
+    assert other.lookup("example.com") == ADDRS
+    with pytest.raises(socket.gaierror) as raised:
+        other.lookup("missing.example")
+    assert raised.value.args == error.args
+    assert second.calls == 0
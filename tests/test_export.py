@@ -0,0 +1,53 @@
+import os
+
+import export
+import pyarrow.parquet as pq
+from blob_store import BlobStore
+from cache import URLData
+from export import RunExporter
+
+from data import UrlTable
+
+SEED = "http://example.com/"
+
+
+def test_url_html_export_keeps_the_seed(data_dir, monkeypatch):
+    monkeypatch.setattr(export, "DATA_DIR", str(data_dir))
+    os.makedirs(data_dir / "run1")
+    pages = UrlTable(str(data_dir / "run1" / "sqlite.db"))
+    pages.store_url(URLData(url=SEED + "a", status=200), "run1", seed_url=SEED)
+    pages.store_url(URLData(url=SEED + "b", status=404), "run1")
+
+    out_dir = data_dir / "parquet"
+    assert RunExporter("run1", str(out_dir)).export_table("url_html") == 2
+
+    table = pq.read_table(out_dir / "url_html" / "run=run1")
+    assert table.schema.field("seed_url").type == "string"
+    rows = sorted(table.to_pylist(), key=lambda row: row["url"])
+    assert [row["seed_url"] for row in rows] == [SEED, None]
+    assert [row["status"] for row in rows] == ["200", "404"]
+    assert rows[0]["run_id"] == "run1"
+
+
+def test_batches_with_bodies_are_bounded_by_size(data_dir, monkeypatch):
+    monkeypatch.setattr(export, "DATA_DIR", str(data_dir))
+    os.makedirs(data_dir / "run1")
+    blob_store = BlobStore(str(data_dir / "blobs"))
+    pages = UrlTable(str(data_dir / "run1" / "sqlite.db"), blob_store=blob_store)
+    for i in range(7):
+        body = f"{i}".encode() * 1000
+        pages.store_url(URLData(url=f"{SEED}{i}", content=body, status=200), "run1")
+
+    exporter = RunExporter(
+        "run1",
+        str(data_dir / "parquet"),
+        include_bodies=True,
+        max_batch_bytes=2500,
+    )
+    batches = list(exporter._batches("url_html", exporter._schema("url_html")))
+    assert [batch.num_rows for batch in batches] == [3, 3, 1]
+    assert batches[1].column("content")[0].as_py() == b"3" * 1000
+
+    assert exporter.export_table("url_html") == 7
+    table = pq.read_table(data_dir / "parquet" / "url_html" / "run=run1")
+    assert sorted(table.column("content").to_pylist())[6] == b"6" * 1000
@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import os
+
+import callbacks
+import manager as manager_module
+import site_downloader
+from cache import QueueManager, URLCache
+from manager import Manager
+from rq.job import Job
+from serializer import MsgpackSerializer
+
+
+def page(*hrefs: str) -> bytes:
+    links = "".join(f'<a href="{href}">{href}</a>' for href in hrefs)
+    return f"<html><head><title>t</title></head><body>{links}</body></html>".encode()
+
+
+def test_fused_jobs_download_parse_and_push_links(
+    data_dir, local_redis, site_server, monkeypatch
+):
+    monkeypatch.setattr(callbacks, "DATA_DIR", str(data_dir))
+    # Writers are kept per run id, don't reuse one from another test's data_dir
+    monkeypatch.setattr(site_downloader, "_warc_writers", {})
+    site_server.pages.update(
+        {"/": page("/a", "/b"), "/a": page("/b", "/c"), "/b": page(), "/c": page("/")}
+    )
+    seed = site_server.url + "/"
+    redis_conn = local_redis
+    URLCache(redis_conn).save_run_settings("run1", {"fused": True, "is_async": False})
+    callbacks._contexts.pop("run1", None)
+    context = callbacks.get_context("run1", redis_conn)
+    os.makedirs(context.data_dir)
+
+    # Synchronous queues run each job, and its callback, as it is enqueued
+    context.cache.set_seed_budgets("run1", {seed: 10})
+    context.cache.push_frontier("run1", seed, [seed])
+    context.drain_frontier()
+    callbacks._contexts.pop("run1", None)
+
+    rows = context.url_db.conn.execute("select url, status from url_html").fetchall()
+    assert sorted(rows) == [(seed + path, 200) for path in ("", "a", "b", "c")]
+    links = context.links_db.conn.execute("select source_url, linked_url from links")
+    edges = {
+        (source[len(seed) - 1 :], linked[len(seed) - 1 :]) for source, linked in links
+    }
+    assert edges >= {("/", "/a"), ("/", "/b"), ("/a", "/b"), ("/a", "/c"), ("/c", "/")}
+    # Every page was crawled by a single fused job, with no parse jobs
+    job_ids = [key.decode().split(":")[-1] for key in redis_conn.keys("rq:job:*")]
+    func_names = {
+        job.func_name
+        for job in Job.fetch_many(
+            job_ids, connection=redis_conn, serializer=MsgpackSerializer
+        )
+        if job is not None
+    }
+    assert func_names == {"jobs.fused"}
+
+
+def test_fused_runs_start_no_parse_workers(redis_conn, monkeypatch):
+    started = []
+
+    class InlineExecutor:
+        def __init__(self, max_workers):
+            pass
+
+        def submit(self, fn, *args):
+            fn(*args)
+
+    monkeypatch.setattr(manager_module, "ThreadPoolExecutor", InlineExecutor)
+    monkeypatch.setattr(
+        manager_module, "start_worker", lambda queue, conn: started.append(queue.name)
+    )
+    for fused, expected in (
+        (False, ["frontier", "site_map", "parse"]),
+        (True, ["frontier", "site_map"]),
+    ):
+        manager = Manager.__new__(Manager)
+        manager.fused = fused
+        manager.num_workers = 1
+        manager.redis_conn = redis_conn
+        manager.qmanager = QueueManager(redis_conn)
+        started.clear()
+        manager._start_workers()
+        assert started == expected
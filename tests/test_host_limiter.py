@@ -0,0 +1,72 @@
+import time
+
+import pytest
+from host_limiter import HostBusy, HostLimiter, HostLimits
+
+HOST = "example.com"
+
+
+def current_limit(limiter: HostLimiter) -> float:
+    return float(limiter.rdb.hget(limiter._state_key(HOST), "limit"))
+
+
+def test_ok_responses_raise_the_limit(redis_conn):
+    limiter = HostLimiter(redis_conn, HostLimits(initial_limit=2, max_limit=3))
+    limiter.record(HOST, "ok")
+    assert current_limit(limiter) == 2.5
+
+    for _ in range(10):
+        limiter.record(HOST, "ok")
+    assert current_limit(limiter) == 3
+
+
+def test_limit_is_cut_once_per_cooldown(redis_conn):
+    limiter = HostLimiter(redis_conn, HostLimits(initial_limit=8))
+    limiter.record(HOST, "throttled")
+    assert current_limit(limiter) == 4
+
+    # Requests that were already in flight fail too, but only count once
+    limiter.record(HOST, "throttled")
+    limiter.record(HOST, "error")
+    assert current_limit(limiter) == 4
+
+    # Once the cooldown has passed the next failure cuts again
+    redis_conn.hset(limiter._state_key(HOST), "cut_at", time.time() - 2)
+    limiter.record(HOST, "error")
+    assert current_limit(limiter) == 2
+    assert redis_conn.hget(limiter._state_key(HOST), "throttled") == b"2"
+
+
+def test_latency_above_the_baseline_cuts_the_limit(redis_conn):
+    limiter = HostLimiter(redis_conn, HostLimits(initial_limit=8, max_limit=8))
+    for _ in range(3):
+        limiter.record(HOST, "ok", latency=0.1)
+    assert current_limit(limiter) == 8
+
+    # Smoothed latency rises to 0.28s, over twice the 0.1s baseline
+    limiter.record(HOST, "ok", latency=1.0)
+    assert current_limit(limiter) == 4
+
+
+def test_slots_of_dead_workers_are_reclaimed(redis_conn):
+    limiter = HostLimiter(redis_conn, HostLimits(initial_limit=1, slot_ttl=0.2))
+    token, limit = limiter.try_acquire(HOST)
+    assert token is not None and limit == 1
+    assert limiter.try_acquire(HOST) == (None, 1)
+
+    # The holder never releases its slot, as if its work horse was killed
+    time.sleep(0.25)
+    assert limiter.try_acquire(HOST)[0] is not None
+
+
+def test_acquire_gives_up_after_the_timeout(redis_conn):
+    limiter = HostLimiter(redis_conn, HostLimits(initial_limit=1, acquire_timeout=0.2))
+    with limiter.slot(HOST):
+        start = time.monotonic()
+        with pytest.raises(HostBusy) as busy:
+            limiter.acquire(HOST)
+        assert time.monotonic() - start >= 0.2
+        assert (busy.value.host, busy.value.limit) == (HOST, 1)
+
+    # The slot was released on leaving the block
+    limiter.release(HOST, limiter.acquire(HOST))
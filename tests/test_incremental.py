@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import os
+from datetime import datetime, timezone
+
+from cache import URLData
+from incremental import IncrementalPlanner
+
+from data import LinksTable, RunTable, SitemapTable, UrlTable
+
+SEED = "http://example.com/"
+CHANGED = SEED + "changed"
+UNCHANGED = SEED + "unchanged"
+
+
+def sitemap_entry(loc: str, modified: str) -> dict:
+    return {
+        "source_url": SEED + "sitemap.xml",
+        "index": "root",
+        "loc": loc,
+        "priority": None,
+        "frequency": "never",
+        "modified": modified,
+        "status": None,
+    }
+
+
+def make_previous_run(data_dir, run_id="run0"):
+    os.makedirs(data_dir / run_id)
+    db_path = str(data_dir / run_id / "sqlite.db")
+    RunTable(db_path).start_run(SEED, None)
+    SitemapTable(db_path).store_sitemap_batch(
+        [sitemap_entry(CHANGED, "2025-01-01"), sitemap_entry(UNCHANGED, "2025-01-01")]
+    )
+    pages = UrlTable(db_path)
+    for url in (CHANGED, UNCHANGED):
+        pages.store_url(URLData(url=url, status=200), run_id, seed_url=SEED)
+    LinksTable(db_path).store_links(SEED, CHANGED, [UNCHANGED])
+
+
+def queued_urls(context) -> list[str]:
+    context.drain_frontier()
+    urls = []
+    for job in context.qmanager.frontier_queue.jobs:
+        url_id = job.args[2]
+        urls.append(context.cache.urls_for_ids(context.run_id, [url_id])[0])
+    return urls
+
+
+def test_unchanged_pages_linked_from_changed_pages_are_not_queued(
+    run_context, data_dir
+):
+    make_previous_run(data_dir)
+    # The current run's tables, as the Manager creates them
+    db_path = str(data_dir / run_context.run_id / "sqlite.db")
+    UrlTable(db_path)
+    LinksTable(db_path)
+    planner = IncrementalPlanner(
+        run_context.run_id,
+        "run0",
+        now=datetime(2025, 2, 1, tzinfo=timezone.utc),
+        seed_url=SEED,
+        cache=run_context.cache,
+    )
+    to_crawl = planner.plan(
+        [sitemap_entry(CHANGED, "2025-01-15"), sitemap_entry(UNCHANGED, "2025-01-01")]
+    )
+    planner.close()
+    assert to_crawl == [CHANGED]
+    run_context.cache.push_frontier(run_context.run_id, SEED, to_crawl)
+    # Parsing the changed page finds its link to the unchanged one
+    run_context.push_links(SEED, [CHANGED, UNCHANGED])
+    assert queued_urls(run_context) == [CHANGED]
+
+
+def test_carried_forward_urls_are_filtered_before_being_marked_seen(
+    run_context, data_dir
+):
+    make_previous_run(data_dir)
+    db_path = str(data_dir / run_context.run_id / "sqlite.db")
+    UrlTable(db_path)
+    LinksTable(db_path)
+    planner = IncrementalPlanner(
+        run_context.run_id,
+        "run0",
+        seed_url=SEED,
+        cache=run_context.cache,
+        url_filter=lambda urls: [],
+    )
+    planner.carry_forward([UNCHANGED])
+    planner.close()
+    assert not run_context.redis_conn.sismember(f"{run_context.run_id}:seen", UNCHANGED)
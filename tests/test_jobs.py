@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import datetime
+
+import jobs
+import pytest
+from rq.job import Job
+from serializer import MsgpackSerializer
+
+SEED = "http://example.com/"
+
+
+def test_serializer_round_trip():
+    value = {
+        "run_id": "run1",
+        "ids": (3, 17),
+        "seen": {"a"},
+        1: b"\x00raw",
+        "modified": datetime.date(2024, 5, 17),
+        "nested": {"ok": True, "score": 0.5, "none": None},
+    }
+
+    assert MsgpackSerializer.loads(MsgpackSerializer.dumps(value)) == {
+        "run_id": "run1",
+        # Tuples and sets come back as lists, other types as their str()
+        "ids": [3, 17],
+        "seen": ["a"],
+        1: b"\x00raw",
+        "modified": "2024-05-17",
+        "nested": {"ok": True, "score": 0.5, "none": None},
+    }
+
+
+def test_page_jobs_carry_only_ids(run_context, redis_conn):
+    download, parse = run_context.enqueue_pages([(SEED, SEED + "a")])[0]
+    seed_id, url_id = run_context.cache.url_ids("run1", [SEED, SEED + "a"])
+
+    for job_id, func_name in ((download.id, "jobs.download"), (parse.id, "jobs.parse")):
+        job = Job.fetch(job_id, connection=redis_conn, serializer=MsgpackSerializer)
+        assert job.func_name == func_name
+        assert job.args == ["run1", seed_id, url_id]
+        assert job.meta == {"run_id": "run1"}
+        assert jobs._resolve(*job.args, redis_conn=redis_conn) == (SEED, SEED + "a")
+
+
+def test_resolve_needs_a_connection_outside_a_job(redis_conn):
+    with pytest.raises(RuntimeError):
+        jobs._resolve("run1", 1, 2)
+    with pytest.raises(LookupError):
+        jobs._resolve("run1", 1, 2, redis_conn=redis_conn)
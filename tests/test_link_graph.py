@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import os
+import sqlite3
+
+from cache import URLData
+from link_graph import LinkGraph, analyze_run
+
+from data import LinksTable, RunTable, SitemapTable, UrlTable
+
+SEED = "http://example.com/"
+OTHER_SEED = "http://other.com/"
+
+
+def make_run(data_dir, run_id="run1") -> str:
+    os.makedirs(data_dir / run_id)
+    db_path = str(data_dir / run_id / "sqlite.db")
+    runs = RunTable(db_path)
+    runs.start_run(SEED, None)
+    runs.start_run(OTHER_SEED, None)
+    links = LinksTable(db_path)
+    links.store_links(SEED, SEED, [SEED + "a", SEED + "b"])
+    links.store_links(OTHER_SEED, OTHER_SEED, [OTHER_SEED + "a"])
+    pages = UrlTable(db_path)
+    for url, seed in [(SEED + "a", SEED), (SEED + "orphan", SEED)]:
+        pages.store_url(URLData(url=url, status=200), run_id, seed_url=seed)
+    SitemapTable(db_path).store_sitemap_batch(
+        [
+            {
+                "source_url": SEED + "sitemap.xml",
+                "index": "root",
+                "loc": loc,
+                "priority": None,
+                "frequency": None,
+                "modified": None,
+                "status": None,
+            }
+            for loc in [SEED + "listed", OTHER_SEED + "listed"]
+        ]
+    )
+    return db_path
+
+
+def scores(db_path) -> dict[tuple[str, str], tuple[int, int]]:
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute(
+        "SELECT seed_url, url, in_degree, is_orphan FROM page_scores"
+    ).fetchall()
+    return {(seed, url): (in_degree, orphan) for seed, url, in_degree, orphan in rows}
+
+
+def test_unlinked_pages_and_sitemap_entries_are_orphans(data_dir):
+    db_path = make_run(data_dir)
+    LinkGraph(db_path, SEED, run_id="run1").refresh()
+    found = scores(db_path)
+    assert found[(SEED, SEED + "orphan")] == (0, 1)
+    assert found[(SEED, SEED + "listed")] == (0, 1)
+    assert found[(SEED, SEED + "a")] == (1, 0)
+    # Sitemap entries on another seed's host aren't this seed's pages
+    assert (SEED, OTHER_SEED + "listed") not in found
+
+
+def test_analyze_run_scores_every_seed_separately(data_dir):
+    db_path = make_run(data_dir)
+    results = analyze_run("run1")
+    assert set(results) == {SEED, OTHER_SEED}
+    found = scores(db_path)
+    assert found[(OTHER_SEED, OTHER_SEED + "a")] == (1, 0)
+    assert found[(OTHER_SEED, OTHER_SEED + "listed")] == (0, 1)
+    # The seeds' rows don't overwrite each other
+    assert (SEED, SEED + "a") in found
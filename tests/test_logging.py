@@ -0,0 +1,36 @@
+import json
+import logging
+import time
+
+import callbacks  # noqa: F401
+from config.handlers import JsonFileHandler, JsonFormatter, QueueListenerHandler
+
+
+def test_module_info_records_reach_the_json_log(tmp_path, monkeypatch):
+    logger = logging.getLogger("callbacks")
+    queue_handler = next(
+        h for h in logger.handlers if isinstance(h, QueueListenerHandler)
+    )
+    json_handler = JsonFileHandler(str(tmp_path / "log.jsonl"))
+    json_handler.setFormatter(JsonFormatter())
+    monkeypatch.setattr(queue_handler.listener, "handlers", (json_handler,))
+
+    logger.info(
+        "Stored page",
+        extra={"run_id": "run1", "url": "https://example.com/", "stage": "download"},
+    )
+    # Records are written by the listener thread
+    log_path = tmp_path / "log.jsonl"
+    deadline = time.monotonic() + 5
+    while not (log_path.exists() and log_path.read_text()):
+        assert time.monotonic() < deadline, "record never reached the json log"
+        time.sleep(0.05)
+    json_handler.close()
+
+    entry = json.loads(log_path.read_text().splitlines()[0])
+    assert entry["level"] == "INFO"
+    assert entry["logger"] == "callbacks"
+    assert entry["message"] == "Stored page"
+    assert entry["run_id"] == "run1"
+    assert entry["url"] == "https://example.com/"
+    assert entry["stage"] == "download"
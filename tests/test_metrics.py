@@ -0,0 +1,28 @@
+import socket
+
+from metrics import Metrics, MetricsServer
+
+
+def test_counters_are_kept_per_run(redis_conn):
+    first = Metrics(redis_conn, run_id="run1")
+    second = Metrics(redis_conn, run_id="run2")
+    first.inc("pages_downloaded_total", 3)
+    second.inc("pages_downloaded_total")
+
+    assert first.read_counters() == [("pages_downloaded_total", {}, 3)]
+    assert second.read_counters() == [("pages_downloaded_total", {}, 1)]
+
+
+def test_server_falls_back_to_a_free_port(redis_conn):
+    taken = socket.socket()
+    taken.bind(("127.0.0.1", 0))
+    taken.listen()
+    port = taken.getsockname()[1]
+    try:
+        server = MetricsServer(Metrics(redis_conn, run_id="run1"), port=port)
+        try:
+            assert server.httpd.server_address[1] not in (0, port)
+        finally:
+            server.httpd.server_close()
+    finally:
+        taken.close()
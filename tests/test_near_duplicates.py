@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+import random
+
+from near_duplicates import NearDuplicateIndex, band_ranges, page_text, simhash
+
+WORDS = [f"word{i}" for i in range(500)]
+
+
+def article(seed: int, length: int = 400) -> list[str]:
+    rng = random.Random(seed)
+    return [rng.choice(WORDS) for _ in range(length)]
+
+
+def page(tokens: list[str], extra: str = "") -> str:
+    return f"<html><body><p>{' '.join(tokens)}</p>{extra}</body></html>"
+
+
+def test_page_text_drops_markup_and_hidden_blocks():
+    text = page_text(b"<p>Fish &amp; chips</p><script>var x = 1;</script>")
+    assert text.split() == ["Fish", "&", "chips"]
+
+
+def test_simhash_distance_follows_similarity():
+    tokens = article(1)
+    edited = list(tokens)
+    edited[200] = "changed"
+    close = (simhash(tokens) ^ simhash(edited)).bit_count()
+    far = (simhash(tokens) ^ simhash(article(2))).bit_count()
+    assert simhash(tokens) == simhash(list(tokens))
+    assert close <= 3
+    assert far > 10
+
+
+def test_bands_cover_the_fingerprint():
+    assert band_ranges(4) == [(0, 16), (16, 16), (32, 16), (48, 16)]
+    assert sum(width for _, width in band_ranges(3)) == 64
+
+
+def test_index_flags_near_duplicates(redis_conn):
+    index = NearDuplicateIndex(redis_conn, "run1")
+    tokens = article(1)
+    assert index.check("https://example.com/a", page(tokens)) is None
+    # The same article with a different footer
+    duplicate = index.check("https://example.com/b", page(tokens, "<p>Footer</p>"))
+    assert duplicate is not None
+    assert duplicate[0] == "https://example.com/a"
+    assert duplicate[1] <= index.max_distance
+    assert index.check("https://example.com/c", page(article(2))) is None
+    # Rechecking an indexed page doesn't report it as its own duplicate
+    assert index.check("https://example.com/a", page(tokens)) is None
+
+
+def test_short_pages_and_other_runs_are_not_compared(redis_conn):
+    index = NearDuplicateIndex(redis_conn, "run1", min_tokens=50)
+    short = page(["tiny", "page"])
+    assert index.check("https://example.com/a", short) is None
+    assert index.check("https://example.com/b", short) is None
+    tokens = article(1)
+    index.check("https://example.com/c", page(tokens))
+    other_run = NearDuplicateIndex(redis_conn, "run2")
+    assert other_run.check("https://example.com/c", page(tokens)) is None
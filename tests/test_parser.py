@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+from parser import PageDirectives, extract_page
+
+from bs4 import BeautifulSoup
+from scope import Scope
+
+URL = "https://example.com/docs/page"
+
+
+def extract(body: str, url: str = URL):
+    soup = BeautifulSoup(
+        f"<html><head></head><body>{body}</body></html>", "html.parser"
+    )
+    return extract_page(url, soup, Scope("https://example.com/"))
+
+
+def test_links_are_resolved_and_scoped():
+    links, directives = extract(
+        '<a href="other#top">a</a> <a href="/about">b</a>'
+        ' <a href="https://elsewhere.org/">c</a>'
+    )
+    assert links == {
+        URL,
+        "https://example.com/docs/other",
+        "https://example.com/about",
+    }
+    assert directives == PageDirectives()
+    assert not directives.any()
+
+
+def test_meta_robots_nofollow_follows_nothing():
+    links, directives = extract(
+        '<meta name="ROBOTS" content="noindex, nofollow"><a href="/a">a</a>'
+    )
+    assert links == set()
+    assert directives.noindex and directives.nofollow
+    _, none = extract('<meta name="robots" content="none">')
+    assert none.noindex and none.nofollow
+
+
+def test_rel_nofollow_links_are_counted_not_followed():
+    links, directives = extract(
+        '<a href="/a" rel="nofollow">a</a> <a href="/b" rel="UGC">b</a>'
+        ' <a href="/c">c</a>'
+    )
+    assert links == {URL, "https://example.com/c"}
+    assert directives.nofollow_links == 2
+    assert directives.any()
+
+
+def test_canonical_page_only_links_to_its_canonical():
+    body = '<link rel="canonical" href="/docs/main"><a href="/a">a</a>'
+    links, directives = extract(body)
+    assert directives.canonical_url == "https://example.com/docs/main"
+    assert not directives.is_canonical(URL)
+    assert links == {URL, "https://example.com/docs/main"}
+    # A page that is its own canonical is expanded as usual
+    links, directives = extract(body, "https://example.com/docs/main")
+    assert directives.is_canonical("https://example.com/docs/main")
+    assert "https://example.com/a" in links
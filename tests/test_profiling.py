@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import os
+from types import SimpleNamespace
+
+import profiling
+from profiling import build_report, profile_dir, profile_job
+
+
+@profile_job
+def fetch(size: int) -> int:
+    return len(bytearray(size))
+
+
+@profile_job
+def extract(count: int) -> int:
+    return len([str(i) for i in range(count)])
+
+
+def run_as_job(monkeypatch, func, job_id: str, memory=True, **meta):
+    job = SimpleNamespace(
+        id=job_id, meta={"run_id": "run1", "profile": {"memory": memory}, **meta}
+    )
+    monkeypatch.setattr(profiling, "get_current_job", lambda: job)
+    return func(1000)
+
+
+def test_jobs_are_only_profiled_when_requested(data_dir, monkeypatch):
+    # Outside a job, and in a job enqueued without --profile
+    assert fetch(10) == 10
+    monkeypatch.setattr(
+        profiling, "get_current_job", lambda: SimpleNamespace(id="job1", meta={})
+    )
+    assert fetch(10) == 10
+    assert not os.path.exists(profile_dir("run1"))
+
+
+def test_retried_jobs_keep_each_run(data_dir, monkeypatch):
+    run_as_job(monkeypatch, fetch, "job1")
+    run_as_job(monkeypatch, fetch, "job1", attempts=1)
+    run_as_job(monkeypatch, fetch, "job1", attempts=1, busy_requeues=1)
+
+    assert sorted(os.listdir(profile_dir("run1"))) == [
+        f"fetch-job1-{run}.{ext}" for run in range(3) for ext in ("prof", "snap")
+    ]
+
+
+def test_report_merges_profiles_per_function(data_dir, monkeypatch):
+    for job_id in ("a", "b", "c"):
+        run_as_job(monkeypatch, fetch, job_id)
+    run_as_job(monkeypatch, extract, "d", memory=False)
+    run_as_job(monkeypatch, extract, "e", memory=False)
+
+    report_path = build_report("run1", top=5)
+    assert report_path == os.path.join(data_dir, "run1", "profile_report.txt")
+    with open(report_path) as f:
+        report = f.read()
+    assert "===== extract (2 jobs) =====" in report
+    assert "===== fetch (3 jobs) =====" in report
+    # Memory sections only for the function whose runs traced allocations
+    assert report.count("allocation sites over") == 1
+    assert "Top 5 allocation sites over 3 jobs" in report
+    assert "test_profiling.py" in report
+
+
+def test_no_report_without_profiles(data_dir):
+    assert build_report("run1") is None
@@ -0,0 +1,60 @@
+import os
+import sqlite3
+
+import reparse
+from blob_store import BlobStore
+from cache import URLCache, URLData
+from reparse import RunReparser
+
+from data import LinksTable, RunTable, UrlTable
+
+SEED = "http://example.com/"
+PAGES = {
+    SEED: '<a href="/docs">docs</a> <a href="/private/notes">notes</a>',
+    SEED + "docs": (
+        '<meta name="robots" content="nofollow"><a href="/docs/more">more</a>'
+    ),
+    SEED + "copy": '<a href="/copied">copied</a>',
+}
+
+
+def make_run(data_dir, run_id="run1"):
+    os.makedirs(data_dir / run_id)
+    db_path = str(data_dir / run_id / "sqlite.db")
+    RunTable(db_path).start_run(SEED, None)
+    LinksTable(db_path)
+    pages = UrlTable(db_path, blob_store=BlobStore(str(data_dir / "blobs")))
+    for url, content in PAGES.items():
+        pages.store_url(URLData(url=url, content=content, status=200), run_id, SEED)
+    pages.store_near_duplicate(SEED + "copy", SEED, 2, run_id)
+    pages.store_directives(SEED + "copy", {"noindex": True}, run_id)
+    return db_path
+
+
+def test_reparse_matches_the_crawl(data_dir, redis_conn, monkeypatch):
+    monkeypatch.setattr(reparse, "DATA_DIR", str(data_dir))
+    db_path = make_run(data_dir)
+    URLCache(redis_conn).save_run_settings("run1", {"scope": {"deny": ["/private/*"]}})
+
+    counts = RunReparser("run1", workers=1, redis_conn=redis_conn).reparse()
+
+    assert counts["pages"] == 2
+    conn = sqlite3.connect(db_path)
+    links = conn.execute("SELECT source_url, linked_url FROM links").fetchall()
+    # Out of scope for the run, on a nofollow page or on a near duplicate
+    assert sorted(links) == [(SEED, SEED), (SEED, SEED + "docs")]
+    directives = conn.execute(
+        "SELECT url, canonical_url, noindex, nofollow FROM page_directives"
+    ).fetchall()
+    assert directives == [(SEED + "docs", None, 0, 1)]
+
+
+def test_reparse_without_settings_uses_config_scope(data_dir, monkeypatch):
+    monkeypatch.setattr(reparse, "DATA_DIR", str(data_dir))
+    db_path = make_run(data_dir)
+
+    RunReparser("run1", workers=1).reparse()
+
+    conn = sqlite3.connect(db_path)
+    linked = {row[0] for row in conn.execute("SELECT linked_url FROM links")}
+    assert SEED + "private/notes" in linked
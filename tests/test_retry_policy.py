@@ -0,0 +1,58 @@
+import socket
+from types import SimpleNamespace
+
+import requests
+from host_limiter import HostBusy
+from retry_policy import FailureClass, RetryPolicy, classify, parse_retry_after
+
+
+def http_error(status, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return requests.HTTPError(response=response)
+
+
+def test_classify_http_statuses():
+    assert classify(http_error(429)) == FailureClass.THROTTLED
+    assert classify(http_error(503)) == FailureClass.THROTTLED
+    assert classify(http_error(408)) == FailureClass.TIMEOUT
+    assert classify(http_error(404)) == FailureClass.PERMANENT
+    assert classify(http_error(500)) == FailureClass.SERVER
+
+
+def test_classify_wrapped_and_stage_errors():
+    wrapped = requests.ConnectionError(OSError(socket.gaierror(-2, "not known")))
+    assert classify(wrapped) == FailureClass.DNS
+    assert classify(requests.ConnectionError("refused")) == FailureClass.CONNECTION
+    assert classify(requests.Timeout()) == FailureClass.TIMEOUT
+    assert classify(HostBusy("example.com", 2)) == FailureClass.BUSY
+    assert classify(ValueError(), stage="parse") == FailureClass.PARSE
+    assert classify(ValueError()) == FailureClass.UNKNOWN
+
+
+def test_retry_after_is_the_minimum_delay():
+    policy = RetryPolicy(jitter=0)
+    decision = policy.decide(http_error(429, {"Retry-After": "120"}), 0)
+    assert decision.delay == 120
+    assert policy.decide(http_error(429, {"Retry-After": "7200"}), 0).delay is None
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+
+
+def test_gives_up_after_max_retries():
+    policy = RetryPolicy(jitter=0)
+    job = SimpleNamespace(meta={}, retries_left=None, retry_intervals=None)
+    delays = [policy.apply(job, http_error(500)).delay for _ in range(4)]
+    assert delays == [15, 30, 60, None]
+    assert job.retries_left == 0
+
+
+def test_busy_host_requeues_without_using_retries():
+    policy = RetryPolicy(jitter=0)
+    job = SimpleNamespace(meta={}, retries_left=None, retry_intervals=None)
+    for _ in range(10):
+        decision = policy.apply(job, HostBusy("example.com", 2))
+        assert decision.delay <= 10
+        assert job.retries_left == 1
+    assert job.meta == {"busy_requeues": 10, "failure_class": "busy"}
+    assert policy.apply(job, http_error(500)).attempt == 0
@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+from cache import URLCache
+from scope import Scope, ScopeRules, load_scope
+
+SEED = "https://www.example.com/docs/index.html"
+
+
+def test_hosts_and_schemes():
+    scope = Scope(SEED)
+    assert scope.reason("https://example.com/docs/a") is None
+    assert scope.reason("http://www.example.com/docs/a") is None
+    assert scope.reason("https://blog.example.com/") == "host"
+    assert scope.reason("https://example.org/docs/a") == "host"
+    assert scope.reason("mailto:someone@example.com") == "scheme"
+    subdomains = Scope(SEED, ScopeRules(include_subdomains=True))
+    assert subdomains.reason("https://blog.example.com/") is None
+    assert subdomains.reason("https://notexample.com/") == "host"
+
+
+def test_depth_is_counted_below_the_seed_directory():
+    scope = Scope(SEED, ScopeRules(max_depth=2))
+    assert scope.reason("https://example.com/docs/a/b") is None
+    assert scope.reason("https://example.com/docs/a/b/c") == "depth"
+    # Outside the seed's directory depth counts from the root
+    assert scope.reason("https://example.com/x/y") is None
+    assert scope.reason("https://example.com/x/y/z") == "depth"
+
+
+def test_patterns_and_extensions():
+    rules = ScopeRules(
+        allow=["/docs/*", "re:^/(en|de)/"],
+        deny=["/docs/private/*", "*?print=*"],
+        deny_extensions=["pdf", ".PNG"],
+    )
+    scope = Scope(SEED, rules)
+    assert scope.reason("https://example.com/docs/guide") is None
+    assert scope.reason("https://example.com/de/start") is None
+    assert scope.reason("https://example.com/blog/post") == "allow"
+    assert scope.reason("https://example.com/docs/private/keys") == "deny"
+    assert scope.reason("https://example.com/docs/guide?print=1") == "deny"
+    assert scope.reason("https://example.com/docs/manual.PDF") == "extension"
+    assert scope.reason("https://example.com/docs/logo.png") == "extension"
+    assert scope.filter(
+        ["https://example.com/docs/a", "https://example.com/blog/b"]
+    ) == ["https://example.com/docs/a"]
+
+
+def test_run_overrides_add_to_config(redis_conn, monkeypatch):
+    import scope as scope_module
+
+    monkeypatch.setattr(
+        scope_module,
+        "get_config",
+        lambda: {"scope": {"deny": ["/admin/*"], "max_depth": 5}},
+    )
+    cache = URLCache(redis_conn)
+    cache.save_run_settings("run1", {"scope": {"deny": ["/tmp/*"], "max_depth": 1}})
+    scope = load_scope(cache, "run1", "https://example.com/")
+    assert scope.rules.deny == ["/admin/*", "/tmp/*"]
+    assert scope.rules.max_depth == 1
+    assert scope.reason("https://example.com/admin/") == "deny"
+    assert scope.reason("https://example.com/a/b") == "depth"
@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import os
+import sqlite3
+
+import main
+import pytest
+from bs4 import BeautifulSoup
+from search_index import SearchIndex, queue_document
+
+
+def queue_page(redis_conn, url: str, title: str, body: str):
+    html = f"<html><head><title>{title}</title></head><body>{body}</body></html>"
+    queue_document(redis_conn, "run1", url, BeautifulSoup(html, "html.parser"))
+
+
+@pytest.fixture
+def index(data_dir):
+    os.makedirs(data_dir / "run1")
+    return SearchIndex(str(data_dir / "run1" / "sqlite.db"))
+
+
+def test_drain_indexes_queued_pages_once(index, redis_conn):
+    queue_page(redis_conn, "https://example.com/a", "Old", "stale text")
+    queue_page(redis_conn, "https://example.com/a", "Crawlers", "about crawling")
+    queue_page(redis_conn, "https://example.com/b", "Other", "<script>crawl</script>")
+    # Both versions of /a land in the first batch, only the latest is kept
+    assert index.drain(redis_conn, "run1", batch_size=2) == 2
+    assert not redis_conn.exists("run1:search_docs")
+
+    results = index.search("crawl")
+    assert [(url, title) for url, title, _, _ in results] == [
+        ("https://example.com/a", "Crawlers")
+    ]
+    assert index.search("stale") == []
+
+
+def test_results_are_ranked_by_bm25(index):
+    index.add_documents(
+        [
+            {"url": "https://example.com/body", "title": "Notes", "text": "redis"},
+            {"url": "https://example.com/title", "title": "Redis", "text": "notes"},
+            {"url": "https://example.com/none", "title": "Other", "text": "sqlite"},
+        ]
+    )
+    results = index.search("redis")
+    # Title matches are weighted above body matches
+    assert [url for url, *_ in results] == [
+        "https://example.com/title",
+        "https://example.com/body",
+    ]
+    assert results[0][3] <= results[1][3]
+
+
+def test_plain_queries_match_words_literally(index):
+    index.add_documents(
+        [{"url": "https://example.com/", "title": "", "text": "the mr-crawly C++ docs"}]
+    )
+    for query in ("mr-crawly", "C++", '"foo'):
+        with pytest.raises(sqlite3.OperationalError):
+            index.search(query)
+    assert len(index.search("mr-crawly", plain=True)) == 1
+    assert len(index.search("C++ docs", plain=True)) == 1
+    assert index.search('"foo', plain=True) == []
+
+
+def test_cli_reports_invalid_queries(index, capsys):
+    with pytest.raises(SystemExit) as exited:
+        main.search(["run1", "mr-crawly"])
+    assert exited.value.code == 2
+    assert "try --plain" in capsys.readouterr().err
@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import gzip
+import io
+import queue
+import threading
+import time
+
+from site_mapper import SiteMapper, iter_sitemap, open_sitemap
+
+SEED = "http://example.com/"
+NS = 'xmlns="http://www.sitemaps.org/schemas/sitemap/0.9"'
+
+
+def urlset(*locs: str) -> bytes:
+    entries = "".join(
+        f"<url><loc>{loc}</loc><priority>0.5</priority>"
+        "<changefreq>daily</changefreq><lastmod>2024-01-01</lastmod></url>"
+        for loc in locs
+    )
+    return f'<?xml version="1.0"?><urlset {NS}>{entries}</urlset>'.encode()
+
+
+def sitemap_index(*locs: str) -> bytes:
+    entries = "".join(f"<sitemap><loc>{loc}</loc></sitemap>" for loc in locs)
+    return f'<?xml version="1.0"?><sitemapindex {NS}>{entries}</sitemapindex>'.encode()
+
+
+def test_iter_sitemap_reads_a_urlset():
+    stream = io.BytesIO(urlset(SEED + "a", SEED + "b"))
+    entries = list(iter_sitemap(stream, SEED + "sitemap.xml", "root"))
+
+    assert [kind for kind, _ in entries] == ["url", "url"]
+    assert entries[0][1] == {
+        "source_url": SEED + "sitemap.xml",
+        "index": "root",
+        "loc": SEED + "a",
+        "priority": 0.5,
+        "frequency": "daily",
+        "modified": "2024-01-01",
+        "status": "Success",
+    }
+
+
+def test_iter_sitemap_reads_a_sitemap_index():
+    stream = io.BytesIO(sitemap_index(SEED + "one.xml", SEED + "two.xml"))
+
+    assert list(iter_sitemap(stream, SEED + "sitemap_index.xml")) == [
+        ("sitemap", SEED + "one.xml"),
+        ("sitemap", SEED + "two.xml"),
+    ]
+
+
+def test_open_sitemap_detects_gzip_by_magic_number(site_server):
+    # Served without Content-Encoding, as static .xml.gz files usually are
+    site_server.pages["/sitemap.xml.gz"] = gzip.compress(urlset(SEED + "a"))
+    site_server.pages["/sitemap.xml"] = urlset(SEED + "b")
+
+    for path, loc in (("/sitemap.xml.gz", SEED + "a"), ("/sitemap.xml", SEED + "b")):
+        response, stream = open_sitemap(site_server.url + path)
+        with response:
+            [(kind, details)] = list(iter_sitemap(stream, path))
+        assert (kind, details["loc"]) == ("url", loc)
+
+
+def test_child_sitemaps_are_fetched_concurrently(run_context, local_redis, site_server):
+    children = [f"/child-{i}.xml" for i in range(3)]
+    site_server.pages["/sitemap_index.xml"] = sitemap_index(
+        *(site_server.url + child for child in children)
+    )
+    # Each child is held until all of them have been requested, which only
+    # happens if they are fetched at the same time
+    barrier = threading.Barrier(len(children), timeout=5)
+    for i, child in enumerate(children):
+        site_server.pages[child] = urlset(SEED + f"{i}/a", SEED + f"{i}/b")
+        site_server.hooks[child] = barrier.wait
+
+    robots_reads = []
+    site_server.hooks["/robots.txt"] = lambda: robots_reads.append(1)
+
+    mapper = SiteMapper(SEED, run_id="run1")
+    mapper.max_workers = len(children)
+    root = site_server.url + "/sitemap_index.xml"
+
+    assert mapper.process_sitemaps([root]) == 6
+    assert sorted(mapper.sitemap_indexes[root]) == sorted(
+        site_server.url + child for child in children
+    )
+    assert mapper.queued_count == 6
+    # The fetch threads share one parse of the host's robots.txt
+    assert len(robots_reads) == 1
+
+
+def test_fetching_stalls_while_ready_batches_is_full(
+    run_context, local_redis, site_server
+):
+    site_server.pages["/sitemap.xml"] = urlset(*(SEED + str(i) for i in range(5)))
+    mapper = SiteMapper(SEED, run_id="run1")
+    mapper.batch_size = 1
+    mapper.ready_batches = queue.Queue(maxsize=2)
+
+    fetch = threading.Thread(
+        target=mapper.process_sitemap, args=(site_server.url + "/sitemap.xml",)
+    )
+    fetch.start()
+    deadline = time.time() + 5
+    while not mapper.ready_batches.full() and time.time() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    # Two batches are waiting and the fetch thread is blocked on the third
+    assert mapper.ready_batches.qsize() == 2
+    assert fetch.is_alive()
+
+    while fetch.is_alive() or not mapper.ready_batches.empty():
+        mapper._drain_batches()
+    fetch.join()
+    assert mapper.entry_count == 5
+
+
+def test_site_without_sitemaps_maps_to_nothing(run_context, local_redis, monkeypatch):
+    monkeypatch.setattr(SiteMapper, "discover_sitemaps", lambda self, url: [])
+    mapper = SiteMapper(SEED, run_id="run1")
+    # Returned rather than raised, so the job isn't retried for nothing
+    assert mapper.get_sitemap_urls(SEED) == ([], {}, 0, 0)
@@ -0,0 +1,35 @@
+from __future__ import annotations
+
+import callbacks
+from snapshot import RunSnapshotter, restore
+
+SEED = "http://example.com/"
+OTHER_SEED = "http://other.example/"
+
+
+def test_unfinished_jobs_survive_a_snapshot_round_trip(run_context, redis_conn):
+    run_id = run_context.run_id
+    cache = run_context.cache
+    cache.set_seed_budgets(run_id, {SEED: 10})
+    cache.push_frontier(run_id, SEED, [SEED + "a", SEED + "b"])
+    run_context.drain_frontier()
+    run_context.process_url(OTHER_SEED)
+    # Another run's jobs share the queues
+    cache.save_run_settings("run2", {"is_async": True})
+    callbacks.get_context("run2", redis_conn).enqueue_pages([(SEED, SEED + "c")])
+
+    run_context.save_pending()
+    path = RunSnapshotter(redis_conn, run_id).snapshot()
+    cache.clear_pending(run_id)
+    redis_conn.flushall()
+    restore(redis_conn, path)
+
+    assert cache.requeue_pending(run_id) == 3
+    assert sorted(cache.pop_frontier(run_id)) == [
+        (SEED, SEED + "a"),
+        (SEED, SEED + "b"),
+        (OTHER_SEED, OTHER_SEED),
+    ]
+    assert redis_conn.hget(f"{run_id}:seed_enqueued", SEED) == b"0"
+    # Nothing is left to requeue a second time
+    assert cache.requeue_pending(run_id) == 0
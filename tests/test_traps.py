@@ -0,0 +1,91 @@
+from metrics import Metrics
+from traps import TrapDetector, TrapLimits, has_repeating_segments, path_template
+
+SITE = "http://example.com"
+
+
+def make_detector(redis_conn, **limits) -> TrapDetector:
+    metrics = Metrics(redis_conn, run_id="run1")
+    return TrapDetector(redis_conn, "run1", TrapLimits(**limits), metrics)
+
+
+def test_depth_is_capped_per_host(redis_conn):
+    detector = make_detector(
+        redis_conn, max_depth=3, host_max_depth={"docs.example.com": 5}
+    )
+    urls = [
+        f"{SITE}/a/b/c",
+        f"{SITE}/a/b/c/d",
+        "http://docs.example.com/a/b/c/d/e",
+        "http://docs.example.com/a/b/c/d/e/f",
+    ]
+
+    assert detector.filter(urls) == [True, False, True, False]
+
+
+def test_repeating_segments_are_rejected(redis_conn):
+    assert has_repeating_segments(["x", "a", "b", "a", "b", "a", "b"], 2)
+    assert not has_repeating_segments(["a", "b", "a", "b"], 2)
+    assert has_repeating_segments(["a", "a", "a"], 2)
+
+    detector = make_detector(redis_conn)
+    assert detector.filter([f"{SITE}/a/b/a/b/a/b", f"{SITE}/a/b/a/b"]) == [
+        False,
+        True,
+    ]
+
+
+def test_urls_sharing_a_template_are_capped(redis_conn):
+    assert path_template("/calendar/2024/05/17") == "/calendar/{n}/{n}/{n}"
+    assert path_template("/item/9f3c2a7be14d5e61") == "/item/{id}"
+
+    detector = make_detector(redis_conn, max_urls_per_template=3)
+    days = [f"{SITE}/calendar/2024/05/{day}" for day in range(1, 6)]
+    assert detector.filter(days) == [True, True, True, False, False]
+    # The count is kept in redis, so later batches (and other processes)
+    # see the template as full too
+    items = [f"{SITE}/item/{index:016x}" for index in range(3)]
+    assert detector.filter([f"{SITE}/calendar/2025/01/01", *items]) == [
+        False,
+        True,
+        True,
+        True,
+    ]
+
+
+def test_query_variants_are_capped_per_path(redis_conn):
+    detector = make_detector(redis_conn, max_query_variants=2)
+    urls = [f"{SITE}/search?q={term}" for term in "abc"]
+
+    assert detector.filter(urls) == [True, True, False]
+    assert detector.filter([f"{SITE}/list?page=1"]) == [True]
+
+
+def test_trapped_urls_are_counted_by_reason(redis_conn):
+    detector = make_detector(
+        redis_conn, max_depth=4, max_urls_per_template=2, max_query_variants=1
+    )
+    detector.filter(
+        [
+            f"{SITE}/a/b/c/d/e",
+            f"{SITE}/x/x/x",
+            f"{SITE}/page/1",
+            f"{SITE}/page/2",
+            f"{SITE}/page/3",
+            f"{SITE}/page/4",
+            f"{SITE}/find?q=1",
+            f"{SITE}/find?q=2",
+        ]
+    )
+
+    counters = {
+        labels["reason"]: value
+        for name, labels, value in detector.metrics.read_counters()
+        if name == "trapped_urls_total"
+    }
+    assert counters == {
+        "depth": 1,
+        "repeating_segments": 1,
+        "template": 2,
+        "query_variants": 1,
+    }
@@ -0,0 +1,81 @@
+import os
+
+import requests
+from warc_writer import WarcWriter, read_record
+
+URL = "http://example.com/a?b=1"
+
+
+def make_response(body: bytes) -> requests.Response:
+    response = requests.Response()
+    response.url = URL
+    response.status_code = 200
+    response.reason = "OK"
+    response.headers["Content-Type"] = "text/html; charset=utf-8"
+    response._content = body
+    response.request = requests.Request("GET", URL).prepare()
+    return response
+
+
+def read_cdx(warc_dir) -> list[list[str]]:
+    with open(os.path.join(warc_dir, "index.cdx")) as f:
+        return [line.split() for line in f if not line.startswith(" CDX")]
+
+
+def test_exchange_is_read_back_through_the_cdx(tmp_path):
+    writer = WarcWriter(str(tmp_path))
+    entry = writer.write_exchange(make_response(b"<html>hello</html>"))
+
+    assert entry["url"] == URL
+    assert entry["mime"] == "text/html"
+    assert entry["urlkey"] == "com,example)/a?b=1"
+    [line] = read_cdx(tmp_path)
+    length, offset, filename = int(line[-3]), int(line[-2]), line[-1]
+    assert (length, offset, filename) == (
+        entry["length"],
+        entry["offset"],
+        entry["filename"],
+    )
+
+    warc_path = os.path.join(tmp_path, filename)
+    record = read_record(warc_path, offset, length)
+    assert record.startswith(b"WARC/1.1\r\n")
+    assert b"WARC-Type: response" in record
+    assert b"HTTP/1.1 200 OK" in record
+    assert record.endswith(b"<html>hello</html>\r\n\r\n")
+
+    # The request record follows the response in the same file
+    request_offset = offset + length
+    request = read_record(
+        warc_path, request_offset, os.path.getsize(warc_path) - request_offset
+    )
+    assert b"WARC-Type: request" in request
+    assert b"GET /a?b=1 HTTP/1.1" in request
+
+
+def test_files_rotate_at_max_file_size(tmp_path):
+    writer = WarcWriter(str(tmp_path), prefix="test", max_file_size=1)
+    entries = [writer.write_exchange(make_response(b"x" * 10)) for _ in range(3)]
+
+    assert [entry["filename"] for entry in entries] == [
+        "test-00000.warc.gz",
+        "test-00001.warc.gz",
+        "test-00002.warc.gz",
+    ]
+    for entry in entries:
+        record = read_record(
+            os.path.join(tmp_path, entry["filename"]), entry["offset"], entry["length"]
+        )
+        assert b"WARC-Type: response" in record
+        # Every file starts with its own warcinfo record
+        assert entry["offset"] > 0
+
+    # A writer in another process picks up after the files already written
+    other = WarcWriter(str(tmp_path), prefix="test", max_file_size=1)
+    assert other.write_exchange(make_response(b"y"))["filename"] == (
+        "test-00003.warc.gz"
+    )
+    # and the first writer moves past the file the other one filled
+    assert writer.write_exchange(make_response(b"z"))["filename"] == (
+        "test-00004.warc.gz"
+    )